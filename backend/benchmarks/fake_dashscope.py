@@ -0,0 +1,174 @@
+"""Local stand-in for the DashScope streaming API, for benchmarking the backend's own overhead.
+
+Serves the text-generation and multimodal-generation endpoints as SSE streams
+with configurable time-to-first-token, token rate, chunk size and error
+injection. Point the backend at it with::
+
+    python -m benchmarks.fake_dashscope --port 9100 --ttft 0.8 --tokens-per-sec 60
+    DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:9100/api/v1 uvicorn src.main:app
+
+Run from the backend/ directory.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from dataclasses import dataclass
+
+from aiohttp import web
+
+TEXT_PATH = "/api/v1/services/aigc/text-generation/generation"
+MULTIMODAL_PATH = "/api/v1/services/aigc/multimodal-generation/generation"
+
+# 用于拼接输出的 PRD 风格片段，每个片段约等于一个 token
+_TOKENS = "## |功能|概述|\n\n|用户|可以|通过|页面|完成|操作|，|系统|需要|保证|。".split("|")  # noqa: SIM905
+
+
+@dataclass
+class FakeUpstreamConfig:
+    ttft: float = 0.5
+    vl_extra_ttft: float = 0.5
+    tokens_per_sec: float = 50.0
+    chunk_tokens: int = 3
+    output_tokens: int = 1500
+    reasoning_tokens: int = 0
+    error_rate: float = 0.0
+    midstream_error_rate: float = 0.0
+    error_code: str = "Throttling.RateQuota"
+    seed: int | None = None
+
+
+class FakeDashScope:
+    """aiohttp application emulating DashScope SSE responses (result_format=message, incremental_output)."""
+
+    def __init__(self, config: FakeUpstreamConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(TEXT_PATH, self.text_generation)
+        app.router.add_post(MULTIMODAL_PATH, self.multimodal_generation)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    async def stats(self, _request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "active": self.active, "peak_active": self.peak_active})
+
+    async def text_generation(self, request: web.Request) -> web.StreamResponse:
+        return await self._generate(request, multimodal=False)
+
+    async def multimodal_generation(self, request: web.Request) -> web.StreamResponse:
+        return await self._generate(request, multimodal=True)
+
+    async def _generate(self, request: web.Request, multimodal: bool) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        request_id = uuid.uuid4().hex
+        config = self.config
+
+        if self.random.random() < config.error_rate:
+            return web.json_response(
+                {"code": config.error_code, "message": "Injected error", "request_id": request_id}, status=429
+            )
+
+        input_tokens = len(json.dumps(body.get("input", {}), ensure_ascii=False)) // 2
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "X-Accel-Buffering": "no"})
+        await response.prepare(request)
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await asyncio.sleep(config.ttft + (config.vl_extra_ttft if multimodal else 0))
+            fail_at = None
+            if self.random.random() < config.midstream_error_rate:
+                fail_at = self.random.randint(1, max(1, config.output_tokens))
+            interval = config.chunk_tokens / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+            event_id = 0
+            emitted = 0
+            total = config.reasoning_tokens + config.output_tokens
+            while emitted < total:
+                count = min(config.chunk_tokens, total - emitted)
+                reasoning = emitted < config.reasoning_tokens
+                if reasoning:
+                    count = min(count, config.reasoning_tokens - emitted)
+                text = "".join(_TOKENS[(emitted + i) % len(_TOKENS)] for i in range(count))
+                emitted += count
+                event_id += 1
+                if fail_at is not None and emitted - config.reasoning_tokens >= fail_at:
+                    await self._send_error(response, event_id, request_id)
+                    return response
+                usage = {"input_tokens": input_tokens, "output_tokens": emitted, "total_tokens": input_tokens + emitted}
+                message = self._message(text, reasoning, multimodal)
+                payload = {
+                    "output": {"choices": [{"message": message, "finish_reason": "null"}]},
+                    "usage": usage,
+                    "request_id": request_id,
+                }
+                if emitted >= total:
+                    payload["output"]["choices"][0]["finish_reason"] = "stop"
+                data = json.dumps(payload, ensure_ascii=False)
+                await response.write(f"id:{event_id}\nevent:result\n:HTTP_STATUS/200\ndata:{data}\n\n".encode())
+                if interval:
+                    await asyncio.sleep(interval)
+            await response.write_eof()
+        except (ConnectionResetError, asyncio.CancelledError):
+            # 后端中止上游调用（客户端断开 / 对冲落败）
+            pass
+        finally:
+            self.active -= 1
+        return response
+
+    @staticmethod
+    def _message(text: str, reasoning: bool, multimodal: bool) -> dict:
+        content = "" if reasoning else text
+        message = {"role": "assistant", "content": [{"text": content}] if multimodal and content else content}
+        message["reasoning_content"] = text if reasoning else ""
+        return message
+
+    async def _send_error(self, response: web.StreamResponse, event_id: int, request_id: str) -> None:
+        error = {"code": self.config.error_code, "message": "Injected mid-stream error", "request_id": request_id}
+        await response.write(f"id:{event_id}\nevent:error\nstatus:429\ndata:{json.dumps(error)}\n\n".encode())
+        await response.write_eof()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--vl-extra-ttft", type=float, default=0.5, help="extra first-token delay for multimodal calls")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="output rate, 0 streams as fast as possible")
+    parser.add_argument("--chunk-tokens", type=int, default=3, help="tokens per SSE event")
+    parser.add_argument("--output-tokens", type=int, default=1500)
+    parser.add_argument("--reasoning-tokens", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls rejected with HTTP 429")
+    parser.add_argument("--midstream-error-rate", type=float, default=0.0, help="fraction of streams that fail midway")
+    parser.add_argument("--error-code", default="Throttling.RateQuota")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    config = FakeUpstreamConfig(
+        ttft=args.ttft,
+        vl_extra_ttft=args.vl_extra_ttft,
+        tokens_per_sec=args.tokens_per_sec,
+        chunk_tokens=max(1, args.chunk_tokens),
+        output_tokens=args.output_tokens,
+        reasoning_tokens=args.reasoning_tokens,
+        error_rate=args.error_rate,
+        midstream_error_rate=args.midstream_error_rate,
+        error_code=args.error_code,
+        seed=args.seed,
+    )
+    web.run_app(FakeDashScope(config).app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""Load driver for /api/v1/generate: replays requests.jsonl-style traffic and reports latency and server cost.
+
+Each line of the requests file is a JSON object with either ``description`` or
+``title`` + ``body`` (the backlog format). A share of the requests can carry
+synthetic images to exercise the multimodal path. Reported per path (text /
+multimodal): throughput, p50/p90/p99 time to first token and total duration;
+when the server process is known (``--server-pid`` or ``--spawn``) also worker
+CPU time and resident memory per concurrent stream, sampled from /proc (Linux).
+
+Self-contained run against the fake upstream (from the backend/ directory)::
+
+    python -m benchmarks.load_driver --spawn --requests-file ../requests.jsonl \\
+        --total 200 --concurrency 50 --multimodal-ratio 0.2 --fake-args "--ttft 0.5 --tokens-per-sec 80"
+
+With ``--url`` every virtual user comes from the driver's IP, which the backend
+counts against ``ADMISSION_MAX_PER_CLIENT``; run that backend with
+``ADMISSION_MAX_PER_CLIENT=0`` or most requests are rejected with 429.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import math
+import os
+import random
+import shlex
+import signal
+import statistics
+import struct
+import subprocess
+import sys
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import aiohttp
+
+_FALLBACK_DESCRIPTIONS = [
+    "用户登录功能：支持手机号验证码和第三方账号登录",
+    "订单列表页：支持按状态筛选、分页和导出",
+    "消息通知中心：站内信、已读未读和批量操作",
+]
+
+
+@dataclass
+class Result:
+    kind: str
+    status: int
+    ttft: float | None
+    duration: float
+    output_chars: int = 0
+    error: str | None = None
+
+
+@dataclass
+class ServerSample:
+    rss_bytes: int
+    cpu_seconds: float
+
+
+@dataclass
+class Report:
+    wall_seconds: float
+    paths: dict[str, dict] = field(default_factory=dict)
+    server: dict | None = None
+
+
+def load_descriptions(path: str | None) -> list[str]:
+    if not path:
+        return list(_FALLBACK_DESCRIPTIONS)
+    descriptions = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        description = item.get("description") or "\n\n".join(filter(None, (item.get("title"), item.get("body"))))
+        if description:
+            descriptions.append(description)
+    return descriptions or list(_FALLBACK_DESCRIPTIONS)
+
+
+def synthetic_png(size: int, seed: int) -> str:
+    """生成 size×size 的随机噪点 PNG（Base64），压缩率接近真实截图的上限。"""
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(size * 3) for _ in range(size))
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+    return base64.b64encode(png).decode("ascii")
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class ProcessSampler:
+    """Samples RSS and CPU time of a process tree (e.g. uvicorn master + workers) from /proc."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.samples: list[ServerSample] = []
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def _tree(self, pid: int) -> list[int]:
+        pids = [pid]
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                children = Path(f"/proc/{pid}/task/{task}/children").read_text().split()
+                for child in children:
+                    pids.extend(self._tree(int(child)))
+        except OSError:
+            pass
+        return pids
+
+    def sample(self) -> ServerSample | None:
+        rss = 0
+        cpu = 0.0
+        for pid in self._tree(self.pid):
+            try:
+                stat = Path(f"/proc/{pid}/stat").read_text()
+                statm = Path(f"/proc/{pid}/statm").read_text().split()
+            except OSError:
+                continue
+            fields = stat.rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / self.clock_ticks
+            rss += int(statm[1]) * self.page_size
+        if rss == 0:
+            return None
+        sample = ServerSample(rss_bytes=rss, cpu_seconds=cpu)
+        self.samples.append(sample)
+        return sample
+
+
+class LoadDriver:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.descriptions = load_descriptions(args.requests_file)
+        self.images = [synthetic_png(args.image_size, seed) for seed in range(max(1, args.images))]
+        self.results: list[Result] = []
+        self.active = 0
+        self.peak_active = 0
+        self.active_samples: list[tuple[int, ServerSample]] = []
+
+    def payload(self, index: int, multimodal: bool) -> dict:
+        description = self.descriptions[index % len(self.descriptions)]
+        # 追加序号，避免结果缓存和相同请求合并让压测失真
+        payload = {"description": f"{description}\n\n(benchmark #{index})", "stream": self.args.stream}
+        # 每个虚拟用户一个会话，会话计数不会互相挤占
+        payload["session_id"] = f"benchmark-{index}"
+        if multimodal:
+            payload["images"] = [
+                {"data": image, "mime_type": "image/png", "filename": f"bench-{i}.png"}
+                for i, image in enumerate(self.images[: self.args.images])
+            ]
+        return payload
+
+    async def one(self, session: aiohttp.ClientSession, index: int) -> None:
+        multimodal = self.args.images > 0 and random.random() < self.args.multimodal_ratio
+        kind = "multimodal" if multimodal else "text"
+        started = time.perf_counter()
+        ttft = None
+        chars = 0
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            async with session.post(self.args.url, json=self.payload(index, multimodal)) as response:
+                if response.status != 200:
+                    body = await response.text()
+                    self.results.append(Result(kind, response.status, None, time.perf_counter() - started, error=body))
+                    return
+                error = None
+                if self.args.stream:
+                    async for line in response.content:
+                        if not line.strip():
+                            continue
+                        event = json.loads(line)
+                        event_type = event.get("type")
+                        if event_type in ("content", "reasoning"):
+                            ttft = ttft or time.perf_counter() - started
+                            chars += len(event.get("content", ""))
+                        elif event_type == "error":
+                            error = event.get("message")
+                else:
+                    body = await response.json()
+                    chars = len(body.get("markdown_content", ""))
+                    ttft = time.perf_counter() - started
+                duration = time.perf_counter() - started
+                self.results.append(Result(kind, response.status, ttft, duration, chars, error))
+        except aiohttp.ClientError as exc:
+            self.results.append(Result(kind, 0, None, time.perf_counter() - started, error=str(exc)))
+        finally:
+            self.active -= 1
+
+    async def sample_server(self, sampler: ProcessSampler, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            sample = sampler.sample()
+            if sample is not None:
+                self.active_samples.append((self.active, sample))
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(stop.wait(), self.args.sample_interval)
+
+    async def run(self, server_pid: int | None) -> Report:
+        sampler = ProcessSampler(server_pid) if server_pid else None
+        baseline = sampler.sample() if sampler else None
+        stop = asyncio.Event()
+        sampling = asyncio.create_task(self.sample_server(sampler, stop)) if sampler else None
+
+        limit = asyncio.Semaphore(self.args.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.args.timeout)
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+
+        async def guarded(session: aiohttp.ClientSession, index: int) -> None:
+            async with limit:
+                await self.one(session, index)
+
+        started = time.perf_counter()
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await asyncio.gather(*(guarded(session, index) for index in range(self.args.total)))
+        wall = time.perf_counter() - started
+
+        if sampling is not None:
+            stop.set()
+            await sampling
+        final = sampler.sample() if sampler else None
+        return self.report(wall, baseline, final)
+
+    def report(self, wall: float, baseline: ServerSample | None, final: ServerSample | None) -> Report:
+        report = Report(wall_seconds=round(wall, 3))
+        for kind in ("text", "multimodal"):
+            results = [result for result in self.results if result.kind == kind]
+            if not results:
+                continue
+            ok = [result for result in results if result.status == 200 and result.error is None]
+            ttfts = [result.ttft for result in ok if result.ttft is not None]
+            durations = [result.duration for result in ok]
+            statuses: dict[str, int] = {}
+            for result in results:
+                if result not in ok:
+                    key = str(result.status) if result.status != 200 else "stream_error"
+                    statuses[key] = statuses.get(key, 0) + 1
+            report.paths[kind] = {
+                "requests": len(results),
+                "succeeded": len(ok),
+                "errors": statuses,
+                "throughput_rps": round(len(ok) / wall, 3),
+                "output_chars_per_sec": round(sum(result.output_chars for result in ok) / wall, 1),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttft_p90": percentile(ttfts, 90),
+                "ttft_p99": percentile(ttfts, 99),
+                "duration_p50": percentile(durations, 50),
+                "duration_p99": percentile(durations, 99),
+                "duration_mean": statistics.fmean(durations) if durations else None,
+            }
+
+        if baseline is not None and final is not None:
+            peak = max((sample.rss_bytes for _, sample in self.active_samples), default=final.rss_bytes)
+            busy = [(active, sample) for active, sample in self.active_samples if active > 0]
+            per_stream = [(sample.rss_bytes - baseline.rss_bytes) / active for active, sample in busy]
+            cpu = final.cpu_seconds - baseline.cpu_seconds
+            report.server = {
+                "cpu_seconds": round(cpu, 3),
+                "cpu_percent_of_one_core": round(cpu / wall * 100, 1),
+                "cpu_ms_per_request": round(cpu * 1000 / max(1, len(self.results)), 2),
+                "rss_baseline_mb": round(baseline.rss_bytes / 2**20, 1),
+                "rss_peak_mb": round(peak / 2**20, 1),
+                "rss_per_stream_kb": round(max(per_stream) / 1024, 1) if per_stream else None,
+                "peak_concurrent_streams": self.peak_active,
+            }
+        return report
+
+
+def print_report(report: Report) -> None:
+    def fmt(value) -> str:
+        if value is None:
+            return "-"
+        return f"{value * 1000:.0f}ms" if isinstance(value, float) else str(value)
+
+    print(f"wall time: {report.wall_seconds:.1f}s")
+    for kind, stats in report.paths.items():
+        print(
+            f"[{kind}] {stats['succeeded']}/{stats['requests']} ok, errors={stats['errors'] or 0}, "
+            f"{stats['throughput_rps']} req/s, {stats['output_chars_per_sec']} chars/s"
+        )
+        print(
+            f"  ttft p50={fmt(stats['ttft_p50'])} p90={fmt(stats['ttft_p90'])} p99={fmt(stats['ttft_p99'])}  "
+            f"duration p50={fmt(stats['duration_p50'])} p99={fmt(stats['duration_p99'])}"
+        )
+    if report.server:
+        server = report.server
+        print(
+            f"[server] cpu {server['cpu_seconds']}s ({server['cpu_percent_of_one_core']}% of one core, "
+            f"{server['cpu_ms_per_request']}ms/request), rss {server['rss_baseline_mb']} -> {server['rss_peak_mb']}MB, "
+            f"~{server['rss_per_stream_kb']}KB per stream at {server['peak_concurrent_streams']} concurrent"
+        )
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    import urllib.request
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"backend exited with code {process.returncode} before becoming ready")
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready")
+
+
+def spawn(args: argparse.Namespace, processes: list[subprocess.Popen]) -> None:
+    """启动假上游和后端（uvicorn），子进程依次加入 processes，后端进程在最后。"""
+    backend_root = Path(__file__).resolve().parents[1]
+    fake = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fake_dashscope",
+            "--port",
+            str(args.fake_port),
+            *shlex.split(args.fake_args),
+        ],
+        cwd=backend_root,
+    )
+    processes.append(fake)
+    env = {
+        **os.environ,
+        "DASHSCOPE_API_KEY": os.environ.get("DASHSCOPE_API_KEY", "benchmark"),
+        "DASHSCOPE_HTTP_BASE_URL": f"http://127.0.0.1:{args.fake_port}/api/v1",
+        # 压测只衡量本服务的开销：不限制单客户端并发，不缓存结果
+        "ADMISSION_MAX_PER_CLIENT": "0",
+        "RESPONSE_CACHE": "off",
+    }
+    backend = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "src.main:app",
+            "--port",
+            str(args.backend_port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=backend_root,
+        env=env,
+    )
+    processes.append(backend)
+    _wait_ready(f"http://127.0.0.1:{args.backend_port}/health", backend)
+    args.url = f"http://127.0.0.1:{args.backend_port}/api/v1/generate"
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000/api/v1/generate")
+    parser.add_argument("--requests-file", help="JSONL with description or title/body per line")
+    parser.add_argument("--total", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="use the buffered JSON response")
+    parser.add_argument("--multimodal-ratio", type=float, default=0.0, help="share of requests sent with images")
+    parser.add_argument("--images", type=int, default=1, help="images per multimodal request (max 5)")
+    parser.add_argument("--image-size", type=int, default=512, help="edge of the synthetic images in pixels")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--server-pid", type=int, help="backend process to sample CPU / memory from")
+    parser.add_argument("--sample-interval", type=float, default=0.5)
+    parser.add_argument("--json", dest="json_path", help="also write the report as JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spawn", action="store_true", help="start the fake upstream and a local backend first")
+    parser.add_argument("--fake-args", default="", help="extra arguments for benchmarks.fake_dashscope (--spawn)")
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--backend-port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    processes: list[subprocess.Popen] = []
+    try:
+        if args.spawn:
+            spawn(args, processes)
+        server_pid = args.server_pid or (processes[-1].pid if processes else None)
+        report = asyncio.run(LoadDriver(args).run(server_pid))
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait(timeout=30)
+    print_report(report)
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(asdict(report), indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+import asyncio
+import contextlib
+import ipaddress
+import logging
+import math
+import os
+import time
+from collections import deque
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Sequence
+from functools import lru_cache
+
+from fastapi import HTTPException, Request
+
+from src.core.shared_state import MemorySharedState, SharedState, get_shared_state
+
+logger = logging.getLogger("uvicorn.error")
+
+IPNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+
+class Ticket:
+    """One admitted (or queued) generation request; release it when the response is finished."""
+
+    def __init__(self, controller: "AdmissionController", keys: tuple[str, ...]):
+        self.controller = controller
+        self.keys = keys
+        self.granted = False
+        self.released = False
+        self.granted_at = 0.0
+
+    @property
+    def position(self) -> int:
+        """1-based position in the wait queue, 0 once admitted."""
+        return self.controller.position(self)
+
+    async def wait(self, timeout: float | None = None) -> None:
+        """等待直到获得执行名额。
+
+        Raises:
+            HTTPException: 排队超时（503，带 Retry-After）
+        """
+        async for _ in self.controller.wait_positions(self, timeout):
+            pass
+
+    async def release(self) -> None:
+        await self.controller.release(self)
+
+
+class AdmissionController:
+    """Bounds concurrent generations per worker, globally and per client.
+
+    Requests beyond the global limit wait in a bounded FIFO queue. A client already
+    at its own limit, or a full queue, is rejected immediately (429 / 503 with
+    Retry-After) instead of piling more load onto the upstream.
+
+    A request is counted against every client key it carries (see
+    ``client_keys``: the client IP and, when given, the session), and is
+    rejected when any of them is at the limit. Per-client counts live in the
+    shared state (see ``SHARED_STATE``), so with several workers the
+    per-client limit holds across all of them. The shared
+    state may be SQLite or Redis, so its calls run in a worker thread instead of
+    on the event loop. Each count expires ``client_lease`` seconds after the
+    client's last admission or release, which bounds how long a crashed
+    worker's leftover counts can block a client.
+
+    Configuration (env):
+        ADMISSION_MAX_CONCURRENT: generations running at once per worker (default 100, 0 disables the limit)
+        ADMISSION_MAX_PER_CLIENT: running + queued requests per IP and per session (default 4, 0 disables)
+        ADMISSION_MAX_QUEUE: requests allowed to wait for a slot (default 200)
+        ADMISSION_QUEUE_TIMEOUT: seconds a request may wait before giving up with 503 (default 60)
+        ADMISSION_CLIENT_LEASE: lifetime of a client's count after its last request (default 900)
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int | None = None,
+        max_per_client: int | None = None,
+        max_queue: int | None = None,
+        queue_timeout: float | None = None,
+        state: SharedState | None = None,
+        client_lease: float | None = None,
+    ):
+        if max_concurrent is None:
+            max_concurrent = int(os.getenv("ADMISSION_MAX_CONCURRENT", "100"))
+        if max_per_client is None:
+            max_per_client = int(os.getenv("ADMISSION_MAX_PER_CLIENT", "4"))
+        if max_queue is None:
+            max_queue = int(os.getenv("ADMISSION_MAX_QUEUE", "200"))
+        if queue_timeout is None:
+            queue_timeout = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "60"))
+        if client_lease is None:
+            client_lease = float(os.getenv("ADMISSION_CLIENT_LEASE", "900"))
+        self.max_concurrent = max_concurrent
+        self.max_per_client = max_per_client
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.state = state or MemorySharedState()
+        self.client_lease = client_lease
+
+        self.active = 0
+        self._queue: deque[Ticket] = deque()
+        self._changed = asyncio.Event()
+        # 平均生成时长（指数移动平均），用于估算 Retry-After
+        self._avg_duration = 30.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def retry_after(self, ahead: int = 0) -> int:
+        slots = self.max_concurrent if self.max_concurrent > 0 else 1
+        return max(1, math.ceil(self._avg_duration * (ahead // slots + 1)))
+
+    async def admit(self, keys: str | Sequence[str]) -> Ticket:
+        """登记一个请求：有空闲名额时直接放行，否则进入等待队列。
+
+        Args:
+            keys: 计数所用的客户端键（见 ``client_keys``），任一键达到上限即拒绝
+
+        Raises:
+            HTTPException: 该客户端并发已满（429）或等待队列已满（503），均带 Retry-After
+        """
+        keys = _as_keys(keys)
+        if not await self._claim_clients(keys):
+            raise HTTPException(
+                status_code=429,
+                detail="Too many concurrent generations for this client",
+                headers={"Retry-After": str(self.retry_after())},
+            )
+        ticket = Ticket(self, keys)
+        if self.max_concurrent <= 0 or (self.active < self.max_concurrent and not self._queue):
+            self._grant(ticket)
+        elif len(self._queue) >= self.max_queue:
+            logger.warning("admission queue full: active=%d queued=%d", self.active, len(self._queue))
+            await self._release_clients(keys)
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please retry later",
+                headers={"Retry-After": str(self.retry_after(len(self._queue)))},
+            )
+        else:
+            self._queue.append(ticket)
+        return ticket
+
+    async def try_admit(self, keys: str | Sequence[str]) -> Ticket | None:
+        """不排队地再占用一个名额（同一请求的扇出调用）；没有空闲名额或该客户端已达上限时返回 None。"""
+        keys = _as_keys(keys)
+        if not self._has_free_slot():
+            return None
+        if not await self._claim_clients(keys):
+            return None
+        # 更新共享计数期间名额可能已被其他请求占用
+        if not self._has_free_slot():
+            await self._release_clients(keys)
+            return None
+        ticket = Ticket(self, keys)
+        self._grant(ticket)
+        return ticket
+
+    async def wait_admit(self, keys: str | Sequence[str], poll_interval: float = 1.0) -> Ticket:
+        """后台任务用：等到 try_admit 成功为止，不返回 429 / 503。
+
+        排队中的交互请求优先；每次名额变化或每隔 poll_interval 秒重试一次
+        （单客户端计数可能由其他 worker 释放，本进程收不到通知）。
+        """
+        while True:
+            changed = self._changed
+            ticket = await self.try_admit(keys)
+            if ticket is not None:
+                return ticket
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(changed.wait(), poll_interval)
+
+    def _has_free_slot(self) -> bool:
+        # 有请求在排队时不插队
+        return self.max_concurrent <= 0 or (self.active < self.max_concurrent and not self._queue)
+
+    async def _claim_clients(self, keys: tuple[str, ...]) -> bool:
+        """各客户端键计数加一；任一键超过上限时全部撤回并返回 False。"""
+        if self.max_per_client <= 0:
+            return True
+        counted: list[str] = []
+        for key in keys:
+            counted.append(key)
+            if await self._count_client(key, 1) > self.max_per_client:
+                for claimed in counted:
+                    await self._count_client(claimed, -1)
+                return False
+        return True
+
+    async def _release_clients(self, keys: tuple[str, ...]) -> None:
+        if self.max_per_client > 0:
+            for key in keys:
+                await self._count_client(key, -1)
+
+    async def _count_client(self, key: str, delta: int) -> int:
+        # SQLite / Redis 调用可能阻塞（写锁等待、网络往返），放到线程中执行
+        return await asyncio.to_thread(self._incr_client, key, delta)
+
+    def _incr_client(self, key: str, delta: int) -> int:
+        # 每次写入都刷新租期，空闲客户端的计数随租期过期
+        name = f"admission:{key}"
+        count = self.state.incr(name, delta, self.client_lease)
+        if count < 0:
+            # 租期过期后的释放会把计数减成负数（客户端凭空多出名额），补回到 0
+            count = self.state.incr(name, -count, self.client_lease)
+        return count
+
+    def position(self, ticket: Ticket) -> int:
+        if ticket.granted:
+            return 0
+        try:
+            return self._queue.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    async def wait_positions(self, ticket: Ticket, timeout: float | None = None) -> AsyncGenerator[int, None]:
+        """排队期间每当位置变化时产出当前位置，获得名额后结束。
+
+        Raises:
+            HTTPException: 超过 timeout（默认 ADMISSION_QUEUE_TIMEOUT）仍未轮到（503）
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        last_position = None
+        while not ticket.granted:
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield position
+            changed = self._changed
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                await self.release(ticket)
+                raise HTTPException(
+                    status_code=503,
+                    detail="Timed out waiting for a free generation slot",
+                    headers={"Retry-After": str(self.retry_after(len(self._queue)))},
+                )
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(changed.wait(), remaining)
+
+    async def release(self, ticket: Ticket) -> None:
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.granted:
+            self.active -= 1
+            duration = time.monotonic() - ticket.granted_at
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+        else:
+            # 排队中放弃（超时或客户端断开）
+            with contextlib.suppress(ValueError):
+                self._queue.remove(ticket)
+        while self._queue and (self.max_concurrent <= 0 or self.active < self.max_concurrent):
+            self._grant(self._queue.popleft())
+        self._notify()
+        # 本地名额先归还，再更新共享计数
+        await self._release_clients(ticket.keys)
+
+    def _grant(self, ticket: Ticket) -> None:
+        ticket.granted = True
+        ticket.granted_at = time.monotonic()
+        self.active += 1
+
+    def _notify(self) -> None:
+        # 唤醒所有排队者重新计算位置，并为下一轮等待准备新的 Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def stream(
+        self,
+        ticket: Ticket,
+        start: Callable[[], AsyncIterator[dict]],
+    ) -> AsyncGenerator[dict, None]:
+        """流式响应的排队包装：排队时先产出 queued / position 事件，轮到后再启动生成。
+
+        无论正常结束、出错还是客户端断开，都会释放名额。
+        """
+        try:
+            if not ticket.granted:
+                event_type = "queued"
+                try:
+                    async for position in self.wait_positions(ticket):
+                        yield {"type": event_type, "position": position}
+                        event_type = "position"
+                except HTTPException as exc:
+                    yield {"type": "error", "message": exc.detail}
+                    return
+            async for event in start():
+                yield event
+        finally:
+            await ticket.release()
+
+
+class SlotPool:
+    """Admission slots for the concurrent sub-calls of one admitted request (batch items, parallel sections).
+
+    The request's own ticket is the first slot. Every further concurrent
+    sub-call takes an extra slot with ``try_admit``, so the fan-out counts
+    against the global and per-client limits like separate requests would.
+    When no extra slot is free (server busy, client at its limit) the sub-call
+    waits for a slot held by the pool, and retries ``try_admit`` every
+    ``retry_interval`` seconds. Extra slots are released as soon as their
+    sub-call ends.
+    """
+
+    def __init__(self, controller: AdmissionController, keys: str | Sequence[str], retry_interval: float = 1.0):
+        self.controller = controller
+        self.keys = _as_keys(keys)
+        self.retry_interval = retry_interval
+        self._base_free = True
+        self._available = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncGenerator[None, None]:
+        """占用一个名额执行一次子调用，结束时归还。"""
+        ticket = await self._acquire()
+        try:
+            yield
+        finally:
+            if ticket is not None:
+                await ticket.release()
+            async with self._available:
+                if ticket is None:
+                    self._base_free = True
+                self._available.notify()
+
+    async def _acquire(self) -> Ticket | None:
+        async with self._available:
+            while True:
+                if self._base_free:
+                    self._base_free = False
+                    return None
+                ticket = await self.controller.try_admit(self.keys)
+                if ticket is not None:
+                    return ticket
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._available.wait(), self.retry_interval)
+
+
+def parse_trusted_proxies(value: str) -> tuple[IPNetwork, ...]:
+    """解析逗号分隔的代理地址 / 网段（如 ``127.0.0.1,10.0.0.0/8``）。"""
+    return tuple(ipaddress.ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip())
+
+
+@lru_cache
+def get_trusted_proxies() -> tuple[IPNetwork, ...]:
+    """TRUSTED_PROXIES: 可信反向代理的地址或网段，逗号分隔（默认为空：不信任任何转发头）。"""
+    return parse_trusted_proxies(os.getenv("TRUSTED_PROXIES", ""))
+
+
+def _is_trusted(address: str, trusted: tuple[IPNetwork, ...]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted)
+
+
+def client_ip(request: Request, trusted: tuple[IPNetwork, ...] | None = None) -> str:
+    """客户端 IP。
+
+    只有直连的对端是可信代理时才读取转发头：优先取代理设置的 X-Real-IP，
+    否则从右向左跳过 X-Forwarded-For 中的可信代理，取第一个不可信的地址。
+    X-Forwarded-For 最左侧的地址由客户端自己填写，不可作为依据。
+    """
+    if trusted is None:
+        trusted = get_trusted_proxies()
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted(peer, trusted):
+        return peer
+    real_ip = request.headers.get("x-real-ip", "").strip()
+    if real_ip:
+        return real_ip
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted(hop, trusted):
+            return hop
+    return hops[0] if hops else peer
+
+
+def client_keys(request: Request, *session_ids: str | None) -> tuple[str, ...]:
+    """并发限制的计数键：客户端 IP（见 `client_ip`）及请求带的各个会话。
+
+    session_id 由客户端任意填写，只作为附加的计数键：每次换一个新会话也绕不过按 IP 的上限。
+    """
+    sessions = dict.fromkeys(f"session:{session_id}" for session_id in session_ids if session_id)
+    return (f"ip:{client_ip(request)}", *sessions)
+
+
+def _as_keys(keys: str | Sequence[str]) -> tuple[str, ...]:
+    return (keys,) if isinstance(keys, str) else tuple(keys)
+
+
+@lru_cache
+def get_admission_controller() -> AdmissionController:
+    """Process-wide admission controller configured from the environment."""
+    return AdmissionController(state=get_shared_state())
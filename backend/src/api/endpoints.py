@@ -1,41 +1,246 @@
-import json
+import asyncio
+import io
 import logging
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Coroutine
+from contextlib import AbstractAsyncContextManager
+from functools import lru_cache
+from typing import Any
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-from src.models.schemas import GenerationRequest
+from src.api.admission import AdmissionController, SlotPool, client_keys, get_admission_controller
+from src.core.event_encoder import get_event_encoder
+from src.core.prompt_loader import get_chat_patch_prompt_loader, get_chat_prompt_loader, get_prompt_loader
+from src.core.tracing import current_span, span
+from src.models.schemas import MAX_IMAGE_SIZE, BatchGenerationRequest, GenerationRequest
+from src.services.batch import BatchRunner, get_batch_runner
+from src.services.image_store import ImageStore, ImageUploadError, get_image_store
+from src.services.jobs import JobQueue, JobQueueFull
 from src.services.llm_service import LLMService
+from src.services.resumable import ResumableStream, ResumableStreams, get_resumable_streams
+from src.services.session_store import SessionStore, get_session_store, prd_etag
 
 router = APIRouter()
 logger = logging.getLogger("uvicorn.error")
 
 
-def get_llm_service():
+@lru_cache
+def get_llm_service() -> LLMService:
+    """Process-wide LLMService, shared by all requests so the upstream connection pool is reused."""
     return LLMService()
 
 
-def _collect_stream_content(chunks) -> str:
-    content_parts: list[str] = []
-    for chunk in chunks:
-        for line in chunk.splitlines():
-            line = line.strip()
-            if not line:
-                continue
+async def close_llm_service() -> None:
+    """Release the shared service's upstream connections (app shutdown)."""
+    if get_llm_service.cache_info().currsize:
+        await get_llm_service().aclose()
+        get_llm_service.cache_clear()
+
+
+@lru_cache
+def get_job_queue() -> JobQueue:
+    """Process-wide background job queue; its workers share the LLMService singleton."""
+    return JobQueue(lambda request, keys: _job_events(get_llm_service(), get_admission_controller(), request, keys))
+
+
+async def close_job_queue() -> None:
+    """Stop the job workers (app shutdown); running jobs are queued again for other workers or the next start."""
+    if get_job_queue.cache_info().currsize:
+        await get_job_queue().close()
+        get_job_queue.cache_clear()
+
+
+def _request_events(
+    llm_service: LLMService,
+    request: GenerationRequest,
+    slot: Callable[[], AbstractAsyncContextManager] | None = None,
+) -> AsyncIterator[dict]:
+    if request.mode == "chat":
+        return llm_service.achat_events(
+            current_prd=request.current_prd,
+            user_message=request.description,
+            images=request.images,
+            edit_mode=request.edit_mode,
+            session_id=request.session_id,
+        )
+    # Generate mode (default): create PRD from scratch
+    return llm_service.agenerate_events(
+        user_description=request.description,
+        images=request.images,
+        session_id=request.session_id,
+        generation_mode=request.generation_mode,
+        slot=slot,
+    )
+
+
+async def _job_events(
+    llm_service: LLMService,
+    admission: AdmissionController,
+    request: GenerationRequest,
+    keys: tuple[str, ...],
+) -> AsyncGenerator[dict, None]:
+    """后台任务同样计入准入：等待空闲名额后再生成，parallel 模式的各章节各占一个名额。"""
+    ticket = await admission.wait_admit(keys)
+    try:
+        async for event in _request_events(llm_service, request, SlotPool(admission, keys).slot):
+            yield event
+    finally:
+        await ticket.release()
+
+
+async def _collect_content(events: AsyncIterator[dict]) -> str:
+    """非流式模式的聚合阶段：直接消费事件字典，不再反解析 NDJSON。"""
+    buffer = io.StringIO()
+    async for event in events:
+        event_type = event.get("type")
+        if event_type == "content":
+            buffer.write(event.get("content", ""))
+        elif event_type == "error":
+            raise HTTPException(status_code=502, detail="Upstream model error")
+    return buffer.getvalue()
+
+
+async def _wait_for_disconnect(http_request: Request) -> None:
+    """请求体已读完，之后 receive() 只会在客户端断开（或响应结束）时返回 http.disconnect。"""
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _stream_until_disconnect(http_request: Request, chunks: AsyncIterator[str]) -> AsyncGenerator[str, None]:
+    """转发流式响应；客户端断开时立即关闭上游事件流，而不是等到下一次写入失败。"""
+    iterator = aiter(chunks)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(http_request))
+    next_chunk: asyncio.Future | None = None
+    try:
+        while True:
+            next_chunk = asyncio.ensure_future(anext(iterator))
+            await asyncio.wait({next_chunk, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_chunk.done():
+                logger.info("client disconnected, aborting stream")
+                return
             try:
-                event = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            event_type = event.get("type")
-            if event_type == "content":
-                content_parts.append(event.get("content", ""))
-            elif event_type == "error":
-                raise HTTPException(status_code=502, detail="Upstream model error")
-    return "".join(content_parts)
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                next_chunk = None
+                return
+            next_chunk = None
+            yield chunk
+    finally:
+        for task in (next_chunk, watcher):
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+async def _run_until_disconnect(http_request: Request, work: Coroutine[Any, Any, str]) -> str:
+    """非流式模式：排队和聚合期间客户端断开时取消生成。"""
+    collect = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({collect, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if collect.done():
+            return collect.result()
+        logger.info("client disconnected, aborting generation")
+        raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        for task in (collect, watcher):
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+
+
+async def _resolve_session(request: GenerationRequest, session_store: SessionStore | None) -> None:
+    """chat 模式未携带 current_prd / images 时，从会话存储中取回上一版 PRD 和图片。"""
+    needs_prd = not request.current_prd
+    needs_images = request.reuse_session_images and not request.images
+    if not (needs_prd or needs_images) or not request.session_id or session_store is None:
+        return
+    record = await session_store.get(request.session_id)
+    if record is None:
+        if needs_prd:
+            raise HTTPException(status_code=404, detail="Session not found or expired, resend current_prd")
+        return
+    if needs_prd:
+        if request.prd_etag and request.prd_etag != record.etag:
+            raise HTTPException(status_code=409, detail="Stored PRD version does not match prd_etag")
+        request.current_prd = record.prd
+    if needs_images:
+        request.images = record.image_attachments() or None
+
+
+def _resumable_response(
+    http_request: Request,
+    resumable: ResumableStreams,
+    stream: ResumableStream,
+    last_event_id: int = 0,
+) -> StreamingResponse:
+    events = resumable.subscribe(stream, last_event_id)
+    chunks = get_event_encoder().encode_stream(events, coalesce=False)
+    return StreamingResponse(
+        _stream_until_disconnect(http_request, chunks),
+        media_type="application/x-ndjson",
+        headers={"X-Generation-Id": stream.generation_id},
+    )
+
+
+def _check_image_refs(request: GenerationRequest, image_store: ImageStore) -> None:
+    """确认 image_id 引用的图片仍在存储中，并补全 MIME 类型和大小。"""
+    if not request.images:
+        return
+    resolved = []
+    for img in request.images:
+        if img.image_id is not None:
+            stored = image_store.get(img.image_id)
+            if stored is None:
+                raise HTTPException(status_code=400, detail=f"Unknown or expired image_id: {img.image_id}")
+            img = img.model_copy(update={"mime_type": stored.mime_type, "size": stored.size})
+        resolved.append(img)
+    request.images = resolved
+
+
+async def _prepare_request(
+    request: GenerationRequest,
+    session_store: SessionStore | None,
+    image_store: ImageStore,
+) -> None:
+    """生成前的请求校验：补全会话中的 PRD / 图片，确认图片引用有效。"""
+    # Chat mode: modify existing PRD (full rewrite or section patches, see edit_mode)
+    if request.mode == "chat":
+        await _resolve_session(request, session_store)
+        if not request.current_prd:
+            raise HTTPException(status_code=400, detail="current_prd is required for chat mode")
+    _check_image_refs(request, image_store)
+
+
+@router.post("/images")
+async def upload_image(request: Request, image_store: ImageStore = Depends(get_image_store)):
+    """上传单张图片（请求体为原始图片字节），返回可在 /generate 中引用的 image_id。
+
+    图片以流的方式写入临时文件并计算哈希，类型由文件头魔数判断，无需 Base64 编码。
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_IMAGE_SIZE} bytes")
+    try:
+        image = await image_store.save_stream(request.stream())
+    except ImageUploadError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=str(exc)) from None
+    return {"image_id": image.image_id, "mime_type": image.mime_type, "size": image.size}
 
 
 @router.post("/generate")
-async def generate_spec(request: GenerationRequest, llm_service: LLMService = Depends(get_llm_service)):
+async def generate_spec(
+    request: GenerationRequest,
+    http_request: Request,
+    llm_service: LLMService = Depends(get_llm_service),
+    session_store: SessionStore | None = Depends(get_session_store),
+    image_store: ImageStore = Depends(get_image_store),
+    admission: AdmissionController = Depends(get_admission_controller),
+    resumable: ResumableStreams = Depends(get_resumable_streams),
+):
     if request.session_id:
         logger.info(
             "generate request session_id=%s mode=%s images=%d",
@@ -44,24 +249,170 @@ async def generate_spec(request: GenerationRequest, llm_service: LLMService = De
             len(request.images) if request.images else 0,
         )
 
-    if request.mode == "chat":
-        # Chat mode: modify existing PRD (always outputs full new PRD)
-        if not request.current_prd:
-            raise HTTPException(status_code=400, detail="current_prd is required for chat mode")
-        generator = llm_service.chat_stream(
-            current_prd=request.current_prd,
-            user_message=request.description,
-            images=request.images,
-        )
-    else:
-        # Generate mode (default): create PRD from scratch
-        generator = llm_service.generate_stream(
-            user_description=request.description,
-            images=request.images,
-        )
+    request_span = current_span()
+    if request_span is not None:
+        request_span.set(mode=request.mode, stream=request.stream, images=len(request.images or ()))
+    with span("generate.prepare"):
+        await _prepare_request(request, session_store, image_store)
+
+    # 准入控制：超出本客户端并发上限直接 429，队列已满直接 503；否则放行或排队
+    keys = client_keys(http_request, request.session_id)
+    ticket = await admission.admit(keys)
+    # parallel 模式的各章节调用同样计入准入，第一个章节沿用本请求的名额
+    slots = SlotPool(admission, keys)
+
+    def start_events() -> AsyncIterator[dict]:
+        return _request_events(llm_service, request, slots.slot)
 
     if request.stream:
-        return StreamingResponse(generator, media_type="application/x-ndjson")
+        # 流式模式走原生 asyncio 路径，不占用 Starlette 线程池。
+        # 排队期间先推送 queued / position 事件；生成在后台进行，断线后可凭 generation_id 续传
+        events = get_event_encoder().coalesce(admission.stream(ticket, start_events))
+        return _resumable_response(http_request, resumable, resumable.start(events))
+
+    # 非流式模式同样在事件循环上异步聚合，不阻塞 /health 与其他请求
+    async def collect() -> str:
+        with span("admission.wait"):
+            await ticket.wait()
+        with span("generate.collect"):
+            return await _collect_content(start_events())
+
+    try:
+        content = await _run_until_disconnect(http_request, collect())
+    finally:
+        await ticket.release()
+
+    headers = {"ETag": f'"{prd_etag(content)}"'} if request.session_id and session_store is not None else None
+    return JSONResponse({"markdown_content": content}, headers=headers)
+
+
+@router.post("/generate/batch")
+async def generate_batch(
+    batch: BatchGenerationRequest,
+    http_request: Request,
+    llm_service: LLMService = Depends(get_llm_service),
+    session_store: SessionStore | None = Depends(get_session_store),
+    image_store: ImageStore = Depends(get_image_store),
+    admission: AdmissionController = Depends(get_admission_controller),
+    resumable: ResumableStreams = Depends(get_resumable_streams),
+    runner: BatchRunner = Depends(get_batch_runner),
+):
+    """批量生成：各项并发执行（受 parallelism 限制），事件以 NDJSON 多路复用返回，用 index 区分所属条目。
+
+    所有条目共享同一个 LLMService（提示词与上游连接池）。批次先按一个请求排队准入，
+    之后每个同时执行的条目各占一个准入名额，受全局与单客户端并发上限约束。
+    """
+    for index, request in enumerate(batch.items):
+        try:
+            await _prepare_request(request, session_store, image_store)
+        except HTTPException as exc:
+            raise HTTPException(status_code=exc.status_code, detail=f"items[{index}]: {exc.detail}") from None
+
+    # 按客户端 IP 和各条目的会话计数，与逐条发送 /generate 受同样的限制
+    keys = client_keys(http_request, *(request.session_id for request in batch.items))
+    ticket = await admission.admit(keys)
+    slots = SlotPool(admission, keys)
+    encoder = get_event_encoder()
+    # 每一项先各自合并增量再打上 index，避免不同条目的 content 被拼在一起。
+    # 条目内的并行章节另用一个名额池，其基础名额即该条目占用的名额，避免与其他条目互相等待
+    starts = [
+        lambda request=request: encoder.coalesce(_request_events(llm_service, request, SlotPool(admission, keys).slot))
+        for request in batch.items
+    ]
+    logger.info("batch request items=%d parallelism=%d", len(batch.items), runner.parallelism(batch.parallelism))
+
+    def start_events() -> AsyncIterator[dict]:
+        return runner.stream(starts, batch.parallelism, slot=slots.slot)
+
+    events = admission.stream(ticket, start_events)
+    return _resumable_response(http_request, resumable, resumable.start(events))
+
+
+@router.post("/jobs", status_code=202)
+async def submit_job(
+    request: GenerationRequest,
+    http_request: Request,
+    session_store: SessionStore | None = Depends(get_session_store),
+    image_store: ImageStore = Depends(get_image_store),
+    jobs: JobQueue = Depends(get_job_queue),
+):
+    """提交后台生成任务，立即返回 job_id；结果通过 GET /jobs/{job_id} 轮询。
+
+    适合批量生成、不需要逐 token 推送的调用方（stream 字段被忽略）。任务执行时按提交者的
+    IP / 会话计入准入控制，等待空闲名额，不会返回 429。
+    """
+    await _prepare_request(request, session_store, image_store)
+    try:
+        record = await jobs.submit(request, client_keys(http_request, request.session_id))
+    except JobQueueFull:
+        raise HTTPException(status_code=503, detail="Job queue is full, please retry later") from None
+    return JSONResponse(record.summary(), status_code=202, headers={"Location": f"/api/v1/jobs/{record.job_id}"})
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, jobs: JobQueue = Depends(get_job_queue)):
+    """任务状态与 usage；成功后附带生成结果。"""
+    record = await jobs.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    body = record.summary()
+    if record.status == "succeeded":
+        body["markdown_content"] = record.result
+    return body
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, jobs: JobQueue = Depends(get_job_queue)):
+    """取消任务；在其他 worker 上运行的任务返回 cancel_requested，稍后变为 cancelled。"""
+    record = await jobs.cancel(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return record.summary()
+
+
+@router.get("/generations/{generation_id}")
+async def resume_generation(
+    generation_id: str,
+    http_request: Request,
+    last_event_id: int | None = None,
+    resumable: ResumableStreams = Depends(get_resumable_streams),
+):
+    """断线重连：从 last_event_id（或 Last-Event-ID 请求头）之后继续接收同一次生成的事件。"""
+    if last_event_id is None:
+        header = http_request.headers.get("last-event-id", "")
+        last_event_id = int(header) if header.isdigit() else 0
+    stream = resumable.get(generation_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
+    if not stream.can_resume(last_event_id):
+        raise HTTPException(status_code=410, detail="Requested events are no longer buffered, please regenerate")
+    return _resumable_response(http_request, resumable, stream, last_event_id)
+
+
+@router.get("/sessions/{session_id}")
+async def get_session(session_id: str, session_store: SessionStore | None = Depends(get_session_store)):
+    """取回会话中保存的最新 PRD（例如页面刷新后恢复）。"""
+    record = await session_store.get(session_id) if session_store is not None else None
+    if record is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return JSONResponse(
+        {"session_id": session_id, "etag": record.etag, "markdown_content": record.prd, "images": len(record.images)},
+        headers={"ETag": f'"{record.etag}"'},
+    )
+
+
+@router.delete("/sessions/{session_id}", status_code=204)
+async def delete_session(session_id: str, session_store: SessionStore | None = Depends(get_session_store)):
+    if session_store is None or not await session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return Response(status_code=204)
+
 
-    content = _collect_stream_content(generator)
-    return JSONResponse({"markdown_content": content})
+@router.get("/prompts")
+def prompt_versions():
+    """当前生效的提示词版本，便于运维确认线上编辑是否已生效。"""
+    return {
+        "generate": get_prompt_loader().version,
+        "chat": get_chat_prompt_loader().version,
+        "chat_patch": get_chat_patch_prompt_loader().version,
+    }
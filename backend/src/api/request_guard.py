@@ -0,0 +1,299 @@
+"""Bounded-cost pre-validation of request bodies, before FastAPI / Pydantic parse them.
+
+FastAPI only validates a ``GenerationRequest`` after the whole body has been
+received, ``json.loads`` has built every string and the model has been
+materialized, so a 200 MB body or a 50 MB "image" costs that much memory and CPU
+before it is rejected. The middleware here rejects such requests while the body
+is still arriving:
+
+- a total body cap, checked against Content-Length up front and against the
+  bytes actually received (chunked uploads)
+- an incremental scan of JSON bodies that tracks string lengths and array sizes
+  by key, so an oversized ``images[].data`` / ``current_prd`` / ``description``
+  (413) or too many ``images`` / ``items`` (422, in the same shape as the
+  Pydantic error) fail at the chunk that crosses the limit
+
+The scanner only counts; it does not check JSON syntax or build any values.
+Malformed bodies are left to FastAPI (422) and Pydantic still enforces the same
+limits exactly after parsing.
+"""
+
+import json
+import os
+import re
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from src.models.schemas import (
+    MAX_BATCH_ITEMS,
+    MAX_DESCRIPTION_CHARS,
+    MAX_IMAGE_BASE64_CHARS,
+    MAX_IMAGES_PER_REQUEST,
+    MAX_PRD_CHARS,
+)
+
+# 默认请求体上限：满额 Base64 图片加上 PRD、描述等文本的余量
+DEFAULT_MAX_BYTES = MAX_IMAGES_PER_REQUEST * MAX_IMAGE_BASE64_CHARS + 8 * 1024 * 1024
+
+# 按键名限制字符串长度（字符数）和数组元素个数，与 schemas 中的字段约束一致
+STRING_LIMITS = {
+    "data": MAX_IMAGE_BASE64_CHARS,
+    "current_prd": MAX_PRD_CHARS,
+    "description": MAX_DESCRIPTION_CHARS,
+}
+ARRAY_LIMITS = {"images": MAX_IMAGES_PER_REQUEST, "items": MAX_BATCH_ITEMS}
+
+# 字符串外：一个结构字符，或一段字面量（数字 / true / false / null）
+_TOKEN_RE = re.compile(rb'["{}\[\],:]|[^\s"{}\[\],:]+')
+# 字符串内：下一个引号或反斜杠
+_STRING_STOP_RE = re.compile(rb'["\\]')
+# UTF-8 续字节，不计入字符数
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+_MAX_KEY_BYTES = 256
+
+
+class PayloadTooLarge(ValueError):
+    """请求体超过限制，对应 HTTP 413。"""
+
+
+class TooManyItems(ValueError):
+    """数组元素个数超过限制，对应 HTTP 422（与 Pydantic 的校验错误一致）。
+
+    Attributes:
+        loc: 数组在请求体中的位置，如 ``("items", 3, "images")``
+    """
+
+    def __init__(self, message: str, loc: tuple):
+        super().__init__(message)
+        self.loc = loc
+
+
+@dataclass
+class _Frame:
+    array: bool
+    # 对象：最近读到的键；数组：数组所在的键
+    key: str | None = None
+    expect_key: bool = False
+    items: int = 0
+    item_limit: int | None = None
+    pending_item: bool = True
+
+
+class JsonBodyScanner:
+    """Incremental JSON scanner that enforces per-key string and array limits chunk by chunk.
+
+    String lengths are counted in characters, as Pydantic's ``max_length`` does:
+    UTF-8 continuation bytes are skipped and an escape sequence counts as one
+    character (a ``\\uXXXX`` surrogate pair as one). Keys are decoded, so
+    ``"d\\u0061ta"`` is limited like ``"data"``. Strings without a limit are
+    skipped without counting.
+    """
+
+    def __init__(
+        self,
+        string_limits: dict[str, int] | None = None,
+        array_limits: dict[str, int] | None = None,
+        max_depth: int = 32,
+    ):
+        self.string_limits = STRING_LIMITS if string_limits is None else string_limits
+        self.array_limits = ARRAY_LIMITS if array_limits is None else array_limits
+        self.max_depth = max_depth
+        self._stack: list[_Frame] = []
+        self._in_string = False
+        self._key: bytearray | None = None
+        self._limit: int | None = None
+        self._limit_key: str | None = None
+        self._length = 0
+        self._escape: bytearray | None = None
+
+    def feed(self, chunk: bytes) -> None:
+        """处理请求体的下一段字节。
+
+        Raises:
+            PayloadTooLarge: 某个字符串超过长度限制，或嵌套层数过深
+            TooManyItems: 某个数组超过元素个数限制
+        """
+        pos = 0
+        size = len(chunk)
+        while pos < size:
+            if self._in_string:
+                pos = self._scan_string(chunk, pos)
+                continue
+            match = _TOKEN_RE.search(chunk, pos)
+            if match is None:
+                return
+            pos = match.end()
+            char = chunk[match.start()]
+            if char == 0x22:  # "
+                self._start_string()
+            elif char in b"{[":
+                self._open(array=char == 0x5B)
+            elif char in b"}]":
+                if self._stack:
+                    self._stack.pop()
+            elif char == 0x2C:  # ,
+                if self._stack:
+                    top = self._stack[-1]
+                    if top.array:
+                        top.pending_item = True
+                    else:
+                        top.expect_key = True
+            elif char != 0x3A:  # 字面量；跨段的字面量只在第一段计数
+                self._value_started()
+
+    def _value_started(self) -> None:
+        if not self._stack:
+            return
+        top = self._stack[-1]
+        if not top.array or not top.pending_item:
+            return
+        top.pending_item = False
+        top.items += 1
+        if top.item_limit is not None and top.items > top.item_limit:
+            raise TooManyItems(f"{top.key} cannot exceed {top.item_limit} items", self._path())
+
+    def _path(self) -> tuple:
+        # 栈顶数组的位置：对象取当前键，数组取当前元素下标
+        return tuple(frame.items - 1 if frame.array else frame.key for frame in self._stack[:-1])
+
+    def _open(self, array: bool) -> None:
+        self._value_started()
+        if len(self._stack) >= self.max_depth:
+            raise PayloadTooLarge(f"JSON nesting exceeds {self.max_depth} levels")
+        parent = self._stack[-1] if self._stack else None
+        key = parent.key if parent is not None and not parent.array else None
+        self._stack.append(
+            _Frame(
+                array=array,
+                key=key if array else None,
+                expect_key=not array,
+                item_limit=self.array_limits.get(key) if array and key is not None else None,
+            )
+        )
+
+    def _start_string(self) -> None:
+        top = self._stack[-1] if self._stack else None
+        self._in_string = True
+        self._length = 0
+        if top is not None and not top.array and top.expect_key:
+            self._key = bytearray()
+            self._limit = None
+            return
+        self._value_started()
+        self._key = None
+        self._limit_key = top.key if top is not None and not top.array else None
+        self._limit = self.string_limits.get(self._limit_key) if self._limit_key is not None else None
+
+    def _scan_string(self, chunk: bytes, pos: int) -> int:
+        size = len(chunk)
+        while self._escape is not None and pos < size:
+            self._escape.append(chunk[pos])
+            pos += 1
+            if self._escape[0] != 0x75 or len(self._escape) == 5:  # 非 \u，或 \uXXXX 已完整
+                self._end_escape()
+        if self._escape is not None:
+            return pos
+
+        match = _STRING_STOP_RE.search(chunk, pos)
+        end = match.start() if match else size
+        if self._key is not None:
+            if len(self._key) <= _MAX_KEY_BYTES:
+                self._key += chunk[pos:end]
+        elif self._limit is not None:
+            self._count(len(chunk[pos:end].translate(None, _CONTINUATION_BYTES)))
+        if match is None:
+            return size
+        if chunk[end] == 0x22:
+            self._end_string()
+        else:
+            self._escape = bytearray()
+        return end + 1
+
+    def _end_escape(self) -> None:
+        escape = self._escape
+        self._escape = None
+        if self._key is not None:
+            self._key += b"\\" + escape
+        elif self._limit is not None:
+            # \uDC00-\uDFFF 是代理对的低位，与高位合计一个字符
+            low_surrogate = escape[0] == 0x75 and escape[1] in b"dD" and escape[2] in b"cdefCDEF"
+            self._count(0 if low_surrogate else 1)
+
+    def _count(self, chars: int) -> None:
+        self._length += chars
+        if self._length > self._limit:
+            raise PayloadTooLarge(f"{self._limit_key} exceeds {self._limit} characters")
+
+    def _end_string(self) -> None:
+        self._in_string = False
+        if self._key is None:
+            return
+        raw, self._key = bytes(self._key), None
+        key = None
+        if len(raw) <= _MAX_KEY_BYTES:
+            try:
+                key = json.loads(b'"' + raw + b'"')
+            except ValueError:
+                key = None
+        top = self._stack[-1]
+        top.key = key
+        top.expect_key = False
+
+
+class RequestGuardMiddleware:
+    """ASGI middleware enforcing the request body cap and the streaming JSON limits.
+
+    Requests whose Content-Length is over the cap are answered with 413 without
+    reading the body. Otherwise the body is counted (and JSON bodies scanned) as
+    FastAPI reads it; crossing a limit raises an ``HTTPException`` from
+    ``receive``, before the rest of the body is read or parsed: 413 for the
+    body cap and string lengths, 422 for array sizes.
+
+    Configuration (env):
+        REQUEST_MAX_BYTES: maximum request body size in bytes (default: five full-size Base64 images + 8 MiB)
+    """
+
+    def __init__(self, app, max_bytes: int | None = None):
+        if max_bytes is None:
+            max_bytes = int(os.getenv("REQUEST_MAX_BYTES", str(DEFAULT_MAX_BYTES)))
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": f"Request body exceeds {self.max_bytes} bytes"})
+            await response(scope, receive, send)
+            return
+
+        content_type = headers.get(b"content-type", b"").split(b";")[0].strip().lower()
+        is_json = content_type == b"application/json" or content_type.endswith(b"+json")
+        scanner = JsonBodyScanner() if is_json else None
+        received = 0
+
+        async def guarded_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Request body exceeds {self.max_bytes} bytes")
+                if scanner is not None:
+                    try:
+                        scanner.feed(body)
+                    except PayloadTooLarge as exc:
+                        raise HTTPException(status_code=413, detail=str(exc)) from None
+                    except TooManyItems as exc:
+                        # FastAPI 把读取请求体时的其他异常转为 400，这里直接给出 422 响应
+                        error = {"type": "too_long", "loc": ["body", *exc.loc], "msg": str(exc)}
+                        raise HTTPException(status_code=422, detail=[error]) from None
+            return message
+
+        await self.app(scope, guarded_receive, send)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+from collections.abc import AsyncGenerator, AsyncIterator
+from functools import lru_cache
+
+try:  # Optional speedup: poetry install --extras speedups
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+# 可合并的增量事件类型：连续的同类 delta 会被拼接后再发送
+COALESCED_EVENT_TYPES = frozenset({"content", "reasoning"})
+
+
+class EventEncoder:
+    """Serializes stream events to NDJSON and coalesces small token deltas.
+
+    Configuration (env):
+        STREAM_ENSURE_ASCII: escape non-ASCII characters (default false, UTF-8 output)
+        STREAM_JSON_BACKEND: auto | json | orjson (default auto, orjson when installed)
+        STREAM_COALESCE_MS: max time a delta may wait before being flushed (default 30, 0 disables)
+        STREAM_COALESCE_BYTES: flush once buffered deltas reach this many UTF-8 bytes (default 2048)
+    """
+
+    def __init__(
+        self,
+        ensure_ascii: bool | None = None,
+        backend: str | None = None,
+        coalesce_ms: float | None = None,
+        coalesce_bytes: int | None = None,
+    ):
+        if ensure_ascii is None:
+            ensure_ascii = os.getenv("STREAM_ENSURE_ASCII", "false").lower() in ("1", "true", "yes")
+        self.ensure_ascii = ensure_ascii
+
+        backend = (backend or os.getenv("STREAM_JSON_BACKEND", "auto")).lower()
+        if backend not in ("auto", "json", "orjson"):
+            raise ValueError(f"Unsupported STREAM_JSON_BACKEND: {backend}")
+        if backend == "orjson" and orjson is None:
+            raise ValueError("STREAM_JSON_BACKEND=orjson but orjson is not installed")
+        # orjson 总是输出 UTF-8，需要 ASCII 转义时退回标准库
+        self.use_orjson = orjson is not None and backend != "json" and not ensure_ascii
+
+        if coalesce_ms is None:
+            coalesce_ms = float(os.getenv("STREAM_COALESCE_MS", "30"))
+        if coalesce_bytes is None:
+            coalesce_bytes = int(os.getenv("STREAM_COALESCE_BYTES", "2048"))
+        self.coalesce_interval = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+
+    def encode(self, event: dict) -> str:
+        if self.use_orjson:
+            return orjson.dumps(event).decode("utf-8") + "\n"
+        return json.dumps(event, ensure_ascii=self.ensure_ascii, separators=(",", ":")) + "\n"
+
+    async def encode_stream(self, events: AsyncIterator[dict], coalesce: bool = True) -> AsyncGenerator[str, None]:
+        """把事件流编码为 NDJSON，并按时间/大小合并连续的 content/reasoning 增量。
+
+        Args:
+            coalesce: 事件已在上游合并过时传 False，只做编码
+        """
+        async for event in self.coalesce(events) if coalesce else events:
+            yield self.encode(event)
+
+    async def coalesce(self, events: AsyncIterator[dict]) -> AsyncGenerator[dict, None]:
+        """合并连续同类型的增量事件。
+
+        缓冲区在以下任一条件满足时输出：距第一个缓冲增量超过 coalesce_interval、
+        缓冲字节数达到 coalesce_bytes、事件类型变化或遇到其他类型的事件。
+        """
+        if self.coalesce_interval <= 0:
+            async for event in events:
+                yield event
+            return
+
+        loop = asyncio.get_running_loop()
+        iterator = aiter(events)
+        buffered: list[dict] = []
+        buffered_bytes = 0
+        deadline = 0.0
+        next_event: asyncio.Future | None = None
+
+        def flush() -> dict:
+            nonlocal buffered, buffered_bytes
+            merged = {**buffered[-1], "content": "".join(e["content"] for e in buffered)}
+            buffered = []
+            buffered_bytes = 0
+            return merged
+
+        try:
+            while True:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(anext(iterator))
+                timeout = max(0.0, deadline - loop.time()) if buffered else None
+                done, _ = await asyncio.wait({next_event}, timeout=timeout)
+                if not done:
+                    # 等待下一个事件超时，先把已缓冲的增量发出去
+                    yield flush()
+                    continue
+
+                try:
+                    event = next_event.result()
+                except StopAsyncIteration:
+                    next_event = None
+                    break
+                next_event = None
+
+                if event.get("type") not in COALESCED_EVENT_TYPES:
+                    if buffered:
+                        yield flush()
+                    yield event
+                    continue
+
+                if buffered and buffered[-1]["type"] != event["type"]:
+                    yield flush()
+                if not buffered:
+                    deadline = loop.time() + self.coalesce_interval
+                buffered.append(event)
+                buffered_bytes += len(event["content"].encode("utf-8"))
+                if buffered_bytes >= self.coalesce_bytes:
+                    yield flush()
+
+            if buffered:
+                yield flush()
+        finally:
+            # 提前结束（如客户端断开）时，确保上游事件流也被关闭
+            if next_event is not None and not next_event.done():
+                next_event.cancel()
+                await asyncio.wait({next_event})
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+
+@lru_cache
+def get_event_encoder() -> EventEncoder:
+    """Process-wide encoder configured from the environment."""
+    return EventEncoder()
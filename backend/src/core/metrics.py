@@ -0,0 +1,253 @@
+import abc
+import bisect
+import math
+import os
+import threading
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Sequence
+from functools import lru_cache
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    @abc.abstractmethod
+    def _samples(self) -> list[str]:
+        """该指标的样本行（不含 HELP / TYPE）。"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Gauge whose value is read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name} {_format_value(self.read())}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str], buckets: Sequence[float]):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：各桶计数（非累计）+ 溢出桶, sum, count
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, totals = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return int(entry[1][1]) if entry else 0
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), list(totals))) for key, (counts, totals) in self._values.items())
+        lines = []
+        for key, (counts, (total, count)) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts, strict=True):
+                cumulative += bucket_count
+                le = _format_labels(self.label_names, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {_format_value(count)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Minimal in-process Prometheus registry (text exposition format 0.0.4)."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str], buckets: Sequence[float]) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        """注册回调型 gauge；同名 gauge 再次注册时替换回调（单例重建后指向新对象）。"""
+        self._metrics.pop(name, None)
+        return self._register(Gauge(name, documentation, read))
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+_LLM_LABELS = ("mode", "model", "kind")
+
+
+class LLMMetrics:
+    """Latency, throughput, token and error metrics for upstream LLM calls.
+
+    Every upstream attempt (including retries, hedged requests and fallback
+    models) is observed separately, labeled by mode (generate / chat /
+    chat_patch), model and kind (text / multimodal). Values are per worker
+    process; with several uvicorn workers scrape each of them.
+
+    Configuration (env):
+        METRICS_ENABLED: expose /metrics and record LLM metrics (default true)
+    """
+
+    def __init__(self, registry: MetricsRegistry | None = None):
+        self.registry = registry or MetricsRegistry()
+        registry = self.registry
+        self.requests = registry.counter(
+            "llm_requests_total", "Upstream LLM calls by outcome.", (*_LLM_LABELS, "outcome")
+        )
+        self.errors = registry.counter("llm_errors_total", "Upstream LLM errors by error code.", (*_LLM_LABELS, "code"))
+        self.tokens = registry.counter("llm_tokens_total", "Tokens reported by the upstream.", (*_LLM_LABELS, "type"))
+        self.chars = registry.counter(
+            "llm_output_chars_total", "Streamed characters by channel (reasoning / content).", (*_LLM_LABELS, "channel")
+        )
+        self.time_to_first_token = registry.histogram(
+            "llm_time_to_first_token_seconds",
+            "Time from the upstream call to its first reasoning or content delta.",
+            _LLM_LABELS,
+            (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+        )
+        self.duration = registry.histogram(
+            "llm_generation_duration_seconds",
+            "Duration of completed upstream calls.",
+            _LLM_LABELS,
+            (1, 2, 5, 10, 20, 40, 60, 120, 240, 480),
+        )
+        self.tokens_per_second = registry.histogram(
+            "llm_output_tokens_per_second",
+            "Output tokens per second after the first token.",
+            _LLM_LABELS,
+            (5, 10, 20, 30, 40, 60, 80, 120, 200),
+        )
+
+    async def observe(
+        self,
+        events: AsyncIterator[dict],
+        mode: str,
+        model: str,
+        kind: str,
+    ) -> AsyncGenerator[dict, None]:
+        """透传一次上游调用的事件，同时记录首 token 延迟、时长、token 数和错误。"""
+        labels = {"mode": mode, "model": model, "kind": kind}
+        started = time.perf_counter()
+        first_token: float | None = None
+        outcome = "cancelled"
+        try:
+            async for event in events:
+                event_type = event.get("type")
+                if event_type in ("content", "reasoning"):
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        self.time_to_first_token.observe(first_token - started, **labels)
+                    self.chars.inc(len(event.get("content", "")), channel=event_type, **labels)
+                elif event_type == "usage":
+                    self._observe_usage(event, started, first_token, labels)
+                elif event_type == "error":
+                    outcome = "error"
+                    self.errors.inc(code=event.get("code") or "unknown", **labels)
+                yield event
+            if outcome != "error":
+                outcome = "success"
+                self.duration.observe(time.perf_counter() - started, **labels)
+        finally:
+            # 提前关闭（对冲落败、客户端断开）记为 cancelled
+            self.requests.inc(outcome=outcome, **labels)
+            if hasattr(events, "aclose"):
+                await events.aclose()
+
+    def _observe_usage(self, event: dict, started: float, first_token: float | None, labels: dict) -> None:
+        input_tokens = event.get("input_tokens") or 0
+        output_tokens = event.get("output_tokens") or 0
+        self.tokens.inc(input_tokens, type="input", **labels)
+        self.tokens.inc(output_tokens, type="output", **labels)
+        if event.get("cached_input_tokens"):
+            # 命中上游前缀缓存的输入 token（包含在 input 中）
+            self.tokens.inc(event["cached_input_tokens"], type="cached_input", **labels)
+        elapsed = time.perf_counter() - (first_token or started)
+        if output_tokens and elapsed > 0:
+            self.tokens_per_second.observe(output_tokens / elapsed, **labels)
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+@lru_cache
+def get_llm_metrics() -> LLMMetrics | None:
+    """Process-wide LLM metrics; None when METRICS_ENABLED is off."""
+    if os.getenv("METRICS_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return LLMMetrics()
@@ -0,0 +1,245 @@
+"""Section index and BM25 relevance scoring for pruning the PRD sent in chat turns.
+
+A chat message usually targets one or two sections ("修改用户故事 3 的验收标准").
+In patch mode the model only has to see those sections in full; the rest of the
+document is sent as an outline of headings so it can still place new sections
+and reference existing ones. The merge runs against the full PRD server-side,
+so omitted sections are never lost.
+"""
+
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+
+from src.core.prd_patch import normalize_heading, parse_sections, strip_guide_trailer
+
+# 小写英文单词 / 数字 / 连续汉字
+_TOKEN_RE = re.compile(r"[a-z]+|\d+|[一-鿿]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """英文按单词、数字去掉前导零（US-003 与 story 3 匹配），汉字按二元组切分。"""
+    tokens: list[str] = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if run.isdigit():
+            tokens.append(str(int(run)))
+        elif run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+@dataclass
+class _Chunk:
+    """A heading and its own body, up to the next heading of any level."""
+
+    start: int
+    end: int
+    # 含子章节的结束位置，即 REPLACE / DELETE 作用的范围
+    subtree_end: int
+    terms: Counter
+    length: int
+
+
+@dataclass
+class _DocumentIndex:
+    lines: list[str]
+    preamble_end: int
+    chunks: list[_Chunk]
+    document_frequency: Counter
+    average_length: float
+
+
+@dataclass
+class PrunedPrd:
+    text: str
+    selected: list[str]
+    original_chars: int
+    # 规范化的章节标题：模型没有看到其完整内容（含子章节），不能整体替换或删除
+    protected: frozenset[str] = frozenset()
+
+
+class PrdIndex:
+    """Heading index over PRD documents with BM25 scoring of sections against a chat message.
+
+    Indexes are cached per document hash, and tokenized sections per section
+    hash, so the next revision of a PRD only re-tokenizes the sections that
+    changed. Each section is scored on its heading path plus its own body, so
+    "用户故事 3 的验收标准" matches the 验收标准 subsection under 用户故事 3.
+
+    Configuration (env):
+        PRD_PRUNE_MIN_CHARS: documents shorter than this are always sent in full (default 6000)
+        PRD_PRUNE_TOP_K: sections sent in full per chat turn (default 4)
+    """
+
+    def __init__(
+        self,
+        min_chars: int | None = None,
+        top_k: int | None = None,
+        min_score: float = 2.0,
+        max_documents: int = 64,
+        max_sections: int = 4096,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        if min_chars is None:
+            min_chars = int(os.getenv("PRD_PRUNE_MIN_CHARS", "6000"))
+        if top_k is None:
+            top_k = int(os.getenv("PRD_PRUNE_TOP_K", "4"))
+        self.min_chars = min_chars
+        self.top_k = max(1, top_k)
+        self.min_score = min_score
+        self.max_documents = max_documents
+        self.max_sections = max_sections
+        self.k1 = k1
+        self.b = b
+        self._documents: OrderedDict[str, _DocumentIndex] = OrderedDict()
+        self._section_terms: OrderedDict[str, Counter] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self, document: str) -> _DocumentIndex:
+        key = hashlib.sha256(document.encode("utf-8")).hexdigest()
+        with self._lock:
+            cached = self._documents.get(key)
+            if cached is not None:
+                self._documents.move_to_end(key)
+                return cached
+            built = self._build(document)
+            self._documents[key] = built
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+            return built
+
+    def _build(self, document: str) -> _DocumentIndex:
+        lines = document.split("\n")
+        sections = parse_sections(lines)
+        chunks: list[_Chunk] = []
+        path: list[tuple[int, str]] = []
+        for position, section in enumerate(sections):
+            while path and path[-1][0] >= section.level:
+                path.pop()
+            path.append((section.level, section.title))
+            end = sections[position + 1].start if position + 1 < len(sections) else len(lines)
+            text = "\n".join([*(title for _, title in path), *lines[section.start + 1 : end]])
+            terms = self._terms(text)
+            chunks.append(
+                _Chunk(
+                    start=section.start,
+                    end=end,
+                    subtree_end=section.end,
+                    terms=terms,
+                    length=sum(terms.values()),
+                )
+            )
+
+        document_frequency: Counter = Counter()
+        for chunk in chunks:
+            document_frequency.update(chunk.terms.keys())
+        average_length = sum(chunk.length for chunk in chunks) / len(chunks) if chunks else 0.0
+        return _DocumentIndex(
+            lines=lines,
+            preamble_end=sections[0].start if sections else len(lines),
+            chunks=chunks,
+            document_frequency=document_frequency,
+            average_length=average_length,
+        )
+
+    def _terms(self, text: str) -> Counter:
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        terms = self._section_terms.get(key)
+        if terms is None:
+            terms = Counter(tokenize(text))
+            self._section_terms[key] = terms
+            while len(self._section_terms) > self.max_sections:
+                self._section_terms.popitem(last=False)
+        else:
+            self._section_terms.move_to_end(key)
+        return terms
+
+    def scores(self, document: str, query: str) -> list[float]:
+        """每个章节（按文档顺序）对 query 的 BM25 得分。"""
+        index = self.index(document)
+        total = len(index.chunks)
+        result = []
+        query_terms = set(tokenize(query))
+        for chunk in index.chunks:
+            score = 0.0
+            for term in query_terms:
+                frequency = chunk.terms.get(term)
+                if not frequency:
+                    continue
+                df = index.document_frequency[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                norm = 1 - self.b + self.b * chunk.length / (index.average_length or 1)
+                score += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+            result.append(score)
+        return result
+
+    def prune(self, document: str, query: str) -> PrunedPrd | None:
+        """保留与 query 最相关的章节全文，其余章节只保留标题行。
+
+        Returns:
+            裁剪结果；文档较短、没有明显相关的章节或裁剪收益不大时返回 None（应发送全文）
+        """
+        document = strip_guide_trailer(document)
+        if len(document) < self.min_chars:
+            return None
+        index = self.index(document)
+        scores = self.scores(document, query)
+        if not scores or max(scores) < self.min_score:
+            return None
+        best = max(scores)
+        ranked = sorted(range(len(scores)), key=lambda position: scores[position], reverse=True)
+        # 只保留与最高分同一量级的章节，避免把泛泛匹配的章节也带上
+        selected = {position for position in ranked[: self.top_k] if scores[position] >= best / 2}
+
+        lines = index.lines
+        output = lines[: index.preamble_end]
+        for position, chunk in enumerate(index.chunks):
+            if position in selected:
+                output.extend(lines[chunk.start : chunk.end])
+            else:
+                output.append(lines[chunk.start])
+        text = "\n".join(output)
+        if len(text) > len(document) * 0.8:
+            return None
+        titles = [lines[index.chunks[position].start].strip() for position in sorted(selected)]
+        return PrunedPrd(
+            text=text,
+            selected=titles,
+            original_chars=len(document),
+            protected=self._protected(index, selected),
+        )
+
+    @staticmethod
+    def _protected(index: _DocumentIndex, selected: set[int]) -> frozenset[str]:
+        # 补丁按标题匹配第一个同名章节，因此按每个标题第一次出现的章节判断
+        protected: set[str] = set()
+        seen: set[str] = set()
+        for position, chunk in enumerate(index.chunks):
+            title = normalize_heading(index.lines[chunk.start])
+            if title in seen:
+                continue
+            seen.add(title)
+            subtree = range(position, len(index.chunks))
+            for inner in subtree:
+                if index.chunks[inner].start >= chunk.subtree_end:
+                    break
+                if inner not in selected:
+                    protected.add(title)
+                    break
+        return frozenset(protected)
+
+
+@lru_cache
+def get_prd_index() -> PrdIndex | None:
+    """Shared PRD index for chat patch mode; None when CHAT_CONTEXT_PRUNING is off."""
+    if os.getenv("CHAT_CONTEXT_PRUNING", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return PrdIndex()
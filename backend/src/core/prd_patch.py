@@ -0,0 +1,275 @@
+"""Section-scoped PRD edits for chat patch mode.
+
+The model answers with edit blocks instead of re-emitting the whole document::
+
+    <<<REPLACE ## 2. 成功标准
+    ## 2. 成功标准
+    - SC-001: ...
+    >>>
+    <<<INSERT_AFTER ## 5.1 登录
+    ### 5.2 找回密码
+    ...
+    >>>
+    <<<DELETE ### 场景 3: 超时
+    >>>
+
+Text outside blocks (the follow-up questions) is kept as a note. The blocks are
+applied server-side to the current PRD, so a one-line change costs a few output
+tokens instead of a full rewrite.
+"""
+
+import re
+from collections.abc import AsyncGenerator, AsyncIterator, Collection
+from dataclasses import dataclass
+
+PATCH_OPS = ("REPLACE", "INSERT_AFTER", "INSERT_BEFORE", "DELETE", "APPEND")
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_BLOCK_START_RE = re.compile(r"^<<<\s*(" + "|".join(PATCH_OPS) + r")\b\s*(.*)$")
+_BLOCK_END = ">>>"
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_BARE_FENCE_RE = re.compile(r"^\s*(```|~~~)[\w-]*\s*$")
+
+# 对话模式输出末尾的引导问题，不属于 PRD 正文
+GUIDE_HEADING = "### 💡 接下来可以考虑"
+
+
+@dataclass
+class Section:
+    """A heading and everything below it up to the next heading of the same or higher level."""
+
+    level: int
+    title: str
+    start: int  # first line index (the heading line)
+    end: int  # exclusive line index, including nested subsections
+
+
+@dataclass
+class PatchOp:
+    op: str
+    target: str
+    content: str = ""
+    applied: bool = False
+    # 未应用的原因，如 not_in_context：目标章节未完整提供给模型
+    reason: str | None = None
+
+    def to_event(self) -> dict:
+        event = {
+            "type": "patch",
+            "op": self.op.lower(),
+            "target": self.target,
+            "content": self.content,
+            "applied": self.applied,
+        }
+        if self.reason:
+            event["reason"] = self.reason
+        return event
+
+
+def normalize_heading(text: str) -> str:
+    """Heading text without markers, emphasis or extra whitespace, for matching."""
+    match = _HEADING_RE.match(text.strip())
+    if match:
+        text = match.group(2)
+    text = text.replace("*", "").replace("`", "")
+    return " ".join(text.split()).lower()
+
+
+def parse_sections(lines: list[str]) -> list[Section]:
+    """Index ATX headings (ignoring fenced code blocks) into nested sections."""
+    headings: list[tuple[int, int, str]] = []
+    in_fence = False
+    for index, line in enumerate(lines):
+        if _FENCE_RE.match(line):
+            in_fence = not in_fence
+            continue
+        if in_fence:
+            continue
+        match = _HEADING_RE.match(line)
+        if match:
+            headings.append((index, len(match.group(1)), match.group(2)))
+
+    sections: list[Section] = []
+    for position, (start, level, title) in enumerate(headings):
+        end = len(lines)
+        for next_start, next_level, _ in headings[position + 1 :]:
+            if next_level <= level:
+                end = next_start
+                break
+        sections.append(Section(level=level, title=title, start=start, end=end))
+    return sections
+
+
+def strip_guide_trailer(document: str) -> str:
+    """去掉上一轮输出末尾的引导问题（`---` 分隔线之后的 💡 段落）。"""
+    index = document.rfind(GUIDE_HEADING)
+    if index == -1:
+        return document
+    head = document[:index].rstrip()
+    if head.endswith("---"):
+        head = head[:-3].rstrip()
+    return head + "\n"
+
+
+def _find_section(sections: list[Section], target: str) -> Section | None:
+    wanted = normalize_heading(target)
+    for section in sections:
+        if normalize_heading(section.title) == wanted:
+            return section
+    return None
+
+
+def apply_patch(document: str, op: PatchOp) -> str:
+    """Apply one edit block to the document; sets ``op.applied``."""
+    lines = document.split("\n")
+    body = op.content.strip("\n").split("\n") if op.content.strip() else []
+
+    if op.op == "APPEND":
+        while lines and not lines[-1].strip():
+            lines.pop()
+        op.applied = True
+        return "\n".join([*lines, "", *body, ""])
+
+    section = _find_section(parse_sections(lines), op.target)
+    if section is None:
+        op.applied = False
+        return document
+
+    if op.op == "REPLACE":
+        if not body or not _HEADING_RE.match(body[0]):
+            # 替换内容缺少标题行时保留原标题
+            body = [lines[section.start], *body]
+        lines[section.start : section.end] = [*body, ""]
+    elif op.op == "DELETE":
+        del lines[section.start : section.end]
+    elif op.op == "INSERT_AFTER":
+        lines[section.end : section.end] = [*body, ""]
+    elif op.op == "INSERT_BEFORE":
+        lines[section.start : section.start] = [*body, ""]
+    op.applied = True
+    return "\n".join(lines)
+
+
+class PatchStreamParser:
+    """Incrementally splits streamed model output into edit blocks and note text."""
+
+    def __init__(self):
+        self._pending = ""
+        self._block: PatchOp | None = None
+        self._block_lines: list[str] = []
+        self.note_lines: list[str] = []
+
+    def feed(self, text: str) -> list[PatchOp]:
+        self._pending += text
+        completed: list[PatchOp] = []
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            op = self._consume_line(line)
+            if op is not None:
+                completed.append(op)
+        return completed
+
+    def close(self) -> list[PatchOp]:
+        completed: list[PatchOp] = []
+        if self._pending:
+            op = self._consume_line(self._pending)
+            self._pending = ""
+            if op is not None:
+                completed.append(op)
+        if self._block is not None:
+            # 模型漏写结束标记时，仍然应用已收到的内容
+            completed.append(self._finish_block())
+        return completed
+
+    @property
+    def note(self) -> str:
+        # 模型有时会把整段输出包在代码块里，去掉孤立的围栏行
+        lines = [line for line in self.note_lines if not _BARE_FENCE_RE.match(line)]
+        return "\n".join(lines).strip()
+
+    def _consume_line(self, line: str) -> PatchOp | None:
+        if self._block is None:
+            match = _BLOCK_START_RE.match(line.strip())
+            if match:
+                self._block = PatchOp(op=match.group(1), target=match.group(2).strip())
+                self._block_lines = []
+            else:
+                self.note_lines.append(line)
+            return None
+        if line.strip() == _BLOCK_END:
+            return self._finish_block()
+        self._block_lines.append(line)
+        return None
+
+    def _finish_block(self) -> PatchOp:
+        op = self._block
+        op.content = "\n".join(self._block_lines)
+        self._block = None
+        self._block_lines = []
+        return op
+
+
+def _apply_guarded(document: str, op: PatchOp, protected: Collection[str]) -> str:
+    if op.op in ("REPLACE", "DELETE") and normalize_heading(op.target) in protected:
+        # 模型只看到了标题行：整体替换或删除会丢掉它没看到的正文和子章节
+        op.applied = False
+        op.reason = "not_in_context"
+        return document
+    return apply_patch(document, op)
+
+
+async def apply_patch_events(
+    events: AsyncIterator[dict],
+    current_prd: str,
+    allow_full_document: bool = True,
+    protected: Collection[str] = (),
+) -> AsyncGenerator[dict, None]:
+    """把模型的补丁输出转换为 patch 事件，并在结束时输出合并后的完整 PRD（content 事件）。
+
+    模型没有按补丁格式输出、而是给出了完整文档时，直接把该文档作为结果。
+    模型看到的是裁剪后的 PRD（allow_full_document=False）时，这样的输出缺少被省略的章节，
+    改为返回错误；针对 protected 中章节（模型未看到完整内容）的 REPLACE / DELETE
+    不应用，patch 事件中 applied=false、reason=not_in_context。
+    """
+    parser = PatchStreamParser()
+    document = strip_guide_trailer(current_prd)
+    patched = 0
+    failed = False
+    usage_event: dict | None = None
+
+    async for event in events:
+        event_type = event.get("type")
+        if event_type == "content":
+            for op in parser.feed(event["content"]):
+                document = _apply_guarded(document, op, protected)
+                patched += 1
+                yield op.to_event()
+        elif event_type == "usage":
+            # usage 放到合并结果之后发送
+            usage_event = event
+        else:
+            if event_type == "error":
+                failed = True
+            yield event
+    for op in parser.close():
+        document = _apply_guarded(document, op, protected)
+        patched += 1
+        yield op.to_event()
+
+    if not failed:
+        note = parser.note
+        if patched == 0 and note.lstrip().startswith("#"):
+            if not allow_full_document:
+                yield {"type": "error", "message": "Model rewrote the document instead of patching it, please retry"}
+                if usage_event is not None:
+                    yield usage_event
+                return
+            merged = note
+        else:
+            merged = document.rstrip("\n")
+            if note:
+                merged = f"{merged}\n\n---\n\n{note}"
+        yield {"type": "content", "content": merged}
+
+    if usage_event is not None:
+        yield usage_event
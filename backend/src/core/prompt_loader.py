@@ -1,10 +1,25 @@
+import hashlib
+import logging
 import os
+import threading
+import time
 from functools import lru_cache
 from pathlib import Path
 
+from src.core.tracing import span
+
+logger = logging.getLogger("uvicorn.error")
+
 
 class PromptLoader:
-    def __init__(self, file_path: str = None):
+    """Loads a prompt file and keeps the decoded text in memory.
+
+    The cached text is revalidated against the file's inode/mtime/size at most
+    once per ``reload_interval`` seconds, so prompts can be edited live without
+    a stat + read on every request.
+    """
+
+    def __init__(self, file_path: str = None, reload_interval: float | None = None):
         self.file_path = file_path or os.getenv("PROMPT_FILE_PATH")
         if not self.file_path:
             # Fallback for local dev if env not set
@@ -12,13 +27,53 @@ class PromptLoader:
             self.file_path = repo_root / "prompts" / "prompt.md"
 
         self.file_path = Path(self.file_path)
+        if reload_interval is None:
+            reload_interval = float(os.getenv("PROMPT_RELOAD_INTERVAL", "2"))
+        self.reload_interval = reload_interval
+
+        self._lock = threading.Lock()
+        self._text: str | None = None
+        self._version: str | None = None
+        self._stat_key: tuple[int, int, int] | None = None
+        self._checked_at = 0.0
 
     def load_prompt(self) -> str:
-        if not self.file_path.exists():
-            raise FileNotFoundError(f"Prompt file not found at: {self.file_path}")
+        with span("prompt.load", prompt=self.file_path.name) as load_span:
+            if self._text is None or time.monotonic() - self._checked_at >= self.reload_interval:
+                with self._lock:
+                    self._revalidate()
+                if load_span is not None:
+                    load_span.set(revalidated=True)
+        return self._text
+
+    @property
+    def version(self) -> str:
+        """Short content hash of the currently cached prompt."""
+        self.load_prompt()
+        return self._version
 
-        with open(self.file_path, encoding="utf-8") as f:
-            return f.read()
+    def _revalidate(self) -> None:
+        try:
+            stat = self.file_path.stat()
+        except FileNotFoundError:
+            if self._text is None:
+                raise FileNotFoundError(f"Prompt file not found at: {self.file_path}") from None
+            # 编辑器替换文件期间可能短暂缺失，继续使用上一个版本
+            logger.warning("Prompt file missing, keeping cached version %s: %s", self._version, self.file_path)
+            self._checked_at = time.monotonic()
+            return
+
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat_key != self._stat_key:
+            with open(self.file_path, encoding="utf-8") as f:
+                text = f.read()
+            version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+            if self._version is not None and version != self._version:
+                logger.info("Prompt reloaded: %s version %s -> %s", self.file_path.name, self._version, version)
+            self._text = text
+            self._version = version
+            self._stat_key = stat_key
+        self._checked_at = time.monotonic()
 
 
 @lru_cache
@@ -35,3 +90,13 @@ def get_chat_prompt_loader() -> PromptLoader:
         repo_root = Path(__file__).resolve().parents[3]
         chat_path = repo_root / "prompts" / "prompt-chat.md"
     return PromptLoader(str(chat_path))
+
+
+@lru_cache
+def get_chat_patch_prompt_loader() -> PromptLoader:
+    """Loader for chat patch mode (section-scoped edits merged server-side)."""
+    patch_path = os.getenv("PROMPT_CHAT_PATCH_FILE_PATH")
+    if not patch_path:
+        repo_root = Path(__file__).resolve().parents[3]
+        patch_path = repo_root / "prompts" / "prompt-chat-patch.md"
+    return PromptLoader(str(patch_path))
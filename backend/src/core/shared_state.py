@@ -0,0 +1,229 @@
+"""Key-value state shared by all uvicorn worker processes.
+
+Caches, sessions and per-client limits kept in process memory are duplicated
+per worker: each worker has its own hit rate and a client can run
+``workers × limit`` generations. The backends here give them one shared view:
+
+- ``memory``: in-process dict, the single-worker default
+- ``sqlite``: one SQLite file in WAL mode, shared by the workers of one host
+- ``redis``: any Redis-protocol server (Redis, Valkey, KeyDB, a local stand-in),
+  shared across hosts; needs ``poetry install --extras shared``
+
+Values are strings (callers store JSON); every key can carry a TTL.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Protocol
+
+try:  # Optional: poetry install --extras shared
+    import redis
+except ImportError:  # pragma: no cover - depends on the environment
+    redis = None
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class SharedState(Protocol):
+    def get(self, key: str) -> str | None: ...
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None: ...
+
+    def delete(self, key: str) -> bool: ...
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        """原子地加上 amount 并返回新值；给出 ttl 时刷新过期时间。"""
+        ...
+
+
+class MemorySharedState:
+    """In-process state; only shared between the tasks and threads of one worker."""
+
+    def __init__(self):
+        self._entries: dict[str, tuple[str, float | None]] = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl is not None else None)
+            self._purge_expired()
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        now = time.time()
+        with self._lock:
+            value, expires_at = self._entries.get(key, ("0", None))
+            if expires_at is not None and expires_at <= now:
+                value, expires_at = "0", None
+            result = int(value) + amount
+            self._entries[key] = (str(result), now + ttl if ttl is not None else expires_at)
+            self._purge_expired()
+        return result
+
+    def _purge_expired(self) -> None:
+        # 每 1024 次写入清理一次过期键，避免只写不读的键（如已结束客户端的计数）一直占用内存
+        self._writes += 1
+        if self._writes % 1024:
+            return
+        now = time.time()
+        for key in [
+            key for key, (_, expires_at) in self._entries.items() if expires_at is not None and expires_at <= now
+        ]:
+            del self._entries[key]
+
+
+class SQLiteSharedState:
+    """State in one SQLite file (WAL mode) shared by all workers on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        # WAL：读不阻塞写，多个进程并发访问同一文件
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            self._purge_expired()
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            # 单条 UPSERT 语句在 SQLite 写锁内执行，跨进程也是原子的；已过期的旧值按 0 计
+            row = self._conn.execute(
+                "INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "value = CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN ? "
+                "ELSE CAST(value AS INTEGER) + ? END, "
+                "expires_at = COALESCE(?, CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN NULL "
+                "ELSE expires_at END) "
+                "RETURNING value",
+                (key, str(amount), expires_at, now, amount, amount, expires_at, now),
+            ).fetchone()
+            self._purge_expired()
+        return int(row[0])
+
+    def _purge_expired(self) -> None:
+        self._writes += 1
+        if self._writes % 1024 == 0:
+            self._conn.execute(
+                "DELETE FROM shared_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisSharedState:
+    """State in a Redis-protocol server, shared across workers and hosts."""
+
+    def __init__(self, url: str | None = None, client=None):
+        if client is None:
+            if redis is None:
+                raise ValueError("SHARED_STATE=redis but the redis package is not installed")
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+
+    def get(self, key: str) -> str | None:
+        value = self.client.get(key)
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        self.client.set(key, value, px=int(ttl * 1000) if ttl is not None else None)
+
+    def delete(self, key: str) -> bool:
+        return bool(self.client.delete(key))
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        if ttl is None:
+            return int(self.client.incrby(key, amount))
+        pipeline = self.client.pipeline()
+        pipeline.incrby(key, amount)
+        pipeline.pexpire(key, int(ttl * 1000))
+        result, _ = pipeline.execute()
+        return int(result)
+
+
+class PrefixedState:
+    """Namespaces the keys of a shared state (several deployments on one Redis)."""
+
+    def __init__(self, state: SharedState, prefix: str):
+        self.state = state
+        self.prefix = prefix
+
+    def get(self, key: str) -> str | None:
+        return self.state.get(self.prefix + key)
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        self.state.set(self.prefix + key, value, ttl)
+
+    def delete(self, key: str) -> bool:
+        return self.state.delete(self.prefix + key)
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        return self.state.incr(self.prefix + key, amount, ttl)
+
+
+@lru_cache
+def get_shared_state() -> SharedState:
+    """Process-wide shared state configured by SHARED_STATE=memory|sqlite|redis (default memory).
+
+    Configuration (env):
+        SHARED_STATE_PATH: SQLite file for the sqlite backend (default shared_state.sqlite3)
+        SHARED_STATE_URL: server URL for the redis backend (default redis://localhost:6379/0)
+        SHARED_STATE_PREFIX: key prefix (default spec_generator:)
+    """
+    backend_name = os.getenv("SHARED_STATE", "memory").lower()
+    if backend_name == "memory":
+        return MemorySharedState()
+    if backend_name == "sqlite":
+        state: SharedState = SQLiteSharedState(os.getenv("SHARED_STATE_PATH", "shared_state.sqlite3"))
+    elif backend_name == "redis":
+        state = RedisSharedState(os.getenv("SHARED_STATE_URL", "redis://localhost:6379/0"))
+    else:
+        raise ValueError(f"Unsupported SHARED_STATE backend: {backend_name}")
+    logger.info("Shared state enabled: backend=%s", backend_name)
+    return PrefixedState(state, os.getenv("SHARED_STATE_PREFIX", "spec_generator:"))
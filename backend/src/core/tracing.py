@@ -0,0 +1,367 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Iterator
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Protocol
+
+try:  # Optional: poetry install --extras tracing
+    from opentelemetry import trace as otel_trace
+except ImportError:  # pragma: no cover - depends on the environment
+    otel_trace = None
+
+logger = logging.getLogger("uvicorn.error")
+
+_current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def parse_traceparent(value: str | None) -> tuple[str, str, bool] | None:
+    """解析 W3C traceparent 请求头，返回 (trace_id, parent_span_id, sampled)。"""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Span:
+    """One timed stage of a request; attributes follow OpenTelemetry naming where one exists."""
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        trace_id: str,
+        parent: "Span | None" = None,
+        parent_id: str | None = None,
+        attributes: dict[str, Any] | None = None,
+    ):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent = parent
+        self.parent_id = parent.span_id if parent is not None else parent_id
+        self.attributes: dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.error: str | None = None
+        self.otel: Any = None
+        self._started = time.perf_counter()
+
+    @property
+    def duration_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def mark(self, name: str) -> None:
+        """记录某个时间点（相对 span 开始的毫秒数），只记第一次。"""
+        self.attributes.setdefault(f"{name}_ms", round(self.duration_ms, 3))
+
+    def end(self, error: str | None = None) -> None:
+        if self.end_ns is not None:
+            return
+        if error is not None:
+            self.error = error
+        self.end_ns = self.start_ns + int(self.duration_ms * 1_000_000)
+        self.tracer.exporter.on_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1_000_000, 3) if self.end_ns else None,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter(Protocol):
+    def on_start(self, span: Span) -> None: ...
+
+    def on_end(self, span: Span) -> None: ...
+
+
+class JsonLogExporter:
+    """Writes each finished span as one JSON log line (OTLP-like field names)."""
+
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        logger.info("trace %s", json.dumps(span.to_dict(), ensure_ascii=False, default=str))
+
+
+class OTelExporter:
+    """Mirrors spans into OpenTelemetry.
+
+    Uses the globally configured tracer provider; when none is configured and the
+    SDK is installed, sets up OTLP/HTTP export (OTEL_EXPORTER_OTLP_* env vars).
+    """
+
+    def __init__(self):
+        if otel_trace is None:
+            raise ValueError("TRACING_EXPORTER=otel but opentelemetry is not installed")
+        self._configure_provider()
+        self.tracer = otel_trace.get_tracer("spec_generator")
+
+    @staticmethod
+    def _configure_provider() -> None:
+        if not isinstance(otel_trace.get_tracer_provider(), otel_trace.ProxyTracerProvider):
+            return
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            logger.warning("opentelemetry SDK not installed, spans go to the no-op tracer provider")
+            return
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        otel_trace.set_tracer_provider(provider)
+
+    def on_start(self, span: Span) -> None:
+        context = None
+        if span.parent is not None and span.parent.otel is not None:
+            context = otel_trace.set_span_in_context(span.parent.otel)
+        elif span.parent_id:
+            # 上游（如前端或网关）通过 traceparent 传入的远端父 span
+            remote = otel_trace.SpanContext(
+                trace_id=int(span.trace_id, 16),
+                span_id=int(span.parent_id, 16),
+                is_remote=True,
+                trace_flags=otel_trace.TraceFlags(otel_trace.TraceFlags.SAMPLED),
+            )
+            context = otel_trace.set_span_in_context(otel_trace.NonRecordingSpan(remote))
+        span.otel = self.tracer.start_span(span.name, context=context, start_time=span.start_ns)
+        span_context = span.otel.get_span_context()
+        if span_context.is_valid:
+            span.trace_id = f"{span_context.trace_id:032x}"
+            span.span_id = f"{span_context.span_id:016x}"
+
+    def on_end(self, span: Span) -> None:
+        span.otel.set_attributes({key: value for key, value in span.attributes.items() if value is not None})
+        if span.error:
+            span.otel.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, span.error))
+        span.otel.end(end_time=span.end_ns)
+
+
+class Tracer:
+    """Per-request stage tracing with head sampling.
+
+    The sampling decision is made once per request (an incoming sampled
+    ``traceparent`` is always traced); unsampled requests create no spans, so the
+    instrumentation is close to free when tracing is off.
+
+    Configuration (env):
+        TRACING_SAMPLE_RATE: fraction of requests traced, 0..1 (default 0, off)
+        TRACING_EXPORTER: log | otel (default log: one JSON line per span in the server log)
+    """
+
+    def __init__(self, sample_rate: float | None = None, exporter: SpanExporter | None = None):
+        if sample_rate is None:
+            sample_rate = float(os.getenv("TRACING_SAMPLE_RATE", "0"))
+        if exporter is None:
+            exporter_name = os.getenv("TRACING_EXPORTER", "log").lower()
+            if exporter_name == "log":
+                exporter = JsonLogExporter()
+            elif exporter_name == "otel":
+                exporter = OTelExporter()
+            else:
+                raise ValueError(f"Unsupported TRACING_EXPORTER: {exporter_name}")
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    def start_trace(self, name: str, traceparent: str | None = None, **attributes: Any) -> Span | None:
+        """开始一次请求的根 span；未被采样时返回 None。"""
+        remote = parse_traceparent(traceparent)
+        sampled = remote[2] if remote is not None else False
+        if not sampled and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return None
+        if remote is not None:
+            return self._start(name, trace_id=remote[0], parent_id=remote[1], attributes=attributes)
+        return self._start(name, trace_id=_new_id(128), attributes=attributes)
+
+    def start_span(self, name: str, parent: Span | None = None, **attributes: Any) -> Span | None:
+        """在 parent（默认当前 span）下开始子 span；不在被采样的请求中时返回 None。"""
+        parent = parent or _current_span.get()
+        if parent is None:
+            return None
+        return self._start(name, trace_id=parent.trace_id, parent=parent, attributes=attributes)
+
+    def _start(self, name: str, **kwargs: Any) -> Span:
+        span = Span(self, name, **kwargs)
+        self.exporter.on_start(span)
+        return span
+
+
+@contextlib.contextmanager
+def activate(span: Span | None) -> Iterator[Span | None]:
+    """把 span 设为当前 span（其后创建的 span 以它为父），退出时恢复。"""
+    if span is None:
+        yield None
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """记录一段同步或 await 代码的耗时；请求未被采样时什么都不做。"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.tracer.start_span(name, parent, **attributes)
+    try:
+        with activate(child):
+            yield child
+    except BaseException as exc:
+        child.end(error=type(exc).__name__)
+        raise
+    finally:
+        child.end()
+
+
+async def trace_stream(events: AsyncIterator[dict], name: str, **attributes: Any) -> AsyncGenerator[dict, None]:
+    """为事件流记录一个 span：首个事件 / 首个 token 的时间点、事件数和错误。
+
+    span 只在拉取下一个事件期间被设为当前 span，内部代码可以用
+    ``current_span().mark(...)`` 记录连接建立等时间点，而不会泄漏给消费方。
+    """
+    parent = _current_span.get()
+    if parent is None:
+        async for event in events:
+            yield event
+        return
+
+    stream_span = parent.tracer.start_span(name, parent, **attributes)
+    iterator = aiter(events)
+    count = 0
+    try:
+        while True:
+            with activate(stream_span):
+                try:
+                    event = await anext(iterator)
+                except StopAsyncIteration:
+                    break
+            count += 1
+            stream_span.mark("first_event")
+            event_type = event.get("type")
+            if event_type in ("content", "reasoning"):
+                stream_span.mark("first_token")
+            elif event_type == "error":
+                stream_span.error = event.get("code") or event.get("message") or "error"
+            yield event
+        stream_span.set(events=count)
+    except BaseException as exc:
+        # 提前关闭（对冲落败、客户端断开）不算错误
+        cancelled = isinstance(exc, GeneratorExit | asyncio.CancelledError)
+        stream_span.set(events=count, cancelled=cancelled)
+        if not cancelled:
+            stream_span.error = type(exc).__name__
+        raise
+    finally:
+        stream_span.end()
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class TracingMiddleware:
+    """ASGI middleware that opens the root span of each sampled HTTP request.
+
+    Besides the total time it records how long the request body took to arrive
+    (large Base64 images), the time to the first response byte and the response
+    size, and returns the trace id in ``X-Trace-Id``.
+    """
+
+    def __init__(self, app, tracer: Tracer | None = None):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        tracer = self.tracer or get_tracer()
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(b"traceparent", b"").decode("latin-1") or None
+        root = tracer.start_trace(
+            "http.request",
+            traceparent=traceparent,
+            **{"http.method": scope.get("method"), "http.target": scope.get("path")},
+        )
+        if root is None:
+            await self.app(scope, receive, send)
+            return
+
+        body_span: Span | None = None
+        body_bytes = 0
+        response_bytes = 0
+
+        async def traced_receive():
+            nonlocal body_span, body_bytes
+            message = await receive()
+            if message["type"] == "http.request" and (body_span is None or body_span.end_ns is None):
+                if body_span is None:
+                    body_span = tracer.start_span("request.body", parent=root)
+                body_bytes += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    body_span.set(bytes=body_bytes)
+                    body_span.end()
+            return message
+
+        async def traced_send(message):
+            nonlocal response_bytes
+            if message["type"] == "http.response.start":
+                root.set(**{"http.status_code": message["status"]})
+                message = {**message, "headers": [*message.get("headers", []), (b"x-trace-id", root.trace_id.encode())]}
+            elif message["type"] == "http.response.body":
+                root.mark("first_byte")
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            with activate(root):
+                await self.app(scope, traced_receive, traced_send)
+        except BaseException as exc:
+            root.error = type(exc).__name__
+            raise
+        finally:
+            root.set(response_bytes=response_bytes)
+            root.end()
+
+
+@lru_cache
+def get_tracer() -> Tracer:
+    """Process-wide tracer configured from the environment."""
+    return Tracer()
@@ -1,16 +1,34 @@
 import logging
 import os
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
+from src.api.admission import get_admission_controller
+from src.api.endpoints import close_job_queue, close_llm_service, get_job_queue
 from src.api.endpoints import router as api_router
+from src.api.request_guard import RequestGuardMiddleware
+from src.core.metrics import CONTENT_TYPE, get_llm_metrics
+from src.core.tracing import TracingMiddleware
 
 load_dotenv()
 
-app = FastAPI(title="Spec Generator API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动后台任务工作协程：继续执行上次退出时未完成的任务，并领取其他 worker 提交的任务
+    await app.dependency_overrides.get(get_job_queue, get_job_queue)().start()
+    yield
+    # 先停止后台任务，未完成的任务下次启动时继续执行
+    await close_job_queue()
+    # LLMService 为进程级单例，关闭时释放上游连接池
+    await close_llm_service()
+
+
+app = FastAPI(title="Spec Generator API", version="1.0.0", lifespan=lifespan)
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -27,6 +45,8 @@ allow_credentials = "*" not in origins
 if "*" in origins:
     origins = ["*"]
 
+# 请求体大小 / JSON 字段长度和数组个数预检，超限时在解析前返回 413 / 422（位于 CORS 之内，错误响应也带 CORS 头）
+app.add_middleware(RequestGuardMiddleware)
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -34,7 +54,10 @@ app.add_middleware(
     allow_credentials=allow_credentials,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Generation-Id", "X-Trace-Id"],
 )
+# 最外层：按 TRACING_SAMPLE_RATE 采样，记录请求体接收、各处理阶段和首字节时间
+app.add_middleware(TracingMiddleware)
 
 
 @app.exception_handler(HTTPException)
@@ -42,6 +65,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail},
+        headers=exc.headers,
     )
 
 
@@ -60,3 +84,25 @@ app.include_router(api_router, prefix="/api/v1")
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
+
+
+llm_metrics = get_llm_metrics()
+if llm_metrics is not None:
+    llm_metrics.registry.gauge(
+        "admission_active_generations",
+        "Generations currently holding an admission slot.",
+        lambda: get_admission_controller().active,
+    )
+    llm_metrics.registry.gauge(
+        "admission_queued_requests",
+        "Requests waiting for an admission slot.",
+        lambda: get_admission_controller().queued,
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus 抓取端点（每个 worker 进程单独统计）。"""
+    if llm_metrics is None:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(llm_metrics.render(), media_type=CONTENT_TYPE)
@@ -1,7 +1,7 @@
 from datetime import datetime, timezone
 from typing import Literal
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, field_validator, model_validator
 
 # 支持的图片 MIME 类型
 SUPPORTED_IMAGE_TYPES = Literal["image/jpeg", "image/png", "image/gif", "image/webp"]
@@ -9,17 +9,56 @@ SUPPORTED_IMAGE_TYPES = Literal["image/jpeg", "image/png", "image/gif", "image/w
 # 图片大小限制（10MB）
 MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10485760 bytes
 
+# Base64 编码后的图片数据最大长度（每 3 字节编码为 4 个字符）
+MAX_IMAGE_BASE64_CHARS = (MAX_IMAGE_SIZE + 2) // 3 * 4
+
 # 单次请求最大图片数量
 MAX_IMAGES_PER_REQUEST = 5
 
+# 批量生成单次最多条目数
+MAX_BATCH_ITEMS = 100
+
+# 功能描述 / 对话消息最大字符数
+MAX_DESCRIPTION_CHARS = 100_000
+
+# chat 模式携带的 current_prd 最大字符数
+MAX_PRD_CHARS = 500_000
+
+
+def base64_decoded_size(data: str) -> int:
+    """Base64 字符串解码后的字节数：由长度和末尾的 '=' 计算，不实际解码。"""
+    padding = 2 if data.endswith("==") else 1 if data.endswith("=") else 0
+    return max(0, len(data) * 3 // 4 - padding)
+
 
 class ImageAttachment(BaseModel):
-    """用户上传的图片附件，包含 Base64 编码数据和元信息。"""
+    """用户上传的图片附件：Base64 编码数据，或 `POST /images` 上传后返回的 image_id 引用。"""
 
-    data: str = Field(..., description="Base64 编码的图片数据（不含 data URI 前缀）")
-    mime_type: SUPPORTED_IMAGE_TYPES = Field(..., description="图片 MIME 类型")
+    data: str | None = Field(
+        default=None, max_length=MAX_IMAGE_BASE64_CHARS, description="Base64 编码的图片数据（不含 data URI 前缀）"
+    )
+    image_id: str | None = Field(
+        default=None, pattern=r"^[0-9a-f]{64}$", description="POST /images 返回的图片 ID（内容 sha256）"
+    )
+    mime_type: SUPPORTED_IMAGE_TYPES | None = Field(default=None, description="图片 MIME 类型（image_id 引用可省略）")
     filename: str | None = Field(default=None, max_length=255, description="原始文件名")
-    size: int | None = Field(default=None, le=MAX_IMAGE_SIZE, description="原始文件大小（字节），最大 10MB")
+    size: int | None = Field(
+        default=None, le=MAX_IMAGE_SIZE, description="原始文件大小（字节），最大 10MB；以 Base64 数据的实际长度为准"
+    )
+
+    @model_validator(mode="after")
+    def validate_source(self) -> "ImageAttachment":
+        if (self.data is None) == (self.image_id is None):
+            raise ValueError("exactly one of data or image_id is required")
+        if self.data is not None and self.mime_type is None:
+            raise ValueError("mime_type is required for base64 data")
+        if self.data is not None:
+            # 客户端声明的 size 不可信：按 Base64 长度算出实际大小并覆盖
+            size = base64_decoded_size(self.data)
+            if size > MAX_IMAGE_SIZE:
+                raise ValueError(f"image exceeds {MAX_IMAGE_SIZE} bytes")
+            self.size = size
+        return self
 
 
 class ChatMessage(BaseModel):
@@ -30,17 +69,36 @@ class ChatMessage(BaseModel):
 
 
 class GenerationRequest(BaseModel):
-    description: str = Field(..., min_length=1, description="Feature description or user message")
+    description: str = Field(
+        ..., min_length=1, max_length=MAX_DESCRIPTION_CHARS, description="Feature description or user message"
+    )
     stream: bool = Field(default=True, description="Whether to stream the response")
     mode: Literal["generate", "chat"] = Field(
         default="generate",
         description="Generation mode: generate=initial PRD from scratch, chat=modify existing PRD",
     )
-    current_prd: str | None = Field(default=None, description="Current PRD content for chat mode")
+    current_prd: str | None = Field(
+        default=None, max_length=MAX_PRD_CHARS, description="Current PRD content for chat mode"
+    )
+    edit_mode: Literal["full", "patch"] | None = Field(
+        default=None,
+        description="Chat edit mode: full=model re-emits the whole PRD, patch=section edits merged server-side",
+    )
+    generation_mode: Literal["sequential", "parallel"] | None = Field(
+        default=None,
+        description="Generate mode: sequential=one upstream stream, parallel=outline first, then sections concurrently",
+    )
     chat_history: list[ChatMessage] | None = Field(
         default=None, description="[DEPRECATED] No longer used, kept for backward compatibility"
     )
     session_id: str | None = Field(default=None, description="Session identifier for conversation tracking")
+    prd_etag: str | None = Field(
+        default=None,
+        description="Chat mode without current_prd: ETag of the session's stored PRD to edit (409 if outdated)",
+    )
+    reuse_session_images: bool = Field(
+        default=False, description="Chat mode: reuse the images stored with the session instead of re-uploading"
+    )
     images: list[ImageAttachment] | None = Field(default=None, description="Image attachments (max 5 images)")
 
     @field_validator("images")
@@ -51,6 +109,15 @@ class GenerationRequest(BaseModel):
         return v
 
 
+class BatchGenerationRequest(BaseModel):
+    items: list[GenerationRequest] = Field(
+        ..., min_length=1, max_length=MAX_BATCH_ITEMS, description="Generation requests (stream is ignored)"
+    )
+    parallelism: int | None = Field(
+        default=None, ge=1, description="Items generated at once, capped by BATCH_MAX_PARALLELISM"
+    )
+
+
 class GenerationResponse(BaseModel):
     markdown_content: str
     generated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -0,0 +1,61 @@
+import contextlib
+import os
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
+from contextlib import AbstractAsyncContextManager
+from functools import lru_cache
+
+from src.services.fan_out import fan_out
+
+
+class BatchRunner:
+    """Runs the items of a batch request concurrently and multiplexes their events into one stream.
+
+    Every event is tagged with the ``index`` of the item it belongs to; each item
+    ends with an ``item_done`` event and the stream ends with ``batch_done``. A
+    failing item does not stop the others. With a ``slot`` factory every running
+    item holds its own admission slot (see ``SlotPool``), so a batch counts
+    against the concurrency limits like the same number of separate requests.
+
+    Configuration (env):
+        BATCH_MAX_PARALLELISM: upper bound for items generated at once per batch (default 8)
+    """
+
+    def __init__(self, max_parallelism: int | None = None):
+        if max_parallelism is None:
+            max_parallelism = int(os.getenv("BATCH_MAX_PARALLELISM", "8"))
+        self.max_parallelism = max(1, max_parallelism)
+
+    def parallelism(self, requested: int | None) -> int:
+        return min(requested or self.max_parallelism, self.max_parallelism)
+
+    async def stream(
+        self,
+        starts: list[Callable[[], AsyncIterator[dict]]],
+        parallelism: int | None = None,
+        slot: Callable[[], AbstractAsyncContextManager] | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """并发执行各项，按到达顺序产出带 index 的事件。
+
+        Args:
+            starts: 每一项对应一个启动函数，返回该项的事件流（错误以 error 事件表示）
+            parallelism: 同时执行的项数，不超过 max_parallelism
+            slot: 每一项执行期间占用的准入名额
+        """
+        failed: set[int] = set()
+        # 有界队列：客户端读得慢时各项生成也随之放慢，不会无限堆积
+        events = fan_out(starts, self.parallelism(parallelism), slot, queue_size=256, label="batch item")
+        async with contextlib.aclosing(events):
+            async for index, event in events:
+                if event is None:
+                    yield {"type": "item_done", "index": index, "status": "failed" if index in failed else "succeeded"}
+                    continue
+                if event.get("type") == "error":
+                    failed.add(index)
+                yield {**event, "index": index}
+        yield {"type": "batch_done", "succeeded": len(starts) - len(failed), "failed": len(failed)}
+
+
+@lru_cache
+def get_batch_runner() -> BatchRunner:
+    """Process-wide batch runner configured from the environment."""
+    return BatchRunner()
@@ -0,0 +1,67 @@
+"""Concurrent fan-out of several event streams into one, shared by batch and parallel generation."""
+
+import asyncio
+import contextlib
+import logging
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
+from contextlib import AbstractAsyncContextManager
+
+logger = logging.getLogger("uvicorn.error")
+
+# 队列中的结束标记：某个流已结束
+_DONE = object()
+
+
+async def fan_out(
+    starts: list[Callable[[], AsyncIterator[dict]]],
+    parallelism: int,
+    slot: Callable[[], AbstractAsyncContextManager] | None = None,
+    queue_size: int = 0,
+    label: str = "stream",
+) -> AsyncGenerator[tuple[int, dict | None], None]:
+    """并发执行多个事件流，按到达顺序产出 ``(index, event)``。
+
+    每个流结束时产出一次 ``(index, None)``。流抛出的异常记录日志后转换为 error 事件，
+    不影响其他流。生成器关闭时（调用方提前结束或客户端断开）取消尚未完成的流，
+    调用方应配合 ``contextlib.aclosing`` 使用。
+
+    Args:
+        starts: 每个流对应一个启动函数
+        parallelism: 同时执行的流数
+        slot: 每个流执行期间占用的准入名额（见 ``SlotPool``）
+        queue_size: 事件队列容量；0 表示不限。有界时消费慢会使各流随之放慢
+        label: 日志中标识流的名称
+    """
+    limit = asyncio.Semaphore(max(1, parallelism))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    async def run(index: int, start: Callable[[], AsyncIterator[dict]]) -> None:
+        async with limit, slot() if slot is not None else contextlib.nullcontext():
+            events = start()
+            try:
+                async for event in events:
+                    await queue.put((index, event))
+            except Exception:
+                logger.exception("%s failed index=%d", label, index)
+                await queue.put((index, {"type": "error", "message": "Upstream model error"}))
+            finally:
+                if hasattr(events, "aclose"):
+                    await events.aclose()
+        await queue.put((index, _DONE))
+
+    tasks = [asyncio.create_task(run(index, start)) for index, start in enumerate(starts)]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            index, event = await queue.get()
+            if event is _DONE:
+                remaining -= 1
+                yield index, None
+                continue
+            yield index, event
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
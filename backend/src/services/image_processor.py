@@ -0,0 +1,147 @@
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+try:  # Optional: poetry install --extras images
+    from PIL import Image
+except ImportError:  # pragma: no cover - depends on the environment
+    Image = None
+
+logger = logging.getLogger("uvicorn.error")
+
+_PIL_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP", "image/gif": "GIF"}
+_OUTPUT_MIME = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+class ImageProcessor:
+    """Downscales images before they are sent to the VL model and caches the result by content hash.
+
+    Configuration (env):
+        IMAGE_MAX_EDGE: longest edge in pixels after downscaling (default 2048, 0 disables)
+        IMAGE_QUALITY: JPEG / WebP encoder quality (default 85)
+        IMAGE_OUTPUT_FORMAT: keep | webp | jpeg (default keep: PNG stays lossless, JPEG/WebP keep their format)
+        IMAGE_CACHE_MAX_MB: size bound of the processed-image cache (default 128)
+
+    Without Pillow installed images are passed through unchanged, but still cached.
+    """
+
+    def __init__(
+        self,
+        max_edge: int | None = None,
+        quality: int | None = None,
+        output_format: str | None = None,
+        cache_max_bytes: int | None = None,
+    ):
+        if max_edge is None:
+            max_edge = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+        if quality is None:
+            quality = int(os.getenv("IMAGE_QUALITY", "85"))
+        output_format = (output_format or os.getenv("IMAGE_OUTPUT_FORMAT", "keep")).lower()
+        if output_format not in ("keep", *_OUTPUT_MIME):
+            raise ValueError(f"Unsupported IMAGE_OUTPUT_FORMAT: {output_format}")
+        if cache_max_bytes is None:
+            cache_max_bytes = int(os.getenv("IMAGE_CACHE_MAX_MB", "128")) * 1024 * 1024
+        self.max_edge = max_edge
+        self.quality = quality
+        self.output_format = output_format
+        self.cache_max_bytes = cache_max_bytes
+        self.enabled = Image is not None and (max_edge > 0 or output_format != "keep")
+        if Image is None and (max_edge > 0 or output_format != "keep"):
+            logger.info("Pillow not installed, images are sent to the VL model without downscaling")
+
+        self._cache: OrderedDict[str, tuple[str, str]] = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def cache_key(self, content_hash: str) -> str:
+        # 处理参数变化后旧结果自动失效
+        return f"{content_hash}:{self.max_edge}:{self.quality}:{self.output_format}:{int(self.enabled)}"
+
+    def get_cached(self, content_hash: str) -> tuple[str, str] | None:
+        """命中时返回 (base64 数据, MIME 类型)。"""
+        key = self.cache_key(content_hash)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            return entry
+
+    def process(self, content_hash: str, data: bytes, mime_type: str) -> tuple[str, str]:
+        """缩放 / 重新编码一张图片，返回 (base64 数据, MIME 类型) 并写入缓存。"""
+        cached = self.get_cached(content_hash)
+        if cached is not None:
+            return cached
+
+        if self.enabled:
+            try:
+                data, mime_type = self._transform(data, mime_type)
+            except Exception:
+                # 无法解码的图片原样发送，交给上游判断
+                logger.warning("image processing failed, sending original hash=%s", content_hash[:12], exc_info=True)
+        result = (base64.b64encode(data).decode("ascii"), mime_type)
+
+        key = self.cache_key(content_hash)
+        size = len(result[0])
+        with self._lock:
+            if key not in self._cache and size <= self.cache_max_bytes:
+                self._cache[key] = result
+                self._cache_bytes += size
+                while self._cache_bytes > self.cache_max_bytes:
+                    _, (evicted, _) = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+        return result
+
+    def process_base64(self, data: str, mime_type: str) -> tuple[str, str]:
+        """处理请求体中的 Base64 图片。
+
+        与上传的图片（image_id）一样按解码后的字节哈希缓存，同一张图片内联发送和
+        按 image_id 引用时共用一份处理结果。
+        """
+        if not self.enabled:
+            return data, mime_type
+        raw = base64.b64decode(data)
+        content_hash = hashlib.sha256(raw).hexdigest()
+        cached = self.get_cached(content_hash)
+        if cached is not None:
+            return cached
+        return self.process(content_hash, raw, mime_type)
+
+    def _transform(self, data: bytes, mime_type: str) -> tuple[bytes, str]:
+        with Image.open(io.BytesIO(data)) as image:
+            animated = getattr(image, "is_animated", False)
+            resize = self.max_edge > 0 and max(image.size) > self.max_edge
+            target = self.output_format
+            if target == "keep":
+                if not resize:
+                    return data, mime_type
+                # GIF 缩放后只保留第一帧，转成 PNG
+                target = "png" if mime_type == "image/gif" else _PIL_FORMATS[mime_type].lower()
+            elif animated and not resize:
+                return data, mime_type
+
+            if resize:
+                image.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+            if target == "jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            elif image.mode == "P":
+                image = image.convert("RGBA")
+
+            buffer = io.BytesIO()
+            options = {"optimize": True} if target == "png" else {"quality": self.quality}
+            image.save(buffer, format=target.upper(), **options)
+        processed = buffer.getvalue()
+        if not resize and len(processed) >= len(data):
+            # 只转格式却没有变小时保留原图
+            return data, mime_type
+        return processed, _OUTPUT_MIME[target]
+
+
+@lru_cache
+def get_image_processor() -> ImageProcessor:
+    """Process-wide image processor configured from the environment."""
+    return ImageProcessor()
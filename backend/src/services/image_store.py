@@ -0,0 +1,199 @@
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+from src.models.schemas import MAX_IMAGE_SIZE
+
+logger = logging.getLogger("uvicorn.error")
+
+# 识别图片类型所需的最少字节数（WebP: RIFF????WEBP）
+SNIFF_BYTES = 12
+
+
+class ImageUploadError(ValueError):
+    """Rejected upload; ``status_code`` is the HTTP status the API should answer with."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_image_mime(head: bytes) -> str | None:
+    """根据文件头魔数判断图片类型，不解码整张图片。"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+@dataclass
+class StoredImage:
+    image_id: str  # sha256 of the image bytes
+    mime_type: str
+    size: int
+    path: Path
+    stored_at: float
+
+
+class ImageStore:
+    """Content-addressed store for uploaded images, kept on disk and bounded by total size.
+
+    Uploads are streamed straight to a temporary file while hashing, so an image
+    never has to be held in memory (or as a base64 string) to be accepted.
+
+    The in-memory index is per process and rebuilt from the directory at
+    startup. With several workers sharing ``root``, an image uploaded through
+    another worker is missing from the index; ``get`` then falls back to the
+    file on disk (existence, TTL by mtime, type by magic bytes) and indexes it.
+    """
+
+    def __init__(self, root: str | Path, max_bytes: int, ttl: float):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._images: OrderedDict[str, StoredImage] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._load_existing()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _load_existing(self) -> None:
+        # 重启后沿用磁盘上已有的图片，按修改时间重建 LRU 顺序
+        entries = [image for path in self.root.iterdir() if (image := self._read_file(path.name)) is not None]
+        for image in sorted(entries, key=lambda image: image.stored_at):
+            self._add(image)
+        self._evict()
+
+    def _read_file(self, image_id: str) -> StoredImage | None:
+        """从磁盘读取一张图片的元数据；不存在、已过期或不是图片时返回 None。"""
+        if len(image_id) != 64 or any(char not in "0123456789abcdef" for char in image_id):
+            return None
+        path = self.root / image_id
+        try:
+            stat = path.stat()
+            if stat.st_mtime + self.ttl <= time.time():
+                path.unlink(missing_ok=True)
+                return None
+            with open(path, "rb") as f:
+                mime_type = sniff_image_mime(f.read(SNIFF_BYTES))
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        if mime_type is None:
+            return None
+        return StoredImage(image_id, mime_type, stat.st_size, path, stat.st_mtime)
+
+    async def save_stream(self, chunks: AsyncIterator[bytes], max_size: int = MAX_IMAGE_SIZE) -> StoredImage:
+        """把上传的字节流写入临时文件，同时计算哈希和校验大小 / 类型。
+
+        Raises:
+            ImageUploadError: 超过大小限制（413）、不是支持的图片类型（415）或内容为空（400）
+        """
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        fd, tmp_name = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ImageUploadError(f"Image exceeds {max_size} bytes", status_code=413)
+                    if len(head) < SNIFF_BYTES:
+                        head += chunk[: SNIFF_BYTES - len(head)]
+                        if len(head) >= SNIFF_BYTES and sniff_image_mime(head) is None:
+                            raise ImageUploadError("Unsupported image type", status_code=415)
+                    digest.update(chunk)
+                    f.write(chunk)
+            if size == 0:
+                raise ImageUploadError("Empty image")
+            mime_type = sniff_image_mime(head)
+            if mime_type is None:
+                raise ImageUploadError("Unsupported image type", status_code=415)
+
+            image_id = digest.hexdigest()
+            path = self.root / image_id
+            with self._lock:
+                existing = self._images.get(image_id)
+                if existing is not None and existing.path.exists():
+                    # 相同内容已存在，直接复用
+                    self._images.move_to_end(image_id)
+                    return existing
+                os.replace(tmp_name, path)
+                tmp_name = None
+                image = StoredImage(image_id, mime_type, size, path, time.time())
+                self._add(image)
+                self._evict()
+            return image
+        finally:
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+    def get(self, image_id: str) -> StoredImage | None:
+        with self._lock:
+            image = self._images.get(image_id)
+            if image is None:
+                # 索引只覆盖本进程；其他 worker 上传的图片从磁盘读取后加入索引
+                image = self._read_file(image_id)
+                if image is None:
+                    return None
+                self._add(image)
+                self._evict()
+                return image if image_id in self._images else None
+            if image.stored_at + self.ttl <= time.time() or not image.path.exists():
+                self._remove(image_id)
+                return None
+            self._images.move_to_end(image_id)
+            return image
+
+    def read_bytes(self, image_id: str) -> bytes:
+        image = self.get(image_id)
+        if image is None:
+            raise KeyError(image_id)
+        return image.path.read_bytes()
+
+    def read_base64(self, image_id: str) -> str:
+        return base64.b64encode(self.read_bytes(image_id)).decode("ascii")
+
+    def _add(self, image: StoredImage) -> None:
+        self._images[image.image_id] = image
+        self._total_bytes += image.size
+
+    def _remove(self, image_id: str) -> None:
+        image = self._images.pop(image_id, None)
+        if image is None:
+            return
+        self._total_bytes -= image.size
+        image.path.unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and len(self._images) > 1:
+            self._remove(next(iter(self._images)))
+
+
+@lru_cache
+def get_image_store() -> ImageStore:
+    """Process-wide image store configured from the environment."""
+    root = os.getenv("IMAGE_STORE_DIR") or Path(tempfile.gettempdir()) / "spec-generator-images"
+    max_bytes = int(os.getenv("IMAGE_STORE_MAX_MB", "1024")) * 1024 * 1024
+    ttl = float(os.getenv("IMAGE_STORE_TTL", "86400"))
+    return ImageStore(root, max_bytes=max_bytes, ttl=ttl)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from collections import deque
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
+
+logger = logging.getLogger("uvicorn.error")
+
+# 计入输出 token 估算的增量事件
+_OUTPUT_EVENT_TYPES = frozenset({"content", "reasoning"})
+
+
+class AbortStats:
+    """Counts generations aborted because every client left, and estimates the output tokens saved.
+
+    The estimate uses running averages from completed generations: the typical
+    output token count, and tokens per emitted character to convert the part that
+    was already streamed before the abort.
+    """
+
+    def __init__(self, avg_output_tokens: float = 3000.0, tokens_per_char: float = 0.7):
+        self.aborted = 0
+        self.tokens_saved = 0
+        self.avg_output_tokens = avg_output_tokens
+        self.tokens_per_char = tokens_per_char
+
+    def observe_completion(self, output_chars: int, output_tokens: int) -> None:
+        if output_tokens <= 0:
+            return
+        self.avg_output_tokens = 0.9 * self.avg_output_tokens + 0.1 * output_tokens
+        if output_chars > 0:
+            self.tokens_per_char = 0.9 * self.tokens_per_char + 0.1 * (output_tokens / output_chars)
+
+    def record_abort(self, output_chars: int) -> int:
+        emitted = output_chars * self.tokens_per_char
+        saved = max(0, round(self.avg_output_tokens - emitted))
+        self.aborted += 1
+        self.tokens_saved += saved
+        return saved
+
+
+class ReplayGone(LookupError):
+    """The requested position has already been dropped from the replay buffer."""
+
+
+class Flight:
+    """One background generation whose events are buffered for every subscriber.
+
+    Used for the generations shared by identical requests (``InflightRegistry``)
+    and for resumable streams (``ResumableStreams``). With ``max_events`` only
+    the newest events are kept; positions older than that can no longer be
+    replayed.
+    """
+
+    def __init__(self, key: str, max_events: int | None = None):
+        self.key = key
+        self.events: deque[dict] = deque(maxlen=max_events)
+        # 已被挤出缓冲区的事件数，即 events[0] 的位置
+        self.dropped = 0
+        self.done = False
+        self.subscribers = 0
+        self.output_chars = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    @property
+    def published(self) -> int:
+        """Number of events published so far, including dropped ones."""
+        return self.dropped + len(self.events)
+
+    def publish(self, event: dict) -> None:
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+        if event.get("type") in _OUTPUT_EVENT_TYPES:
+            self.output_chars += len(event.get("content", ""))
+        self._notify()
+
+    def finish(self) -> None:
+        self.done = True
+        self._notify()
+
+    def _notify(self) -> None:
+        # 唤醒当前所有等待者，并为下一轮等待准备新的 Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self, start: int = 0) -> AsyncGenerator[dict, None]:
+        """先回放从位置 start 起已产生的事件，再实时接收后续事件，直到生成结束。
+
+        Raises:
+            ReplayGone: 所需事件已被挤出缓冲区
+        """
+        index = start
+        while True:
+            if index < self.dropped:
+                raise ReplayGone(f"event {index + 1} is no longer buffered")
+            if index < self.published:
+                yield self.events[index - self.dropped]
+                index += 1
+            elif self.done:
+                return
+            else:
+                await self._changed.wait()
+
+
+class InflightRegistry:
+    """Single-flight coalescing of concurrent identical generations.
+
+    The first caller for a key starts a background task that drives the upstream
+    stream; later callers with the same key attach to it, get the already emitted
+    prefix replayed and then receive new events as they arrive. When the last
+    subscriber leaves (client disconnected) the upstream generation is cancelled.
+    """
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+        self.abort_stats = AbortStats()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def subscribe(
+        self,
+        key: str,
+        factory: Callable[[], AsyncIterator[dict]],
+    ) -> AsyncGenerator[dict, None]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = Flight(key)
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._drive(flight, factory()))
+        else:
+            logger.info(
+                "joined in-flight generation key=%s replay=%d subscribers=%d",
+                key[:12],
+                len(flight.events),
+                flight.subscribers + 1,
+            )
+
+        flight.subscribers += 1
+        try:
+            async for event in flight.follow():
+                yield event
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                self._abort(flight)
+
+    def _abort(self, flight: Flight) -> None:
+        """所有订阅者都已离开：立即取消上游生成，新的相同请求会重新发起。"""
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if flight.task is not None and not flight.task.done():
+            flight.task.cancel()
+
+    async def _drive(self, flight: Flight, events: AsyncIterator[dict]) -> None:
+        try:
+            async for event in events:
+                flight.publish(event)
+                if event.get("type") == "usage" and not event.get("cached"):
+                    self.abort_stats.observe_completion(flight.output_chars, event.get("output_tokens", 0))
+        except asyncio.CancelledError:
+            saved = self.abort_stats.record_abort(flight.output_chars)
+            logger.info(
+                "generation aborted, no subscribers left key=%s emitted_chars=%d est_tokens_saved=%d total_saved=%d",
+                flight.key[:12],
+                flight.output_chars,
+                saved,
+                self.abort_stats.tokens_saved,
+            )
+        except Exception:
+            logger.exception("in-flight generation failed key=%s", flight.key[:12])
+            flight.publish({"type": "error", "message": "Upstream model error"})
+        finally:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.finish()
@@ -0,0 +1,425 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import AsyncIterator, Callable, Sequence
+from dataclasses import dataclass, field
+
+from src.models.schemas import GenerationRequest
+
+logger = logging.getLogger("uvicorn.error")
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class JobQueueFull(RuntimeError):
+    """Too many jobs are waiting; the caller should retry later."""
+
+
+@dataclass
+class JobRecord:
+    """One background generation job and, once finished, its result and token usage."""
+
+    job_id: str
+    request: dict
+    status: str = "queued"
+    result: str | None = None
+    usage: dict | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    cancel_requested: bool = False
+    # 提交者的准入计数键（见 client_keys），任务执行时同样计入并发限制
+    client_keys: list[str] = field(default_factory=list)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def summary(self) -> dict:
+        """轮询用的状态信息，不含生成结果。"""
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "usage": self.usage,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+        }
+
+
+class SQLiteJobStore:
+    """SQLite job table shared by all worker processes of the host; it is the queue itself.
+
+    A worker claims a queued job atomically and holds it under a lease that it
+    renews while the job runs. Jobs whose lease has expired (the owning worker
+    died) are queued again; cancelling a running job sets a flag that the owner
+    picks up on its next renewal.
+    """
+
+    _COLUMNS = (
+        "job_id, request, status, result, usage, error, created_at, started_at, finished_at, cancel_requested, "
+        "client_keys"
+    )
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, request TEXT NOT NULL, status TEXT NOT NULL, result TEXT, usage TEXT, "
+            "error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL, "
+            "owner TEXT, lease_until REAL, cancel_requested INTEGER NOT NULL DEFAULT 0, client_keys TEXT)"
+        )
+        # 旧版本创建的表没有租约和准入相关的列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (
+            ("owner", "TEXT"),
+            ("lease_until", "REAL"),
+            ("cancel_requested", "INTEGER NOT NULL DEFAULT 0"),
+            ("client_keys", "TEXT"),
+        ):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.commit()
+
+    def _record(self, row: tuple) -> JobRecord:
+        return JobRecord(
+            job_id=row[0],
+            request=json.loads(row[1]),
+            status=row[2],
+            result=row[3],
+            usage=json.loads(row[4]) if row[4] else None,
+            error=row[5],
+            created_at=row[6],
+            started_at=row[7],
+            finished_at=row[8],
+            cancel_requested=bool(row[9]),
+            client_keys=json.loads(row[10]) if row[10] else [],
+        )
+
+    def save(self, record: JobRecord) -> None:
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record.job_id,
+                    json.dumps(record.request),
+                    record.status,
+                    record.result,
+                    json.dumps(record.usage) if record.usage else None,
+                    record.error,
+                    record.created_at,
+                    record.started_at,
+                    record.finished_at,
+                    int(record.cancel_requested),
+                    json.dumps(record.client_keys),
+                ),
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> JobRecord | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def queued(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def claim_next(self, owner: str, lease: float) -> JobRecord | None:
+        """原子地领取最早排队的任务并设置租约；没有可领取的任务时返回 None。
+
+        租约已过期的运行中任务（所属 worker 已退出）先重新排队。
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL, started_at = NULL "
+                "WHERE status = 'running' AND (lease_until IS NULL OR lease_until <= ?)",
+                (now,),
+            )
+            # 单条 UPDATE 在 SQLite 写锁内执行：多个进程同时领取时只有一个能成功
+            row = self._conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, started_at = ? "
+                "WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) "
+                f"AND status = 'queued' RETURNING {self._COLUMNS}",
+                (owner, now + lease, now),
+            ).fetchone()
+            self._conn.commit()
+        return self._record(row) if row is not None else None
+
+    def renew(self, job_id: str, owner: str, lease: float) -> bool | None:
+        """延长租约。
+
+        Returns:
+            是否已请求取消；租约已不属于 owner 时返回 None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND owner = ? AND status = 'running' "
+                "RETURNING cancel_requested",
+                (time.time() + lease, job_id, owner),
+            ).fetchone()
+            self._conn.commit()
+        return bool(row[0]) if row is not None else None
+
+    def finish(self, record: JobRecord, owner: str) -> bool:
+        """写入结束状态；租约已被其他 worker 接管时不覆盖，返回 False。"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, usage = ?, error = ?, finished_at = ?, lease_until = NULL "
+                "WHERE job_id = ? AND owner = ? AND status = 'running'",
+                (
+                    record.status,
+                    record.result,
+                    json.dumps(record.usage) if record.usage else None,
+                    record.error,
+                    record.finished_at,
+                    record.job_id,
+                    owner,
+                ),
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def release(self, job_id: str, owner: str) -> None:
+        """交还租约，任务重新排队（worker 正常退出时）。"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL, started_at = NULL "
+                "WHERE job_id = ? AND owner = ? AND status = 'running'",
+                (job_id, owner),
+            )
+            self._conn.commit()
+
+    def request_cancel(self, job_id: str) -> JobRecord | None:
+        """排队中的任务直接标记为已取消；运行中的任务设置取消标记，由持有租约的 worker 停止。"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            self._conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = 'running'", (job_id,)
+            )
+            self._conn.commit()
+        return self.get(job_id)
+
+    def purge_expired(self) -> int:
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at <= ?",
+                (cutoff,),
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JobQueue:
+    """Runs submitted generation requests on a bounded pool of background workers.
+
+    Submitting only writes the job to the store, so HTTP handlers return at once;
+    throughput is set by the number of workers rather than by open client
+    connections. The store is the queue: every uvicorn worker claims jobs from
+    it atomically, so a job runs in one process at a time, and a job whose
+    process died is picked up again once its lease expires. Results and usage
+    stay in the store for ``JOB_RESULT_TTL``. ``run`` gets the request and the
+    client keys given at submission, so the caller can apply admission control.
+
+    Configuration (env):
+        JOB_WORKERS: jobs generated concurrently per worker process (default 4)
+        JOB_MAX_PENDING: queued jobs accepted before submissions are rejected (default 1000)
+        JOB_STORE_PATH: SQLite file holding jobs and results (default jobs.sqlite3)
+        JOB_RESULT_TTL: seconds finished jobs are kept (default 86400)
+        JOB_LEASE: seconds a running job stays claimed without a renewal (default 30)
+        JOB_POLL_INTERVAL: seconds between checks for jobs submitted through other workers (default 1)
+    """
+
+    def __init__(
+        self,
+        run: Callable[[GenerationRequest, tuple[str, ...]], AsyncIterator[dict]],
+        store: SQLiteJobStore | None = None,
+        workers: int | None = None,
+        max_pending: int | None = None,
+        lease: float | None = None,
+        poll_interval: float | None = None,
+    ):
+        if store is None:
+            store = SQLiteJobStore(
+                os.getenv("JOB_STORE_PATH", "jobs.sqlite3"),
+                ttl=float(os.getenv("JOB_RESULT_TTL", "86400")),
+            )
+        if workers is None:
+            workers = int(os.getenv("JOB_WORKERS", "4"))
+        if max_pending is None:
+            max_pending = int(os.getenv("JOB_MAX_PENDING", "1000"))
+        if lease is None:
+            lease = float(os.getenv("JOB_LEASE", "30"))
+        if poll_interval is None:
+            poll_interval = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+        self.run = run
+        self.store = store
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.lease = lease
+        # 续约同时检查取消标记，间隔决定跨进程取消的延迟
+        self.heartbeat = min(2.0, lease / 3)
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup: asyncio.Semaphore | None = None
+        self._workers: list[asyncio.Task] = []
+        self._running: dict[str, asyncio.Task] = {}
+        self._closing = False
+
+    async def start(self) -> None:
+        """启动工作协程（幂等）；上次退出时未完成的任务由工作协程重新领取。"""
+        if self._wakeup is not None:
+            return
+        self._wakeup = asyncio.Semaphore(0)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        """停止工作协程；运行中的任务交还租约重新排队，由其他 worker 或下次启动时继续执行。"""
+        self._closing = True
+        tasks = [*self._running.values(), *self._workers]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._workers = []
+        self._wakeup = None
+        self._closing = False
+        await asyncio.to_thread(self.store.close)
+
+    async def submit(self, request: GenerationRequest, client_keys: Sequence[str] = ()) -> JobRecord:
+        """保存任务并排队，立即返回。
+
+        Args:
+            request: 生成请求
+            client_keys: 提交者的准入计数键，执行时原样交给 run
+
+        Raises:
+            JobQueueFull: 排队任务数已达 JOB_MAX_PENDING
+        """
+        await self.start()
+        pending = await asyncio.to_thread(self.store.queued)
+        if pending >= self.max_pending:
+            raise JobQueueFull(f"{pending} jobs already queued")
+        record = JobRecord(
+            job_id=uuid.uuid4().hex, request=request.model_dump(exclude_none=True), client_keys=list(client_keys)
+        )
+        await asyncio.to_thread(self.store.save, record)
+        self._wakeup.release()
+        await asyncio.to_thread(self.store.purge_expired)
+        return record
+
+    async def get(self, job_id: str) -> JobRecord | None:
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def cancel(self, job_id: str) -> JobRecord | None:
+        """取消排队中或运行中的任务；已结束的任务原样返回。
+
+        任务在其他 worker 上运行时只设置取消标记，返回的状态仍为 running（cancel_requested），
+        持有租约的 worker 在下一次续约时停止它。
+        """
+        record = await asyncio.to_thread(self.store.request_cancel, job_id)
+        if record is None or record.finished:
+            return record
+        task = self._running.get(job_id)
+        if task is not None:
+            # 由 _execute 记录 cancelled 状态
+            task.cancel()
+            await asyncio.wait({task})
+            return await self.get(job_id)
+        return record
+
+    async def _worker(self) -> None:
+        wakeup = self._wakeup
+        while True:
+            record = await asyncio.to_thread(self.store.claim_next, self.owner, self.lease)
+            if record is None:
+                # 等待本进程提交的新任务，或定期检查其他 worker 提交 / 租约过期的任务
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(wakeup.acquire(), self.poll_interval)
+                continue
+            task = asyncio.create_task(self._execute(record))
+            self._running[record.job_id] = task
+            keeper = asyncio.create_task(self._keep_lease(record.job_id, task))
+            try:
+                # 单个任务被取消不影响工作协程本身
+                await asyncio.wait({task})
+            finally:
+                keeper.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await keeper
+                self._running.pop(record.job_id, None)
+
+    async def _keep_lease(self, job_id: str, task: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            cancel_requested = await asyncio.to_thread(self.store.renew, job_id, self.owner, self.lease)
+            if cancel_requested is None:
+                logger.warning("job lease lost job_id=%s", job_id)
+                task.cancel()
+                return
+            if cancel_requested:
+                task.cancel()
+                return
+
+    async def _execute(self, record: JobRecord) -> None:
+        parts: list[str] = []
+        try:
+            request = GenerationRequest.model_validate(record.request)
+            async for event in self.run(request, tuple(record.client_keys)):
+                event_type = event.get("type")
+                if event_type == "content":
+                    parts.append(event.get("content", ""))
+                elif event_type == "usage":
+                    record.usage = {key: value for key, value in event.items() if key != "type"}
+                elif event_type == "error":
+                    record.status = "failed"
+                    record.error = event.get("message") or "Upstream model error"
+                    break
+            else:
+                record.status = "succeeded"
+                record.result = "".join(parts)
+        except asyncio.CancelledError:
+            if self._closing:
+                await asyncio.to_thread(self.store.release, record.job_id, self.owner)
+                raise
+            record.status = "cancelled"
+        except Exception:
+            logger.exception("job failed job_id=%s", record.job_id)
+            record.status = "failed"
+            record.error = "Internal error"
+        record.finished_at = time.time()
+        if not await asyncio.to_thread(self.store.finish, record, self.owner):
+            # 租约已过期并被其他 worker 接管，结果以接管方为准
+            logger.warning("job finished after losing its lease job_id=%s", record.job_id)
+            return
+        logger.info(
+            "job finished job_id=%s status=%s duration=%.1fs",
+            record.job_id,
+            record.status,
+            record.finished_at - record.started_at,
+        )
@@ -1,17 +1,63 @@
-import json
+import asyncio
 import logging
 import os
-from collections.abc import Generator
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Iterator
+from contextlib import AbstractAsyncContextManager
 from http import HTTPStatus
 
+import aiohttp
 import dashscope
 from dashscope.api_entities.dashscope_response import Message
 
-from src.core.prompt_loader import get_chat_prompt_loader, get_prompt_loader
+from src.core.metrics import get_llm_metrics
+from src.core.prd_index import PrunedPrd, get_prd_index
+from src.core.prd_patch import apply_patch_events
+from src.core.prompt_loader import get_chat_patch_prompt_loader, get_chat_prompt_loader, get_prompt_loader
+from src.core.tracing import current_span, span, trace_stream
 from src.models.schemas import ImageAttachment
+from src.services.image_processor import get_image_processor
+from src.services.image_store import get_image_store
+from src.services.inflight import InflightRegistry
+from src.services.parallel_generation import OUTLINE_INSTRUCTION, Outline, get_parallel_generator
+from src.services.response_cache import build_request_key, get_response_cache
+from src.services.session_store import get_session_store
+from src.services.upstream import ResilientUpstream
 
 logger = logging.getLogger("uvicorn.error")
 
+# chat 模式固定的确认回复，属于可缓存前缀的一部分，必须逐字节不变
+PRD_ACK = "好的，我已了解当前 PRD 内容，请告诉我你的想法或问题。"
+PRUNED_NOTE = "只展示与本次修改相关的章节全文，其余章节仅保留标题，不要修改或删除它们"
+
+
+def _parse_models(value: str | None) -> list[str]:
+    return [model.strip() for model in (value or "").split(",") if model.strip()]
+
+
+def _image_chars(images: list[ImageAttachment] | None) -> int:
+    return sum(len(img.data or "") for img in images or ())
+
+
+def _cache_marked(content: str | list) -> list:
+    """给消息内容加上 DashScope 显式缓存标记（缓存到该消息为止的前缀）。"""
+    marker = {"cache_control": {"type": "ephemeral"}}
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, **marker}]
+    return [*content[:-1], {**content[-1], **marker}]
+
+
+def _usage_details(usage) -> dict:
+    """上游 usage 中的 prompt_tokens_details（命中 / 新建的前缀缓存 token 数）。"""
+    details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else None
+    return details if isinstance(details, dict) else {}
+
+
+def _mark_connected() -> None:
+    # 上游已返回响应头：记录连接耗时（trace 的 upstream.call span）
+    upstream_span = current_span()
+    if upstream_span is not None:
+        upstream_span.mark("connected")
+
 
 class LLMService:
     def __init__(self):
@@ -21,71 +67,276 @@ class LLMService:
         dashscope.api_key = self.api_key
         self.model = os.getenv("DASHSCOPE_MODEL", "deepseek-v3.2")
         self.vl_model = os.getenv("DASHSCOPE_VL_MODEL", "qwen3-vl-plus")  # Updated default to qwen3-vl-plus
+        # 首选模型不可用或首 token 过慢时依次尝试的备用模型（逗号分隔）
+        self.fallback_models = _parse_models(os.getenv("DASHSCOPE_FALLBACK_MODELS"))
+        self.vl_fallback_models = _parse_models(os.getenv("DASHSCOPE_VL_FALLBACK_MODELS"))
         self.enable_thinking = os.getenv("ENABLE_THINKING", "true").lower() in ("1", "true", "yes")
         self.debug_errors = os.getenv("DEBUG_ERRORS", "false").lower() in ("1", "true", "yes")
         self.prompt_loader = get_prompt_loader()
         self.chat_prompt_loader = get_chat_prompt_loader()
-        logger.info("LLMService initialized: model=%s, vl_model=%s, enable_thinking=%s",
-                    self.model, self.vl_model, self.enable_thinking)
+        self.chat_patch_prompt_loader = get_chat_patch_prompt_loader()
+        self.prd_index = get_prd_index()
+        self.chat_edit_mode = os.getenv("CHAT_EDIT_MODE", "full").lower()
+        self.generation_mode = os.getenv("GENERATION_MODE", "sequential").lower()
+        self.parallel_generator = get_parallel_generator()
+        # explicit: 在稳定前缀末尾加 cache_control 标记；implicit: 只依赖模型自带的隐式前缀缓存
+        # 显式缓存的创建按更高单价计费，默认不开启
+        self.prompt_cache_mode = os.getenv("PROMPT_CACHE_MODE", "implicit").lower()
+        if self.prompt_cache_mode not in ("explicit", "implicit"):
+            raise ValueError(f"Unsupported PROMPT_CACHE_MODE: {self.prompt_cache_mode}")
+        self.response_cache = get_response_cache()
+        self.inflight = InflightRegistry()
+        self.session_store = get_session_store()
+        self.image_store = get_image_store()
+        self.image_processor = get_image_processor()
+        self.upstream = ResilientUpstream()
+        self.metrics = get_llm_metrics()
+        # 上游长连接池：连接数即可同时进行的上游流式生成数
+        self.pool_size = int(os.getenv("UPSTREAM_POOL_SIZE", "200"))
+        self.pool_per_host = int(os.getenv("UPSTREAM_POOL_PER_HOST", "200"))
+        self.keepalive_timeout = float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS", "60"))
+        self._session: aiohttp.ClientSession | None = None
+        self._session_loop: asyncio.AbstractEventLoop | None = None
+        logger.info(
+            "LLMService initialized: model=%s, vl_model=%s, enable_thinking=%s, pool_size=%d",
+            self.model,
+            self.vl_model,
+            self.enable_thinking,
+            self.pool_size,
+        )
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """返回共享的 aiohttp 会话，复用到 DashScope 的 keep-alive 连接。
+
+        会话绑定创建它的事件循环；循环变化（如测试中）时关闭旧会话并重新创建。
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            if self._session is not None and not self._session.closed:
+                await self._close_stale_session(self._session, self._session_loop)
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, trust_env=True)
+            self._session_loop = loop
+        return self._session
+
+    @staticmethod
+    async def _close_stale_session(session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop | None) -> None:
+        """关闭绑定在其他事件循环上的旧会话，释放其连接。"""
+        if loop is not None and loop.is_running():
+            # 旧循环仍在其他线程运行：交给它自己关闭
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+        # 旧循环已结束：aiohttp 跳过已失效的 transport，只把会话标记为关闭
+        await session.close()
+
+    async def aclose(self) -> None:
+        """关闭上游连接池，在应用关闭时调用。"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    def _upstream_error_event(self, exc: Exception) -> dict:
+        message = str(exc) if self.debug_errors else "Upstream model error"
+        return {"type": "error", "message": message}
+
+    def _text_call_kwargs(
+        self, messages: list[Message], model: str | None = None, thinking: bool | None = None
+    ) -> dict:
+        return {
+            "model": model or self.model,
+            "messages": messages,
+            "result_format": "message",
+            "stream": True,
+            "incremental_output": True,
+            "enable_thinking": self.enable_thinking if thinking is None else thinking,
+            "timeout": 300,
+        }
+
+    def _multimodal_call_kwargs(
+        self, messages: list[dict], model: str | None = None, thinking: bool | None = None
+    ) -> dict:
+        return {
+            "model": model or self.vl_model,
+            "messages": messages,
+            "stream": True,
+            "incremental_output": True,
+            "enable_thinking": self.enable_thinking if thinking is None else thinking,
+            "timeout": 300,
+        }
+
+    def _text_response_events(self, response) -> Iterator[dict]:
+        """把一条 Generation 流式响应转换为事件字典。"""
+        if response.status_code == HTTPStatus.OK:
+            if response.output and response.output.choices:
+                message = response.output.choices[0].message
+                # Safely get reasoning_content - DashScope objects raise KeyError for missing attrs
+                try:
+                    reasoning_content = message.reasoning_content
+                    if reasoning_content:
+                        yield {"type": "reasoning", "content": reasoning_content}
+                except (KeyError, AttributeError):
+                    pass
+                content = message.content
+                if content:
+                    assert isinstance(content, str)
+                    yield {"type": "content", "content": content}
+        else:
+            error_msg = response.message if self.debug_errors else "Upstream model error"
+            yield {"type": "error", "message": error_msg, "code": response.code}
+
+    def _multimodal_response_events(self, response) -> Iterator[dict]:
+        """把一条 MultiModalConversation 流式响应转换为事件字典。"""
+        if response.status_code == HTTPStatus.OK:
+            if response.output and response.output.choices:
+                choice = response.output.choices[0]
+                message = choice.message
+
+                # 提取 reasoning_content（思考过程）
+                try:
+                    reasoning_content = message.reasoning_content
+                    if reasoning_content:
+                        logger.info("VL model returned reasoning content: %d chars", len(reasoning_content))
+                        yield {"type": "reasoning", "content": reasoning_content}
+                    else:
+                        logger.warning("VL model returned empty reasoning_content")
+                except (KeyError, AttributeError) as e:
+                    logger.warning("VL model does not have reasoning_content attribute: %s", e)
+
+                # MultiModalConversation 返回的 content 可能是列表
+                content = message.content
+                if content:
+                    # 提取文本内容
+                    if isinstance(content, list):
+                        for item in content:
+                            if isinstance(item, dict) and "text" in item:
+                                text = item["text"]
+                                if text:
+                                    yield {"type": "content", "content": text}
+                    elif isinstance(content, str):
+                        yield {"type": "content", "content": content}
+        else:
+            logger.error(
+                "VL API error: status=%s, code=%s, message=%s",
+                response.status_code,
+                response.code,
+                response.message,
+            )
+            error_msg = response.message if self.debug_errors else "Upstream model error"
+            yield {"type": "error", "message": error_msg, "code": response.code}
 
-    def _emit_event(self, event: dict) -> str:
-        return json.dumps(event, ensure_ascii=True) + "\n"
+    def _usage_event(self, last_response) -> dict | None:
+        if last_response and hasattr(last_response, "usage") and last_response.usage:
+            usage = last_response.usage
+            input_tokens = getattr(usage, "input_tokens", 0)
+            output_tokens = getattr(usage, "output_tokens", 0)
+            details = _usage_details(usage)
+            cached_tokens = details.get("cached_tokens") or 0
+            event = {
+                "type": "usage",
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "cached_input_tokens": cached_tokens,
+                "uncached_input_tokens": max(0, input_tokens - cached_tokens),
+            }
+            if details.get("cache_creation_input_tokens"):
+                event["cache_creation_input_tokens"] = details["cache_creation_input_tokens"]
+            return event
+        return None
+
+    def _with_prefix_cache(self, messages: list, stable_context: bool = True) -> list:
+        """在可缓存前缀的末尾加显式缓存标记。
+
+        前缀是除最后一条用户消息外的全部消息：generate 模式为系统提示词，
+        chat 模式为系统提示词 + 当前 PRD + 固定确认回复。系统消息单独再标记一次，
+        这样 PRD 变化后仍能命中系统提示词部分的缓存。
 
-    def _stream_response(self, messages: list[Message]) -> Generator[str, None, None]:
-        """Common streaming logic with DashScope SDK.
+        Args:
+            stable_context: 为 False 时（PRD 每轮都会变化）只缓存系统提示词，
+                不为下一轮用不上的 PRD 创建缓存
+        """
+        if self.prompt_cache_mode != "explicit":
+            return messages
+        marked = list(messages)
+        for index in {0, len(marked) - 2} if stable_context else {0}:
+            if index >= 0:
+                message = marked[index]
+                if isinstance(message, Message):
+                    marked[index] = Message(role=message.role, content=_cache_marked(message.content))
+                else:
+                    marked[index] = {**message, "content": _cache_marked(message["content"])}
+        return marked
+
+    async def _astream_events(
+        self, messages: list[Message], model: str | None = None, thinking: bool | None = None
+    ) -> AsyncGenerator[dict, None]:
+        """文本模型的流式调用，基于 `dashscope.AioGeneration`。
+
+        整个流式过程都在事件循环上以非阻塞方式进行，不占用线程池。
+        产出未序列化的事件字典，由调用方决定编码为 NDJSON 还是直接聚合。
 
         Args:
             messages: 发送给 LLM 的消息列表
+            model: 覆盖默认文本模型（备用模型重试时使用）
+            thinking: 覆盖 ENABLE_THINKING
         """
+        last_response = None
         try:
-            responses = dashscope.Generation.call(
-                model=self.model,
-                messages=messages,
-                result_format="message",
-                stream=True,
-                incremental_output=True,
-                enable_thinking=self.enable_thinking,
-                timeout=300,
+            responses = await dashscope.AioGeneration.call(
+                **self._text_call_kwargs(messages, model, thinking),
+                session=await self._get_session(),
             )
+            _mark_connected()
+            async for response in responses:
+                last_response = response
+                for event in self._text_response_events(response):
+                    yield event
         except Exception as exc:
-            message = str(exc) if self.debug_errors else "Upstream model error"
-            yield self._emit_event({"type": "error", "message": message})
+            yield self._upstream_error_event(exc)
             return
 
-        last_response = None
+        usage_event = self._usage_event(last_response)
+        if usage_event:
+            yield usage_event
 
-        for response in responses:
-            last_response = response
-            if response.status_code == HTTPStatus.OK:
-                if response.output and response.output.choices:
-                    message = response.output.choices[0].message
-                    # Safely get reasoning_content - DashScope objects raise KeyError for missing attrs
-                    try:
-                        reasoning_content = message.reasoning_content
-                        if reasoning_content:
-                            yield self._emit_event({"type": "reasoning", "content": reasoning_content})
-                    except (KeyError, AttributeError):
-                        pass
-                    content = message.content
-                    if content:
-                        assert isinstance(content, str)
-                        yield self._emit_event({"type": "content", "content": content})
-            else:
-                error_msg = response.message if self.debug_errors else "Upstream model error"
-                yield self._emit_event({"type": "error", "message": error_msg, "code": response.code})
+    def _load_images(self, images: list[ImageAttachment] | None) -> list[ImageAttachment] | None:
+        """发送给 VL 模型前的图片处理：解析 image_id 引用，按配置缩放 / 重新编码。
 
-        if last_response and hasattr(last_response, "usage") and last_response.usage:
-            usage = last_response.usage
-            input_tokens = getattr(usage, "input_tokens", 0)
-            output_tokens = getattr(usage, "output_tokens", 0)
-            yield self._emit_event(
-                {
-                    "type": "usage",
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_tokens": input_tokens + output_tokens,
-                }
-            )
+        处理结果按图片内容哈希缓存，多轮对话重复附带的同一张图片不会重复读取和缩放。
+
+        Raises:
+            LookupError: 引用的图片已过期或不存在
+        """
+        if not images:
+            return images
+        loaded = []
+        for img in images:
+            if img.data is not None:
+                data, mime_type = self.image_processor.process_base64(img.data, img.mime_type)
+            else:
+                # image_id 即内容哈希，命中缓存时无需读取文件
+                processed = self.image_processor.get_cached(img.image_id)
+                if processed is None:
+                    stored = self.image_store.get(img.image_id)
+                    if stored is None:
+                        raise LookupError(f"Image {img.image_id} not found")
+                    raw = self.image_store.read_bytes(img.image_id)
+                    processed = self.image_processor.process(img.image_id, raw, stored.mime_type)
+                data, mime_type = processed
+            loaded.append(img.model_copy(update={"data": data, "mime_type": mime_type}))
+        return loaded
+
+    async def _aload_images(self, images: list[ImageAttachment] | None) -> list[ImageAttachment] | None:
+        if not images:
+            return images
+        # 读文件、缩放和 Base64 编码放到线程池，避免阻塞事件循环
+        with span("images.load", images=len(images)):
+            return await asyncio.to_thread(self._load_images, images)
 
     def _build_multimodal_content(
         self,
@@ -132,97 +383,55 @@ class LLMService:
         Returns:
             DashScope MultiModalConversation 格式的消息列表
         """
-        messages = [
-            {"role": "system", "content": [{"text": system_prompt}]},
-            {"role": "user", "content": self._build_multimodal_content(user_text, images)},
-        ]
+        with span("messages.build_multimodal", images=len(images or ()), image_chars=_image_chars(images)):
+            messages = [
+                {"role": "system", "content": [{"text": system_prompt}]},
+                {"role": "user", "content": self._build_multimodal_content(user_text, images)},
+            ]
         return messages
 
-    def _stream_multimodal_response(
+    async def _astream_multimodal_events(
         self,
         messages: list[dict],
-    ) -> Generator[str, None, None]:
-        """多模态 API 的流式响应处理。
+        model: str | None = None,
+        thinking: bool | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """多模态 API 的异步流式响应处理，基于 `dashscope.AioMultiModalConversation`。
 
         Args:
             messages: 多模态格式的消息列表
+            model: 覆盖默认 VL 模型（备用模型重试时使用）
+            thinking: 覆盖 ENABLE_THINKING
 
         Yields:
-            NDJSON 格式的事件字符串
+            事件字典
         """
+        last_response = None
         try:
-            responses = dashscope.MultiModalConversation.call(
-                model=self.vl_model,
-                messages=messages,
-                stream=True,
-                incremental_output=True,
-                enable_thinking=self.enable_thinking,
-                timeout=300,
+            responses = await dashscope.AioMultiModalConversation.call(
+                **self._multimodal_call_kwargs(messages, model, thinking),
+                session=await self._get_session(),
             )
+            _mark_connected()
+            async for response in responses:
+                last_response = response
+                for event in self._multimodal_response_events(response):
+                    yield event
         except Exception as exc:
-            message = str(exc) if self.debug_errors else "Upstream model error"
-            yield self._emit_event({"type": "error", "message": message})
+            yield self._upstream_error_event(exc)
             return
 
-        last_response = None
-
-        for response in responses:
-            last_response = response
-            if response.status_code == HTTPStatus.OK:
-                if response.output and response.output.choices:
-                    choice = response.output.choices[0]
-                    message = choice.message
-
-                    # 提取 reasoning_content（思考过程）
-                    try:
-                        reasoning_content = message.reasoning_content
-                        if reasoning_content:
-                            logger.info("VL model returned reasoning content: %d chars", len(reasoning_content))
-                            yield self._emit_event({"type": "reasoning", "content": reasoning_content})
-                        else:
-                            logger.warning("VL model returned empty reasoning_content")
-                    except (KeyError, AttributeError) as e:
-                        logger.warning("VL model does not have reasoning_content attribute: %s", e)
-
-                    # MultiModalConversation 返回的 content 可能是列表
-                    content = message.content
-                    if content:
-                        # 提取文本内容
-                        if isinstance(content, list):
-                            for item in content:
-                                if isinstance(item, dict) and "text" in item:
-                                    text = item["text"]
-                                    if text:
-                                        yield self._emit_event({"type": "content", "content": text})
-                        elif isinstance(content, str):
-                            yield self._emit_event({"type": "content", "content": content})
-            else:
-                logger.error(
-                    "VL API error: status=%s, code=%s, message=%s",
-                    response.status_code, response.code, response.message
-                )
-                error_msg = response.message if self.debug_errors else "Upstream model error"
-                yield self._emit_event({"type": "error", "message": error_msg, "code": response.code})
-
         # 发送 usage 信息
-        if last_response and hasattr(last_response, "usage") and last_response.usage:
-            usage = last_response.usage
-            input_tokens = getattr(usage, "input_tokens", 0)
-            output_tokens = getattr(usage, "output_tokens", 0)
-            yield self._emit_event(
-                {
-                    "type": "usage",
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_tokens": input_tokens + output_tokens,
-                }
-            )
+        usage_event = self._usage_event(last_response)
+        if usage_event:
+            yield usage_event
 
     def _build_chat_messages(
         self,
         system_prompt: str,
         current_prd: str,
         user_message: str,
+        pruned: bool = False,
     ) -> list[Message]:
         """
         简化的消息列表构建：
@@ -233,18 +442,43 @@ class LLMService:
         """
         messages: list[Message] = [
             Message(role="system", content=system_prompt),
-            Message(role="user", content=f"## 当前 PRD\n\n{current_prd}"),
-            Message(role="assistant", content="好的，我已了解当前 PRD 内容，请告诉我你的想法或问题。"),
+            Message(role="user", content=self._prd_message(current_prd, pruned)),
+            Message(role="assistant", content=PRD_ACK),
             Message(role="user", content=user_message),
         ]
         return messages
 
+    @staticmethod
+    def _prd_message(current_prd: str, pruned: bool = False) -> str:
+        # 去掉首尾空白，客户端回传的同一份 PRD 末尾换行不同也能命中前缀缓存
+        if pruned:
+            return f"## 当前 PRD（{PRUNED_NOTE}）\n\n{current_prd.strip()}"
+        return f"## 当前 PRD\n\n{current_prd.strip()}"
+
+    def _prune_prd(self, current_prd: str, user_message: str) -> PrunedPrd | None:
+        """补丁模式下按相关性裁剪 PRD，见 `PrdIndex`；未启用或不需要裁剪时返回 None。"""
+        if self.prd_index is None:
+            return None
+        with span("prd.prune", chars=len(current_prd)) as prune_span:
+            pruned = self.prd_index.prune(current_prd, user_message)
+            if prune_span is not None:
+                prune_span.set(pruned_chars=len(pruned.text) if pruned else None)
+        if pruned is not None:
+            logger.info(
+                "chat context pruned: %d -> %d chars, sections=%s",
+                pruned.original_chars,
+                len(pruned.text),
+                pruned.selected,
+            )
+        return pruned
+
     def _build_multimodal_chat_messages(
         self,
         system_prompt: str,
         current_prd: str,
         user_message: str,
         images: list[ImageAttachment],
+        pruned: bool = False,
     ) -> list[dict]:
         """构建多模态 Chat 模式的消息列表。
 
@@ -263,27 +497,24 @@ class LLMService:
         Returns:
             DashScope MultiModalConversation 格式的消息列表
         """
-        messages: list[dict] = [
-            {"role": "system", "content": [{"text": system_prompt}]},
-            {"role": "user", "content": [{"text": f"## 当前 PRD\n\n{current_prd}"}]},
-            {"role": "assistant", "content": [{"text": "好的，我已了解当前 PRD 内容，请告诉我你的想法或问题。"}]},
-            {"role": "user", "content": self._build_multimodal_content(user_message, images)},
-        ]
+        with span("messages.build_multimodal", images=len(images), image_chars=_image_chars(images)):
+            messages: list[dict] = [
+                {"role": "system", "content": [{"text": system_prompt}]},
+                {"role": "user", "content": [{"text": self._prd_message(current_prd, pruned)}]},
+                {"role": "assistant", "content": [{"text": PRD_ACK}]},
+                {"role": "user", "content": self._build_multimodal_content(user_message, images)},
+            ]
         return messages
 
-    def generate_stream(
+    def _prepare_generate(
         self,
         user_description: str,
         images: list[ImageAttachment] | None = None,
-    ) -> Generator[str, None, None]:
-        """Generate a new PRD from scratch.
-
-        Args:
-            user_description: 用户的功能描述
-            images: 可选的图片附件列表
+    ) -> tuple[list, bool]:
+        """构建 generate 模式的消息列表。
 
-        Yields:
-            NDJSON 格式的事件字符串
+        Returns:
+            (messages, is_multimodal)，有图片时使用多模态格式
         """
         system_prompt = self.prompt_loader.load_prompt()
 
@@ -292,7 +523,7 @@ class LLMService:
             # Log multi-image request details for debugging
             total_size = sum(img.size or 0 for img in images)
             logger.info(
-                "generate_stream with images: count=%d, total_size=%.2fMB, model=%s",
+                "generate with images: count=%d, total_size=%.2fMB, model=%s",
                 len(images),
                 total_size / (1024 * 1024),
                 self.vl_model,
@@ -302,37 +533,44 @@ class LLMService:
                 user_text=user_description,
                 images=images,
             )
-            yield from self._stream_multimodal_response(messages)
-        else:
-            # 无图片时保持原有逻辑（向后兼容）
-            messages: list[Message] = [
-                Message(role="system", content=system_prompt),
-                Message(role="user", content=user_description),
-            ]
-            yield from self._stream_response(messages)
+            return self._with_prefix_cache(messages), True
 
-    def chat_stream(
+        # 无图片时保持原有逻辑（向后兼容）
+        messages: list[Message] = [
+            Message(role="system", content=system_prompt),
+            Message(role="user", content=user_description),
+        ]
+        return self._with_prefix_cache(messages), False
+
+    def _prepare_chat(
         self,
         current_prd: str,
         user_message: str,
         images: list[ImageAttachment] | None = None,
-    ) -> Generator[str, None, None]:
-        """
-        基于现有 PRD 进行修改，总是输出完整的新版 PRD。
+        patch: bool = False,
+        pruned: bool = False,
+    ) -> tuple[list, bool]:
+        """构建 chat 模式的消息列表。
 
         Args:
-            current_prd: 当前 PRD 内容
-            user_message: 用户消息
-            images: 可选的图片附件列表
+            patch: 使用补丁输出提示词（只输出改动的章节）
+            pruned: current_prd 是裁剪后的上下文（不相关章节只保留标题）
+
+        Returns:
+            (messages, is_multimodal)，有图片时使用多模态格式
         """
-        system_prompt = self.chat_prompt_loader.load_prompt()
+        loader = self.chat_patch_prompt_loader if patch else self.chat_prompt_loader
+        system_prompt = loader.load_prompt()
+        # full 模式每轮都输出新版 PRD，下一轮的 PRD 必然不同；裁剪后的 PRD 随消息变化。
+        # 只有补丁模式下未裁剪的 PRD 在小改动之间保持不变，值得缓存
+        stable_context = patch and not pruned
 
         # 如果有图片，使用多模态 API
         if images:
             # Log multi-image request details for debugging
             total_size = sum(img.size or 0 for img in images)
             logger.info(
-                "chat_stream with images: count=%d, total_size=%.2fMB, model=%s",
+                "chat with images: count=%d, total_size=%.2fMB, model=%s",
                 len(images),
                 total_size / (1024 * 1024),
                 self.vl_model,
@@ -342,13 +580,226 @@ class LLMService:
                 current_prd=current_prd,
                 user_message=user_message,
                 images=images,
+                pruned=pruned,
             )
-            yield from self._stream_multimodal_response(messages)
-        else:
-            # 无图片时使用标准 API
-            messages = self._build_chat_messages(
-                system_prompt=system_prompt,
-                current_prd=current_prd,
-                user_message=user_message,
+            return self._with_prefix_cache(messages, stable_context=stable_context), True
+
+        # 无图片时使用标准 API
+        messages = self._build_chat_messages(
+            system_prompt=system_prompt,
+            current_prd=current_prd,
+            user_message=user_message,
+            pruned=pruned,
+        )
+        return self._with_prefix_cache(messages, stable_context=stable_context), False
+
+    async def agenerate_events(
+        self,
+        user_description: str,
+        images: list[ImageAttachment] | None = None,
+        session_id: str | None = None,
+        generation_mode: str | None = None,
+        slot: Callable[[], AbstractAsyncContextManager] | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """异步生成新 PRD，产出事件字典。
+
+        Args:
+            user_description: 用户的功能描述
+            images: 可选的图片附件列表
+            session_id: 可选的会话 ID，生成结果会保存到会话存储
+            generation_mode: sequential=一次上游调用顺序生成；parallel=先生成大纲，
+                再并发生成各章节，见 `ParallelGenerator`。默认取 GENERATION_MODE
+            slot: parallel 模式下每个章节调用占用的准入名额（见 `SlotPool`）
+
+        Yields:
+            事件字典（content / reasoning / usage / error / session）
+        """
+        parallel = (generation_mode or self.generation_mode) == "parallel"
+        key = build_request_key(
+            description=user_description,
+            images=images,
+            model=self.vl_model if images else self.model,
+            enable_thinking=self.enable_thinking,
+            prompt_version=self.prompt_loader.version,
+            mode="generate-parallel" if parallel else "generate",
+        )
+
+        def start_generation() -> AsyncIterator[dict]:
+            if parallel:
+                stream = self._agenerate_parallel_events(user_description, images, slot)
+            else:
+                stream = self._agenerate_upstream_events(user_description, images)
+            if self.response_cache is None:
+                return stream
+            return self.response_cache.wrap(key, stream)
+
+        # 相同请求并发到达时只驱动一次上游生成，其余调用方订阅同一事件流
+        async for event in self._with_session(self.inflight.subscribe(key, start_generation), session_id, images):
+            yield event
+
+    def _with_session(
+        self,
+        events: AsyncIterator[dict],
+        session_id: str | None,
+        images: list[ImageAttachment] | None,
+    ) -> AsyncIterator[dict]:
+        if not session_id or self.session_store is None:
+            return events
+        return self.session_store.wrap(session_id, events, images)
+
+    async def _agenerate_upstream_events(
+        self,
+        user_description: str,
+        images: list[ImageAttachment] | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        try:
+            images = await self._aload_images(images)
+        except LookupError:
+            yield {"type": "error", "message": "Image expired or not found, please upload it again"}
+            return
+        messages, multimodal = self._prepare_generate(user_description, images)
+        async for event in self._aupstream_events(messages, multimodal, "generate"):
+            yield event
+
+    async def _agenerate_parallel_events(
+        self,
+        user_description: str,
+        images: list[ImageAttachment] | None = None,
+        slot: Callable[[], AbstractAsyncContextManager] | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        try:
+            images = await self._aload_images(images)
+        except LookupError:
+            yield {"type": "error", "message": "Image expired or not found, please upload it again"}
+            return
+        system_prompt = self.prompt_loader.load_prompt()
+
+        def outline_call() -> AsyncIterator[dict]:
+            user_text = f"{user_description}\n\n{OUTLINE_INSTRUCTION}"
+            messages, multimodal = self._generate_turns(system_prompt, user_text, images, [])
+            return self._aupstream_events(messages, multimodal, "generate_outline")
+
+        def section_call(outline: Outline, index: int) -> AsyncIterator[dict]:
+            # 各章节调用共享 系统提示词 + 描述 + 大纲 前缀，只有最后一条指令不同。
+            # 图片内容已由大纲调用写进大纲，章节调用只发文本；章节的思考过程不输出，关闭思考
+            turns = [("assistant", outline.render()), ("user", outline.section_instruction(index))]
+            messages, multimodal = self._generate_turns(system_prompt, user_description, None, turns)
+            return self._aupstream_events(messages, multimodal, "generate_section", thinking=False)
+
+        def sequential_call() -> AsyncIterator[dict]:
+            messages, multimodal = self._prepare_generate(user_description, images)
+            return self._aupstream_events(messages, multimodal, "generate")
+
+        async for event in self.parallel_generator.stream(outline_call, section_call, sequential_call, slot):
+            yield event
+
+    def _generate_turns(
+        self,
+        system_prompt: str,
+        user_text: str,
+        images: list[ImageAttachment] | None,
+        turns: list[tuple[str, str]],
+    ) -> tuple[list, bool]:
+        """generate 模式的消息列表，后面追加若干轮 (role, text) 对话。"""
+        if images:
+            messages = self._build_multimodal_messages(system_prompt, user_text, images)
+            messages.extend({"role": role, "content": [{"text": text}]} for role, text in turns)
+            return self._with_prefix_cache(messages), True
+        messages = [
+            Message(role="system", content=system_prompt),
+            Message(role="user", content=user_text),
+            *(Message(role=role, content=text) for role, text in turns),
+        ]
+        return self._with_prefix_cache(messages), False
+
+    async def achat_events(
+        self,
+        current_prd: str,
+        user_message: str,
+        images: list[ImageAttachment] | None = None,
+        edit_mode: str | None = None,
+        session_id: str | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """异步修改现有 PRD，产出事件字典。
+
+        Args:
+            current_prd: 当前 PRD 内容
+            user_message: 用户消息
+            images: 可选的图片附件列表
+            edit_mode: full=模型输出完整新版 PRD；patch=模型只输出章节补丁，
+                由服务端合并后输出 patch 事件和完整 PRD。默认取 CHAT_EDIT_MODE
+            session_id: 可选的会话 ID，修改后的 PRD 会保存到会话存储
+        """
+        patch = (edit_mode or self.chat_edit_mode) == "patch"
+        loader = self.chat_patch_prompt_loader if patch else self.chat_prompt_loader
+        key = build_request_key(
+            description=user_message,
+            images=images,
+            model=self.vl_model if images else self.model,
+            enable_thinking=self.enable_thinking,
+            prompt_version=loader.version,
+            mode="chat-patch" if patch else "chat",
+            current_prd=current_prd,
+        )
+
+        def start_generation() -> AsyncIterator[dict]:
+            # 只在补丁模式裁剪：合并基于完整 PRD，完整输出模式下模型需要看到全文
+            pruned = self._prune_prd(current_prd, user_message) if patch else None
+            context = pruned.text if pruned is not None else current_prd
+            stream = self._achat_upstream_events(context, user_message, images, patch, pruned is not None)
+            if patch:
+                return apply_patch_events(
+                    stream,
+                    current_prd,
+                    allow_full_document=pruned is None,
+                    protected=pruned.protected if pruned is not None else (),
+                )
+            return stream
+
+        async for event in self._with_session(self.inflight.subscribe(key, start_generation), session_id, images):
+            yield event
+
+    async def _achat_upstream_events(
+        self,
+        current_prd: str,
+        user_message: str,
+        images: list[ImageAttachment] | None = None,
+        patch: bool = False,
+        pruned: bool = False,
+    ) -> AsyncGenerator[dict, None]:
+        try:
+            images = await self._aload_images(images)
+        except LookupError:
+            yield {"type": "error", "message": "Image expired or not found, please upload it again"}
+            return
+        messages, multimodal = self._prepare_chat(current_prd, user_message, images, patch, pruned)
+        async for event in self._aupstream_events(messages, multimodal, "chat_patch" if patch else "chat"):
+            yield event
+
+    def _aupstream_events(
+        self, messages: list, multimodal: bool, mode: str = "generate", thinking: bool | None = None
+    ) -> AsyncIterator[dict]:
+        """带重试、对冲请求和备用模型切换的上游调用，见 `ResilientUpstream`。
+
+        Args:
+            mode: 指标标签（generate / chat / chat_patch）
+            thinking: 覆盖 ENABLE_THINKING
+        """
+        if multimodal:
+            return self.upstream.stream(
+                [self.vl_model, *self.vl_fallback_models],
+                lambda model: self._observe(
+                    self._astream_multimodal_events(messages, model, thinking), mode, model, "multimodal"
+                ),
             )
-            yield from self._stream_response(messages)
+        return self.upstream.stream(
+            [self.model, *self.fallback_models],
+            lambda model: self._observe(self._astream_events(messages, model, thinking), mode, model, "text"),
+        )
+
+    def _observe(self, events: AsyncIterator[dict], mode: str, model: str, kind: str) -> AsyncIterator[dict]:
+        # 每次上游尝试（含重试、对冲和备用模型）单独计入指标和 trace
+        events = trace_stream(events, "upstream.call", mode=mode, model=model, kind=kind)
+        if self.metrics is None:
+            return events
+        return self.metrics.observe(events, mode, model, kind)
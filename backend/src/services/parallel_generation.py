@@ -0,0 +1,218 @@
+"""Outline-first PRD generation with the sections filled in concurrently.
+
+A first upstream call returns only the outline (title, ``##`` sections and a
+one-line brief per section). Each section is then generated by its own
+upstream call that sees the same system prompt, description and outline, and
+the section streams are reassembled in document order: section N is streamed
+live while it is the earliest unfinished one, later sections are buffered until
+then. End-to-end latency for long PRDs drops to roughly outline + the slowest
+``ceil(sections / parallelism)`` sections.
+"""
+
+import contextlib
+import functools
+import logging
+import os
+import re
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
+from contextlib import AbstractAsyncContextManager
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from src.services.fan_out import fan_out
+
+logger = logging.getLogger("uvicorn.error")
+
+OUTLINE_INSTRUCTION = (
+    "先不要撰写正文。按输出模板列出这份 PRD 的大纲：第一行是文档标题（# [功能名称] PRD），"
+    "之后每个二级章节一行（## 编号. 章节名），每个章节标题下用一行以“- ”开头的要点写明该章节要覆盖的内容"
+    "（不超过 60 字，涉及的用户故事、子功能、场景名称要写全）。不适用的章节不要列出。只输出大纲。"
+)
+
+_TITLE_RE = re.compile(r"^#\s+(.+?)\s*$")
+_SECTION_RE = re.compile(r"^##\s+(.+?)\s*$")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+
+_USAGE_FIELDS = ("input_tokens", "output_tokens", "total_tokens", "cached_input_tokens", "uncached_input_tokens")
+
+
+@dataclass
+class OutlineSection:
+    heading: str
+    notes: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Outline:
+    title: str | None
+    sections: list[OutlineSection]
+
+    def render(self) -> str:
+        """规范化后的大纲文本，作为各章节调用共享的 assistant 消息（逐字节稳定，便于前缀缓存）。"""
+        lines = [self.title] if self.title else []
+        for section in self.sections:
+            lines.append(section.heading)
+            lines.extend(section.notes)
+        return "\n".join(lines)
+
+    def section_instruction(self, index: int) -> str:
+        heading = self.sections[index].heading
+        scope = f"「{heading}」章节的完整内容：从这一行标题开始，到下一个章节标题之前停止"
+        if index == 0:
+            scope = f"文档开头（{self.title or '文档标题'}及版本信息行）和{scope}"
+        return f"按上面的大纲撰写 PRD。本次只输出{scope}，不要输出其他章节，也不要输出任何说明。"
+
+
+def parse_outline(text: str) -> Outline:
+    """解析大纲调用的输出：一级标题、二级章节标题及其下的要点行。"""
+    title: str | None = None
+    sections: list[OutlineSection] = []
+    for raw in text.split("\n"):
+        line = raw.rstrip()
+        if _FENCE_RE.match(line):
+            # 模型有时把大纲包在代码块里，围栏本身忽略
+            continue
+        if not line.strip():
+            continue
+        if _SECTION_RE.match(line):
+            sections.append(OutlineSection(heading=line.strip()))
+        elif _TITLE_RE.match(line):
+            if title is None and not sections:
+                title = line.strip()
+        elif sections and not line.lstrip().startswith("#"):
+            sections[-1].notes.append(line.strip())
+    return Outline(title=title, sections=sections)
+
+
+def _add_usage(total: dict | None, event: dict) -> dict:
+    total = total or {"type": "usage"}
+    for name in _USAGE_FIELDS:
+        if name in event:
+            total[name] = total.get(name, 0) + (event[name] or 0)
+    return total
+
+
+class ParallelGenerator:
+    """Orchestrates outline-first generation; the upstream calls are supplied by the caller.
+
+    Reasoning is forwarded from the outline call only (interleaving the thinking
+    of several sections would be unreadable); content is forwarded in document
+    order. The usage of all calls is summed into one usage event at the end.
+    Any error stops the remaining sections.
+
+    Configuration (env):
+        PARALLEL_SECTIONS: sections generated at once per request (default 4)
+        PARALLEL_MIN_SECTIONS: outlines with fewer sections fall back to one sequential call (default 3)
+    """
+
+    def __init__(self, max_parallel: int | None = None, min_sections: int | None = None):
+        if max_parallel is None:
+            max_parallel = int(os.getenv("PARALLEL_SECTIONS", "4"))
+        if min_sections is None:
+            min_sections = int(os.getenv("PARALLEL_MIN_SECTIONS", "3"))
+        self.max_parallel = max(1, max_parallel)
+        self.min_sections = max(1, min_sections)
+
+    async def stream(
+        self,
+        outline_call: Callable[[], AsyncIterator[dict]],
+        section_call: Callable[[Outline, int], AsyncIterator[dict]],
+        sequential_call: Callable[[], AsyncIterator[dict]],
+        slot: Callable[[], AbstractAsyncContextManager] | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """先生成大纲，再并发生成各章节并按顺序输出。
+
+        Args:
+            outline_call: 发起大纲调用
+            section_call: 发起第 index 个章节的调用
+            sequential_call: 大纲不可用（解析失败或章节太少）时的整篇顺序生成
+            slot: 每个章节调用执行期间占用的准入名额（见 ``SlotPool``）
+        """
+        usage: dict | None = None
+        parts: list[str] = []
+        async for event in outline_call():
+            event_type = event.get("type")
+            if event_type == "content":
+                parts.append(event["content"])
+            elif event_type == "usage":
+                usage = _add_usage(usage, event)
+            else:
+                # reasoning / error 直接转发；大纲内容不输出给客户端
+                yield event
+                if event_type == "error":
+                    return
+
+        outline = parse_outline("".join(parts))
+        if len(outline.sections) < self.min_sections:
+            logger.info("outline has %d sections, falling back to sequential generation", len(outline.sections))
+            async for event in sequential_call():
+                if event.get("type") == "usage":
+                    usage = _add_usage(usage, event)
+                    continue
+                yield event
+            if usage is not None:
+                yield usage
+            return
+
+        logger.info("parallel generation: sections=%d, parallelism=%d", len(outline.sections), self.max_parallel)
+        async for event in self._sections(outline, section_call, slot):
+            if event.get("type") == "usage":
+                usage = _add_usage(usage, event)
+                continue
+            yield event
+            if event.get("type") == "error":
+                return
+        if usage is not None:
+            yield usage
+
+    async def _sections(
+        self,
+        outline: Outline,
+        section_call: Callable[[Outline, int], AsyncIterator[dict]],
+        slot: Callable[[], AbstractAsyncContextManager] | None,
+    ) -> AsyncGenerator[dict, None]:
+        count = len(outline.sections)
+        starts = [functools.partial(section_call, outline, index) for index in range(count)]
+        buffers: list[list[dict]] = [[] for _ in range(count)]
+        done = [False] * count
+        started: set[int] = set()
+        current = 0
+
+        def separated(event: dict, position: int) -> dict:
+            # 每个章节的第一段内容前加空行，与上一章节分隔
+            if event.get("type") != "content" or position in started:
+                return event
+            started.add(position)
+            return event if position == 0 else {**event, "content": "\n\n" + event["content"]}
+
+        # 提前返回时关闭 fan_out，取消仍在生成的章节
+        events = fan_out(starts, self.max_parallel, slot, label="section generation")
+        async with contextlib.aclosing(events):
+            async for index, event in events:
+                if event is None:
+                    done[index] = True
+                elif event.get("type") == "error":
+                    # 任一章节失败即结束整个生成
+                    yield event
+                    return
+                elif event.get("type") == "reasoning":
+                    continue
+                elif index == current:
+                    yield separated(event, index)
+                    continue
+                else:
+                    buffers[index].append(event)
+                    continue
+                # 当前章节完成：依次输出已缓冲的后续章节，直到遇到仍在生成的章节
+                while current < count and done[current]:
+                    current += 1
+                    if current < count:
+                        for buffered in buffers[current]:
+                            yield separated(buffered, current)
+                        buffers[current] = []
+
+
+@lru_cache
+def get_parallel_generator() -> ParallelGenerator:
+    """Process-wide parallel generator configured from the environment."""
+    return ParallelGenerator()
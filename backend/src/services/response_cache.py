@@ -0,0 +1,198 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator
+from functools import lru_cache
+from typing import Protocol
+
+from src.core.shared_state import SharedState, get_shared_state
+from src.models.schemas import ImageAttachment
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def build_request_key(
+    *,
+    description: str,
+    model: str,
+    enable_thinking: bool,
+    prompt_version: str,
+    images: list[ImageAttachment] | None = None,
+    mode: str = "generate",
+    current_prd: str | None = None,
+) -> str:
+    """生成请求指纹：规范化描述 + 图片内容哈希 + 模型 + 思考开关 + 提示词版本。
+
+    chat 模式额外包含当前 PRD 的哈希。
+    """
+    normalized = " ".join(description.split())
+    # image_id 本身就是图片内容的 sha256；内联图片同样按解码后的字节计算，与上传的同一张图片指纹相同
+    image_hashes = [img.image_id or hashlib.sha256(base64.b64decode(img.data)).hexdigest() for img in images or []]
+    prd_hash = hashlib.sha256(current_prd.encode("utf-8")).hexdigest() if current_prd is not None else None
+    payload = json.dumps(
+        [mode, normalized, image_hashes, model, enable_thinking, prompt_version, prd_hash],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheBackend(Protocol):
+    def get(self, key: str) -> list[dict] | None: ...
+
+    def set(self, key: str, events: list[dict]) -> None: ...
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache with per-entry TTL."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> list[dict] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, events = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return events
+
+    def set(self, key: str, events: list[dict]) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, events)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """Local SQLite cache, survives restarts; LRU by last access, TTL by creation time."""
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, events TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> list[dict] | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT events, created_at FROM response_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl <= now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, events: list[dict]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, events, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(events, ensure_ascii=False), now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+
+class SharedStateCacheBackend:
+    """Cache in the SHARED_STATE backend: one hit rate across all workers; bounded by TTL only."""
+
+    def __init__(self, state: SharedState, ttl: float):
+        self.state = state
+        self.ttl = ttl
+
+    def get(self, key: str) -> list[dict] | None:
+        value = self.state.get(f"response_cache:{key}")
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, events: list[dict]) -> None:
+        self.state.set(f"response_cache:{key}", json.dumps(events, ensure_ascii=False), self.ttl)
+
+
+class ResponseCache:
+    """Caches the complete event stream of successful generations and replays it on repeat requests."""
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    async def get(self, key: str) -> list[dict] | None:
+        return await asyncio.to_thread(self.backend.get, key)
+
+    async def set(self, key: str, events: list[dict]) -> None:
+        await asyncio.to_thread(self.backend.set, key, events)
+
+    async def wrap(self, key: str, events: AsyncIterator[dict]) -> AsyncGenerator[dict, None]:
+        """命中时全速回放缓存事件；未命中时透传上游事件，完整且无错误的结果写入缓存。"""
+        cached = await self.get(key)
+        if cached is not None:
+            logger.info("response cache hit key=%s events=%d", key[:12], len(cached))
+            for event in cached:
+                if event.get("type") == "usage":
+                    event = {**event, "cached": True}
+                yield event
+            return
+
+        recorded: list[dict] = []
+        failed = False
+        async for event in events:
+            if event.get("type") == "error":
+                failed = True
+            recorded.append(event)
+            yield event
+
+        has_content = any(event.get("type") == "content" for event in recorded)
+        if not failed and has_content:
+            await self.set(key, recorded)
+
+
+@lru_cache
+def get_response_cache() -> ResponseCache | None:
+    """Opt-in cache configured by RESPONSE_CACHE=memory|sqlite|shared; None when disabled."""
+    backend_name = os.getenv("RESPONSE_CACHE", "").lower()
+    if not backend_name or backend_name in ("0", "false", "off", "none"):
+        return None
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+    if backend_name == "memory":
+        backend = MemoryCacheBackend(max_entries=max_entries, ttl=ttl)
+    elif backend_name == "sqlite":
+        path = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+        backend = SQLiteCacheBackend(path, max_entries=max_entries, ttl=ttl)
+    elif backend_name == "shared":
+        backend = SharedStateCacheBackend(get_shared_state(), ttl=ttl)
+    else:
+        raise ValueError(f"Unsupported RESPONSE_CACHE backend: {backend_name}")
+    logger.info("Response cache enabled: backend=%s, ttl=%ss, max_entries=%d", backend_name, ttl, max_entries)
+    return ResponseCache(backend)
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import uuid
+from collections.abc import AsyncGenerator, AsyncIterator
+from functools import lru_cache
+
+from src.services.inflight import Flight
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class ResumableStream(Flight):
+    """Event stream of one streaming request, numbered and kept in a bounded replay buffer.
+
+    Event ``id`` n is position n - 1 of the underlying ``Flight``.
+    """
+
+    def __init__(self, generation_id: str, max_events: int):
+        super().__init__(generation_id, max_events)
+        self.abort_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def generation_id(self) -> str:
+        return self.key
+
+    def can_resume(self, last_event_id: int) -> bool:
+        return last_event_id >= self.dropped
+
+    def publish(self, event: dict) -> None:
+        super().publish({**event, "id": self.published + 1})
+
+
+class ResumableStreams:
+    """Runs streaming generations in the background so a dropped client can reconnect and resume.
+
+    Each event gets a monotonically increasing ``id`` and the stream opens with a
+    ``generation`` event carrying the ``generation_id``. When the last client
+    disconnects the generation keeps running for ``grace`` seconds; if nobody
+    resumes within that window it is cancelled (which aborts the upstream call).
+    Finished streams stay resumable for another ``grace`` seconds.
+
+    The registry lives in the worker process that runs the generation; the
+    replay buffer is not shared through ``SHARED_STATE``. With several workers
+    the load balancer must route a client's requests to the same worker
+    (sticky sessions, e.g. nginx ``ip_hash``), otherwise a resume that lands
+    on another worker gets 404.
+
+    Configuration (env):
+        STREAM_RESUME_GRACE: seconds to wait for a reconnect (default 0: abort on disconnect, resuming disabled)
+        STREAM_REPLAY_MAX_EVENTS: events kept per generation for replay (default 10000)
+    """
+
+    def __init__(self, grace: float | None = None, max_events: int | None = None):
+        if grace is None:
+            # 默认断开即中止：前端的“停止”就是断开连接，保留生成只会继续占用上游和准入名额
+            grace = float(os.getenv("STREAM_RESUME_GRACE", "0"))
+        if max_events is None:
+            max_events = int(os.getenv("STREAM_REPLAY_MAX_EVENTS", "10000"))
+        self.grace = grace
+        self.max_events = max_events
+        self._streams: dict[str, ResumableStream] = {}
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def get(self, generation_id: str) -> ResumableStream | None:
+        return self._streams.get(generation_id)
+
+    def start(self, events: AsyncIterator[dict]) -> ResumableStream:
+        stream = ResumableStream(uuid.uuid4().hex, self.max_events)
+        self._streams[stream.generation_id] = stream
+        stream.publish({"type": "generation", "generation_id": stream.generation_id})
+        stream.task = asyncio.create_task(self._drive(stream, events))
+        return stream
+
+    async def subscribe(self, stream: ResumableStream, last_event_id: int = 0) -> AsyncGenerator[dict, None]:
+        if stream.abort_handle is not None:
+            stream.abort_handle.cancel()
+            stream.abort_handle = None
+            logger.info("client resumed generation=%s from id=%d", stream.generation_id, last_event_id)
+        stream.subscribers += 1
+        try:
+            async for event in stream.follow(last_event_id):
+                yield event
+        finally:
+            stream.subscribers -= 1
+            if stream.subscribers == 0 and not stream.done:
+                self._schedule_abort(stream)
+
+    def _schedule_abort(self, stream: ResumableStream) -> None:
+        if self.grace <= 0:
+            self._abort(stream)
+            return
+        # 客户端断开：保留上游生成一段时间，等待客户端带 last_event_id 重连
+        loop = asyncio.get_running_loop()
+        stream.abort_handle = loop.call_later(self.grace, self._abort, stream)
+
+    def _abort(self, stream: ResumableStream) -> None:
+        stream.abort_handle = None
+        if stream.subscribers == 0 and stream.task is not None and not stream.task.done():
+            logger.info("no client resumed generation=%s, cancelling", stream.generation_id)
+            stream.task.cancel()
+
+    async def _drive(self, stream: ResumableStream, events: AsyncIterator[dict]) -> None:
+        try:
+            async for event in events:
+                stream.publish(event)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("streaming generation failed generation=%s", stream.generation_id)
+            stream.publish({"type": "error", "message": "Upstream model error"})
+        finally:
+            stream.finish()
+            self._retire(stream)
+
+    def _retire(self, stream: ResumableStream) -> None:
+        if self.grace <= 0:
+            self._streams.pop(stream.generation_id, None)
+            return
+        # 结束后仍保留一段时间，供最后一段没收到的客户端补取
+        asyncio.get_running_loop().call_later(self.grace, self._streams.pop, stream.generation_id, None)
+
+
+@lru_cache
+def get_resumable_streams() -> ResumableStreams:
+    """Process-wide registry of resumable streaming generations."""
+    return ResumableStreams()
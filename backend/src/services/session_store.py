@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Protocol
+
+from src.core.shared_state import SharedState, get_shared_state
+from src.models.schemas import ImageAttachment
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def prd_etag(prd: str) -> str:
+    """PRD 内容的短哈希，客户端用它引用服务端保存的版本。"""
+    return hashlib.sha256(prd.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class SessionRecord:
+    """Latest PRD version of a session plus the image attachments it was built from."""
+
+    prd: str
+    etag: str
+    images: list[dict] = field(default_factory=list)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def size(self) -> int:
+        return len(self.prd.encode("utf-8")) + sum(len(image.get("data") or "") for image in self.images)
+
+    def image_attachments(self) -> list[ImageAttachment]:
+        # 入库前已经校验过，回放时跳过 Pydantic 校验；上传的图片只保存 image_id 引用
+        return [ImageAttachment.model_construct(**image) for image in self.images]
+
+
+class SessionBackend(Protocol):
+    def get(self, session_id: str) -> SessionRecord | None: ...
+
+    def set(self, session_id: str, record: SessionRecord) -> None: ...
+
+    def delete(self, session_id: str) -> bool: ...
+
+
+class MemorySessionBackend:
+    """In-process LRU bounded by the total size of stored PRDs and images."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, SessionRecord] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, session_id: str) -> SessionRecord | None:
+        with self._lock:
+            record = self._entries.get(session_id)
+            if record is None:
+                return None
+            if record.updated_at + self.ttl <= time.time():
+                self._remove(session_id)
+                return None
+            self._entries.move_to_end(session_id)
+            return record
+
+    def set(self, session_id: str, record: SessionRecord) -> None:
+        size = record.size
+        with self._lock:
+            self._remove(session_id)
+            if size > self.max_bytes:
+                logger.warning("session %s too large to store (%d bytes)", session_id, size)
+                return
+            self._entries[session_id] = record
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._remove(session_id)
+
+    def _remove(self, session_id: str) -> bool:
+        record = self._entries.pop(session_id, None)
+        if record is None:
+            return False
+        self._total_bytes -= record.size
+        return True
+
+
+class SQLiteSessionBackend:
+    """Local SQLite session store, survives restarts; LRU by last access, bounded by total size."""
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, prd TEXT NOT NULL, etag TEXT NOT NULL, images TEXT NOT NULL, "
+            "size INTEGER NOT NULL, updated_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, session_id: str) -> SessionRecord | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT prd, etag, images, updated_at FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[3] + self.ttl <= now:
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE sessions SET accessed_at = ? WHERE session_id = ?", (now, session_id))
+            self._conn.commit()
+        return SessionRecord(prd=row[0], etag=row[1], images=json.loads(row[2]), updated_at=row[3])
+
+    def set(self, session_id: str, record: SessionRecord) -> None:
+        size = record.size
+        if size > self.max_bytes:
+            logger.warning("session %s too large to store (%d bytes)", session_id, size)
+            self.delete(session_id)
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, prd, etag, images, size, updated_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, record.prd, record.etag, json.dumps(record.images), size, record.updated_at, now),
+            )
+            # 按最近访问时间从新到旧累计大小，超出上限的旧会话被淘汰
+            self._conn.execute(
+                "DELETE FROM sessions WHERE session_id IN ("
+                "SELECT session_id FROM (SELECT session_id, SUM(size) OVER (ORDER BY accessed_at DESC) AS running "
+                "FROM sessions) WHERE running > ?)",
+                (self.max_bytes,),
+            )
+            self._conn.commit()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+
+class SharedStateSessionBackend:
+    """Sessions in the SHARED_STATE backend, so follow-up turns may land on any worker; bounded by TTL."""
+
+    def __init__(self, state: SharedState, max_bytes: int, ttl: float):
+        self.state = state
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def get(self, session_id: str) -> SessionRecord | None:
+        value = self.state.get(f"session:{session_id}")
+        return SessionRecord(**json.loads(value)) if value is not None else None
+
+    def set(self, session_id: str, record: SessionRecord) -> None:
+        if record.size > self.max_bytes:
+            logger.warning("session %s too large to store (%d bytes)", session_id, record.size)
+            self.delete(session_id)
+            return
+        value = json.dumps(
+            {"prd": record.prd, "etag": record.etag, "images": record.images, "updated_at": record.updated_at},
+            ensure_ascii=False,
+        )
+        self.state.set(f"session:{session_id}", value, max(0.001, record.updated_at + self.ttl - time.time()))
+
+    def delete(self, session_id: str) -> bool:
+        return self.state.delete(f"session:{session_id}")
+
+
+class SessionStore:
+    """Keeps the latest PRD of each chat session so follow-up turns can reference it by session_id/ETag."""
+
+    def __init__(self, backend: SessionBackend):
+        self.backend = backend
+
+    async def get(self, session_id: str) -> SessionRecord | None:
+        return await asyncio.to_thread(self.backend.get, session_id)
+
+    async def set(self, session_id: str, record: SessionRecord) -> None:
+        await asyncio.to_thread(self.backend.set, session_id, record)
+
+    async def delete(self, session_id: str) -> bool:
+        return await asyncio.to_thread(self.backend.delete, session_id)
+
+    async def wrap(
+        self,
+        session_id: str,
+        events: AsyncIterator[dict],
+        images: list[ImageAttachment] | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """透传事件；生成成功结束后保存新版 PRD，并追加一个 session 事件告知新的 ETag。
+
+        本轮没有上传图片时沿用会话中已保存的图片引用。
+        """
+        parts: list[str] = []
+        failed = False
+        async for event in events:
+            event_type = event.get("type")
+            if event_type == "content":
+                parts.append(event["content"])
+            elif event_type == "error":
+                failed = True
+            yield event
+
+        if failed or not parts:
+            return
+        prd = "".join(parts)
+        if images:
+            stored_images = [image.model_dump() for image in images]
+        else:
+            previous = await self.get(session_id)
+            stored_images = previous.images if previous is not None else []
+        record = SessionRecord(prd=prd, etag=prd_etag(prd), images=stored_images)
+        await self.set(session_id, record)
+        yield {"type": "session", "session_id": session_id, "etag": record.etag}
+
+
+@lru_cache
+def get_session_store() -> SessionStore | None:
+    """Session store configured by SESSION_STORE=memory|sqlite|shared|off (default memory)."""
+    backend_name = os.getenv("SESSION_STORE", "memory").lower()
+    if backend_name in ("", "0", "false", "off", "none"):
+        return None
+    ttl = float(os.getenv("SESSION_STORE_TTL", "86400"))
+    max_bytes = int(os.getenv("SESSION_STORE_MAX_MB", "256")) * 1024 * 1024
+    if backend_name == "memory":
+        backend = MemorySessionBackend(max_bytes=max_bytes, ttl=ttl)
+    elif backend_name == "sqlite":
+        path = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+        backend = SQLiteSessionBackend(path, max_bytes=max_bytes, ttl=ttl)
+    elif backend_name == "shared":
+        backend = SharedStateSessionBackend(get_shared_state(), max_bytes=max_bytes, ttl=ttl)
+    else:
+        raise ValueError(f"Unsupported SESSION_STORE backend: {backend_name}")
+    logger.info("Session store enabled: backend=%s, ttl=%ss, max_bytes=%d", backend_name, ttl, max_bytes)
+    return SessionStore(backend)
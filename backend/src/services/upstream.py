@@ -0,0 +1,268 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
+from dataclasses import dataclass, field
+
+logger = logging.getLogger("uvicorn.error")
+
+# 首个 token：content 或 reasoning 事件到达即视为上游已开始正常输出
+TOKEN_EVENT_TYPES = frozenset({"content", "reasoning"})
+
+# 请求本身有问题（参数、内容审核、鉴权、欠费），重试或换模型都没有意义
+NON_RETRYABLE_CODES = ("InvalidParameter", "DataInspectionFailed", "InvalidApiKey", "Arrearage", "AccessDenied")
+
+
+def is_retryable(error_event: dict) -> bool:
+    code = error_event.get("code") or ""
+    return not code.startswith(NON_RETRYABLE_CODES)
+
+
+def _circuit_open_error() -> dict:
+    return {"type": "error", "message": "Upstream model temporarily unavailable", "code": "CircuitOpen"}
+
+
+class CircuitBreaker:
+    """Per-model breaker: opens after consecutive failures, lets one trial request through after a cool-down.
+
+    While the trial is running the breaker stays closed to every other request;
+    its outcome closes the breaker again or restarts the cool-down.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self.failure_threshold <= 0:
+            return True
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self.trial_running)
+
+    def acquire(self) -> bool:
+        """在发起调用前占用名额；半开状态下只放行一个试探请求。"""
+        if not self.allow():
+            return False
+        if self.failure_threshold > 0 and self.state == "half-open":
+            self.trial_running = True
+        return True
+
+    def end_trial(self) -> None:
+        """试探请求未得出结论（被取消或请求本身无效）：允许下一个请求再试探。"""
+        self.trial_running = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failure_threshold > 0 and (self.state == "half-open" or self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+
+@dataclass
+class _Probe:
+    """Result of running one attempt up to its first token (or failure)."""
+
+    model: str
+    stream: AsyncIterator[dict]
+    prelude: list[dict] = field(default_factory=list)
+    error: dict | None = None
+    # 本次调用是熔断器半开状态下的试探请求
+    trial: bool = False
+
+
+class ResilientUpstream:
+    """Retry, hedging and failover for streaming upstream calls.
+
+    Until the first token arrives an attempt can be abandoned safely: failures are
+    retried with jittered exponential backoff, falling over to the next model in
+    the list, and an attempt that is slow to produce its first token gets a hedged
+    request to the next model -- whichever produces a token first wins. Once a
+    token has been streamed the attempt is committed and later errors pass through.
+
+    Configuration (env):
+        UPSTREAM_RETRIES: extra rounds after the first one fails before any token (default 2)
+        UPSTREAM_BACKOFF_BASE / UPSTREAM_BACKOFF_MAX: backoff in seconds (default 0.5 / 5)
+        UPSTREAM_HEDGE_AFTER: seconds without a first token before hedging to the next model (default 20, 0 disables)
+        UPSTREAM_BREAKER_FAILURES: consecutive failures that open a model's breaker (default 5, 0 disables)
+        UPSTREAM_BREAKER_RESET: seconds before an open breaker lets one trial request through (default 30)
+    """
+
+    def __init__(
+        self,
+        retries: int | None = None,
+        backoff_base: float | None = None,
+        backoff_max: float | None = None,
+        hedge_after: float | None = None,
+        breaker_failures: int | None = None,
+        breaker_reset: float | None = None,
+    ):
+        self.retries = int(os.getenv("UPSTREAM_RETRIES", "2")) if retries is None else retries
+        self.backoff_base = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5")) if backoff_base is None else backoff_base
+        self.backoff_max = float(os.getenv("UPSTREAM_BACKOFF_MAX", "5")) if backoff_max is None else backoff_max
+        self.hedge_after = float(os.getenv("UPSTREAM_HEDGE_AFTER", "20")) if hedge_after is None else hedge_after
+        if breaker_failures is None:
+            breaker_failures = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+        if breaker_reset is None:
+            breaker_reset = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+            self._breakers[model] = breaker
+        return breaker
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter：在 [0, min(max, base * 2^attempt)] 内随机
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def stream(
+        self,
+        models: list[str],
+        start: Callable[[str], AsyncIterator[dict]],
+    ) -> AsyncGenerator[dict, None]:
+        """按 models 顺序（首选模型在前）发起流式调用，产出胜出调用的事件。
+
+        Args:
+            models: 首选模型及备用模型
+            start: 给定模型名，返回该模型的事件流（错误以 error 事件表示）
+        """
+        last_error: dict | None = None
+        for round_index in range(self.retries + 1):
+            candidates = [model for model in dict.fromkeys(models) if self.breaker(model).allow()]
+            if not candidates:
+                logger.warning("all upstream circuit breakers open: %s", ", ".join(models))
+                yield _circuit_open_error()
+                return
+
+            winner, last_error = await self._race(candidates, start)
+            if winner is not None:
+                if winner.model != models[0]:
+                    logger.info("upstream served by fallback model=%s", winner.model)
+                try:
+                    for event in winner.prelude:
+                        yield event
+                    async for event in winner.stream:
+                        yield event
+                finally:
+                    if hasattr(winner.stream, "aclose"):
+                        await winner.stream.aclose()
+                return
+
+            if not is_retryable(last_error) or round_index == self.retries:
+                break
+            delay = self.backoff(round_index)
+            logger.warning("upstream attempt failed before first token, retrying in %.2fs", delay)
+            await asyncio.sleep(delay)
+
+        yield last_error
+
+    async def _race(
+        self,
+        candidates: list[str],
+        start: Callable[[str], AsyncIterator[dict]],
+    ) -> tuple[_Probe | None, dict | None]:
+        """一轮尝试：先调用首选模型，超过 hedge_after 仍无首 token 或失败时再调用下一个模型。"""
+        pending: dict[asyncio.Task, _Probe] = {}
+        next_index = 0
+        last_error: dict | None = None
+
+        def launch() -> bool:
+            # 本轮开始后熔断器可能已被其他请求的试探占用，跳过此类模型
+            nonlocal next_index
+            while next_index < len(candidates):
+                model = candidates[next_index]
+                next_index += 1
+                breaker = self.breaker(model)
+                trial = breaker.state == "half-open"
+                if not breaker.acquire():
+                    continue
+                probe = _Probe(model=model, stream=start(model), trial=trial)
+                pending[asyncio.create_task(self._probe(probe))] = probe
+                return True
+            return False
+
+        if not launch():
+            return None, _circuit_open_error()
+        try:
+            while pending:
+                can_hedge = next_index < len(candidates) and self.hedge_after > 0
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_after if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    logger.info(
+                        "no first token after %.1fs, hedging to model=%s", self.hedge_after, candidates[next_index]
+                    )
+                    launch()
+                    continue
+
+                for task in done:
+                    probe = pending.pop(task)
+                    if probe.error is None:
+                        self.breaker(probe.model).record_success()
+                        return probe, None
+                    last_error = probe.error
+                    if is_retryable(probe.error):
+                        self.breaker(probe.model).record_failure()
+                    elif probe.trial:
+                        self.breaker(probe.model).end_trial()
+                    await self._close(probe)
+                if not is_retryable(last_error):
+                    return None, last_error
+                if not pending and next_index < len(candidates):
+                    # 当前模型失败，立即切换到下一个模型
+                    launch()
+            return None, last_error
+        finally:
+            for task, probe in pending.items():
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+                await self._close(probe)
+                if probe.trial:
+                    self.breaker(probe.model).end_trial()
+
+    async def _probe(self, probe: _Probe) -> None:
+        try:
+            async for event in probe.stream:
+                event_type = event.get("type")
+                if event_type == "error":
+                    probe.error = event
+                    return
+                probe.prelude.append(event)
+                if event_type in TOKEN_EVENT_TYPES:
+                    return
+        except Exception:
+            logger.exception("upstream attempt failed model=%s", probe.model)
+            probe.error = {"type": "error", "message": "Upstream model error"}
+
+    @staticmethod
+    async def _close(probe: _Probe) -> None:
+        if hasattr(probe.stream, "aclose"):
+            with contextlib.suppress(Exception):
+                await probe.stream.aclose()
@@ -0,0 +1,17 @@
+"""Helpers shared by the test modules for driving async event streams."""
+
+import asyncio
+
+
+async def async_iter(items):
+    for item in items:
+        yield item
+
+
+def collect(stream) -> list:
+    """在新的事件循环中读完一个异步事件流。"""
+
+    async def drain():
+        return [event async for event in stream]
+
+    return asyncio.run(drain())
@@ -9,14 +9,16 @@ from src.services.llm_service import LLMService
 client = TestClient(app)
 
 
-def mock_generate_stream_clarification(user_description: str, images=None):
-    yield '{"type":"content","content":"## Requirements\\n\\n- [NEEDS CLARIFICATION: What is the user role?]"}\n'
+async def mock_generate_events_clarification(
+    user_description: str, images=None, session_id=None, generation_mode=None, slot=None
+):
+    yield {"type": "content", "content": "## Requirements\n\n- [NEEDS CLARIFICATION: What is the user role?]"}
 
 
 @pytest.fixture
 def mock_llm_service_clarification():
     mock_service = MagicMock(spec=LLMService)
-    mock_service.generate_stream.side_effect = mock_generate_stream_clarification
+    mock_service.agenerate_events.side_effect = mock_generate_events_clarification
     return mock_service
 
 
@@ -1,3 +1,5 @@
+import asyncio
+import json
 from unittest.mock import MagicMock
 
 import pytest
@@ -9,16 +11,26 @@ from src.services.llm_service import LLMService
 client = TestClient(app)
 
 
-def mock_generate_stream(user_description: str, images=None):
-    yield '{"type":"content","content":"Chunk 1"}\n'
-    yield '{"type":"content","content":"Chunk 2"}\n'
-    yield '{"type":"usage","input_tokens":1,"output_tokens":2,"total_tokens":3}\n'
+MOCK_EVENTS = [
+    {"type": "content", "content": "Chunk 1"},
+    {"type": "content", "content": "Chunk 2"},
+    {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3},
+]
+
+
+async def mock_agenerate_events(user_description: str, images=None, session_id=None, generation_mode=None, slot=None):
+    for event in MOCK_EVENTS:
+        yield event
+
+
+async def mock_achat_events(content: str):
+    yield {"type": "content", "content": content}
 
 
 @pytest.fixture
 def mock_llm_service():
     mock_service = MagicMock(spec=LLMService)
-    mock_service.generate_stream.side_effect = mock_generate_stream
+    mock_service.agenerate_events.side_effect = mock_agenerate_events
     return mock_service
 
 
@@ -45,12 +57,34 @@ def test_generate_spec_streaming(mock_llm_service):
     app.dependency_overrides = {}
 
 
+def test_generate_passes_generation_mode(mock_llm_service):
+    from src.api.endpoints import get_llm_service
+
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+
+    response = client.post("/api/v1/generate", json={"description": "Test feature", "generation_mode": "parallel"})
+
+    assert response.status_code == 200
+    assert mock_llm_service.agenerate_events.call_args.kwargs["generation_mode"] == "parallel"
+    invalid = client.post("/api/v1/generate", json={"description": "Test feature", "generation_mode": "fast"})
+    assert invalid.status_code == 422
+
+    app.dependency_overrides = {}
+
+
 def test_health_check():
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
 
+def test_prompt_versions():
+    response = client.get("/api/v1/prompts")
+
+    assert response.status_code == 200
+    assert set(response.json()) == {"generate", "chat", "chat_patch"}
+
+
 def test_generate_spec_non_streaming(mock_llm_service):
     from src.api.endpoints import get_llm_service
 
@@ -74,8 +108,10 @@ def test_chat_requires_current_prd():
 
 
 def test_chat_streaming(mock_llm_service):
-    mock_llm_service.chat_stream.side_effect = lambda current_prd, user_message, images=None: iter(
-        ['{"type":"content","content":"Response from chat"}\n']
+    mock_llm_service.achat_events.side_effect = (
+        lambda current_prd, user_message, images=None, edit_mode=None, session_id=None: mock_achat_events(
+            "Response from chat"
+        )
     )
 
     from src.api.endpoints import get_llm_service
@@ -95,8 +131,10 @@ def test_chat_streaming(mock_llm_service):
 
 def test_chat_always_outputs_full_prd(mock_llm_service):
     """测试 chat 模式总是输出完整 PRD"""
-    mock_llm_service.chat_stream.side_effect = lambda current_prd, user_message, images=None: iter(
-        ['{"type":"content","content":"## 功能背景\\n完整的 PRD 内容"}\n']
+    mock_llm_service.achat_events.side_effect = (
+        lambda current_prd, user_message, images=None, edit_mode=None, session_id=None: mock_achat_events(
+            "## 功能背景\n完整的 PRD 内容"
+        )
     )
 
     from src.api.endpoints import get_llm_service
@@ -117,3 +155,222 @@ def test_chat_always_outputs_full_prd(mock_llm_service):
     assert "功能背景" in response.text
 
     app.dependency_overrides = {}
+
+
+def test_chat_patch_mode_passes_edit_mode(mock_llm_service):
+    mock_llm_service.achat_events.side_effect = (
+        lambda current_prd, user_message, images=None, edit_mode=None, session_id=None: mock_achat_events("merged")
+    )
+
+    from src.api.endpoints import get_llm_service
+
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+
+    response = client.post(
+        "/api/v1/generate",
+        json={
+            "description": "把成功标准改成 90%",
+            "mode": "chat",
+            "current_prd": "Current PRD content",
+            "edit_mode": "patch",
+        },
+    )
+
+    assert response.status_code == 200
+    assert mock_llm_service.achat_events.call_args.kwargs["edit_mode"] == "patch"
+
+    app.dependency_overrides = {}
+
+
+def test_chat_uses_session_stored_prd(mock_llm_service):
+    from src.api.endpoints import get_llm_service
+    from src.services.session_store import MemorySessionBackend, SessionRecord, SessionStore, get_session_store
+
+    store = SessionStore(MemorySessionBackend(max_bytes=1024 * 1024, ttl=60))
+    store.backend.set("s1", SessionRecord(prd="Stored PRD", etag="etag-1"))
+    mock_llm_service.achat_events.side_effect = (
+        lambda current_prd, user_message, images=None, edit_mode=None, session_id=None: mock_achat_events(current_prd)
+    )
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+    app.dependency_overrides[get_session_store] = lambda: store
+
+    response = client.post(
+        "/api/v1/generate",
+        json={"description": "改一下", "mode": "chat", "session_id": "s1", "prd_etag": "etag-1"},
+    )
+    assert response.status_code == 200
+    assert "Stored PRD" in response.text
+    assert mock_llm_service.achat_events.call_args.kwargs["session_id"] == "s1"
+
+    stale = client.post(
+        "/api/v1/generate",
+        json={"description": "改一下", "mode": "chat", "session_id": "s1", "prd_etag": "old"},
+    )
+    assert stale.status_code == 409
+
+    missing = client.post("/api/v1/generate", json={"description": "改一下", "mode": "chat", "session_id": "s2"})
+    assert missing.status_code == 404
+
+    fetched = client.get("/api/v1/sessions/s1")
+    assert fetched.json()["markdown_content"] == "Stored PRD"
+    assert fetched.headers["etag"] == '"etag-1"'
+
+    assert client.delete("/api/v1/sessions/s1").status_code == 204
+    assert client.get("/api/v1/sessions/s1").status_code == 404
+
+    app.dependency_overrides = {}
+
+
+def test_upload_image_and_reference_it(mock_llm_service, tmp_path):
+    from src.api.endpoints import get_llm_service
+    from src.services.image_store import ImageStore, get_image_store
+
+    store = ImageStore(tmp_path, max_bytes=1024 * 1024, ttl=60)
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+    app.dependency_overrides[get_image_store] = lambda: store
+
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+    uploaded = client.post("/api/v1/images", content=png, headers={"Content-Type": "image/png"})
+    assert uploaded.status_code == 200
+    image_id = uploaded.json()["image_id"]
+    assert uploaded.json() == {"image_id": image_id, "mime_type": "image/png", "size": len(png)}
+
+    assert client.post("/api/v1/images", content=b"%PDF-1.7 not an image").status_code == 415
+
+    response = client.post(
+        "/api/v1/generate",
+        json={"description": "Test feature", "stream": True, "images": [{"image_id": image_id}]},
+    )
+    assert response.status_code == 200
+    images = mock_llm_service.agenerate_events.call_args.kwargs["images"]
+    assert images[0].mime_type == "image/png"
+    assert images[0].size == len(png)
+
+    unknown = client.post(
+        "/api/v1/generate",
+        json={"description": "Test feature", "images": [{"image_id": "0" * 64}]},
+    )
+    assert unknown.status_code == 400
+
+    app.dependency_overrides = {}
+
+
+def test_generate_rejects_client_over_concurrency_limit(mock_llm_service):
+    from src.api.admission import AdmissionController, get_admission_controller
+    from src.api.endpoints import get_llm_service
+
+    admission = AdmissionController(max_concurrent=10, max_per_client=1, max_queue=10, queue_timeout=5)
+    asyncio.run(admission.admit("session:busy"))
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+    app.dependency_overrides[get_admission_controller] = lambda: admission
+
+    response = client.post("/api/v1/generate", json={"description": "Test feature", "session_id": "busy"})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+    ok = client.post("/api/v1/generate", json={"description": "Test feature", "session_id": "other"})
+    assert ok.status_code == 200
+    assert admission.active == 1
+
+    app.dependency_overrides = {}
+
+
+def test_streaming_events_carry_ids_and_can_be_resumed(mock_llm_service):
+    from src.api.endpoints import get_llm_service
+    from src.services.resumable import ResumableStreams, get_resumable_streams
+
+    resumable = ResumableStreams(grace=5, max_events=100)
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+    app.dependency_overrides[get_resumable_streams] = lambda: resumable
+
+    response = client.post("/api/v1/generate", json={"description": "Test feature", "stream": True})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    generation_id = response.headers["X-Generation-Id"]
+
+    assert events[0] == {"type": "generation", "generation_id": generation_id, "id": 1}
+    assert [event["id"] for event in events] == list(range(1, len(events) + 1))
+
+    resumed = client.get(f"/api/v1/generations/{generation_id}", headers={"Last-Event-ID": "2"})
+    assert resumed.status_code == 200
+    assert [json.loads(line) for line in resumed.text.splitlines()] == events[2:]
+
+    assert client.get("/api/v1/generations/unknown").status_code == 404
+
+    app.dependency_overrides = {}
+
+
+def test_job_submission_and_polling(tmp_path):
+    import time
+
+    from src.api.endpoints import get_job_queue
+    from src.services.jobs import JobQueue, SQLiteJobStore
+
+    async def run(request, keys=()):
+        for event in MOCK_EVENTS:
+            yield event
+
+    queue = JobQueue(run, store=SQLiteJobStore(str(tmp_path / "jobs.sqlite3"), ttl=60), workers=2, max_pending=10)
+    app.dependency_overrides[get_job_queue] = lambda: queue
+
+    with TestClient(app) as job_client:
+        response = job_client.post("/api/v1/jobs", json={"description": "Test feature"})
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+        assert response.headers["Location"] == f"/api/v1/jobs/{job_id}"
+
+        for _ in range(100):
+            body = job_client.get(f"/api/v1/jobs/{job_id}").json()
+            if body["status"] == "succeeded":
+                break
+            time.sleep(0.01)
+
+        assert body["markdown_content"] == "Chunk 1Chunk 2"
+        assert body["usage"] == {"input_tokens": 1, "output_tokens": 2, "total_tokens": 3}
+        assert job_client.get("/api/v1/jobs/unknown").status_code == 404
+        # 覆盖的依赖不会被 lifespan 关闭，这里手动停止工作协程
+        job_client.portal.call(queue.close)
+
+    app.dependency_overrides = {}
+
+
+def test_batch_generation_multiplexes_items(mock_llm_service):
+    from src.api.endpoints import get_llm_service
+
+    app.dependency_overrides[get_llm_service] = lambda: mock_llm_service
+
+    response = client.post(
+        "/api/v1/generate/batch",
+        json={"items": [{"description": "Feature A"}, {"description": "Feature B"}], "parallelism": 2},
+    )
+    events = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.status_code == 200
+    for index in (0, 1):
+        item_events = [event for event in events if event.get("index") == index]
+        assert "".join(event["content"] for event in item_events if event["type"] == "content") == "Chunk 1Chunk 2"
+        assert item_events[-1]["type"] == "item_done"
+        assert item_events[-1]["status"] == "succeeded"
+    assert events[-1]["type"] == "batch_done"
+    assert events[-1]["succeeded"] == 2
+
+    app.dependency_overrides = {}
+
+
+def test_batch_generation_reports_invalid_item():
+    response = client.post(
+        "/api/v1/generate/batch",
+        json={"items": [{"description": "Feature A"}, {"description": "Edit", "mode": "chat"}]},
+    )
+
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("items[1]:")
+
+
+def test_metrics_endpoint_exposes_prometheus_text():
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE llm_requests_total counter" in response.text
+    assert "admission_active_generations 0" in response.text
@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+
+from src.api.admission import AdmissionController, SlotPool, client_ip, client_keys, parse_trusted_proxies
+from src.core.shared_state import MemorySharedState
+
+
+def _controller(**kwargs) -> AdmissionController:
+    options = {"max_concurrent": 1, "max_per_client": 2, "max_queue": 1, "queue_timeout": 5}
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test_admits_until_limits_then_rejects_fast():
+    async def scenario():
+        controller = _controller()
+
+        first = await controller.admit("a")
+        queued = await controller.admit("b")
+
+        assert first.granted and first.position == 0
+        assert not queued.granted and queued.position == 1
+        with pytest.raises(HTTPException) as queue_full:
+            await controller.admit("c")
+        assert queue_full.value.status_code == 503
+        assert int(queue_full.value.headers["Retry-After"]) >= 1
+
+        await first.release()
+        assert queued.granted
+        assert controller.active == 1 and controller.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_per_client_limit_counts_running_and_queued():
+    async def scenario():
+        controller = _controller(max_concurrent=1, max_per_client=1, max_queue=10)
+        ticket = await controller.admit("a")
+
+        with pytest.raises(HTTPException) as too_many:
+            await controller.admit("a")
+
+        assert too_many.value.status_code == 429
+        assert "Retry-After" in too_many.value.headers
+        await ticket.release()
+        await ticket.release()  # 重复释放无副作用
+        assert (await controller.admit("a")).granted
+
+    asyncio.run(scenario())
+
+
+def test_release_after_lease_expiry_does_not_leave_negative_count():
+    async def scenario():
+        state = MemorySharedState()
+        controller = _controller(max_concurrent=10, max_per_client=1, state=state, client_lease=60)
+        ticket = await controller.admit("a")
+        state.delete("admission:a")  # 模拟租期过期
+
+        await ticket.release()
+
+        assert state.get("admission:a") == "0"
+        await controller.admit("a")
+        with pytest.raises(HTTPException) as too_many:
+            await controller.admit("a")
+        assert too_many.value.status_code == 429
+
+    asyncio.run(scenario())
+
+
+def test_stream_emits_queue_positions_then_output():
+    async def scenario():
+        controller = _controller(max_concurrent=1, max_queue=5)
+        running = await controller.admit("a")
+        waiting = await controller.admit("b")
+        last = await controller.admit("c")
+
+        async def start():
+            yield {"type": "content", "content": "PRD"}
+
+        async def consume(ticket):
+            return [chunk async for chunk in controller.stream(ticket, start)]
+
+        task = asyncio.create_task(consume(last))
+        await asyncio.sleep(0.01)
+        await running.release()  # waiting 获得名额，last 前进到第 1 位
+        await asyncio.sleep(0.01)
+        await waiting.release()
+        assert await task == [
+            {"type": "queued", "position": 2},
+            {"type": "position", "position": 1},
+            {"type": "content", "content": "PRD"},
+        ]
+        assert controller.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_releases_ticket():
+    async def scenario():
+        controller = _controller(queue_timeout=0.01)
+        await controller.admit("a")
+        ticket = await controller.admit("b")
+
+        with pytest.raises(HTTPException) as timeout:
+            await ticket.wait()
+
+        assert timeout.value.status_code == 503
+        assert controller.queued == 0
+        assert (await controller.admit("b")).position == 1
+
+    asyncio.run(scenario())
+
+
+def test_slot_pool_counts_fan_out_against_global_and_client_limits():
+    async def run_fan_out(controller: AdmissionController, calls: int) -> int:
+        ticket = await controller.admit("a")
+        pool = SlotPool(controller, "a", retry_interval=0.01)
+        running = peak = 0
+
+        async def call():
+            nonlocal running, peak
+            async with pool.slot():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*(call() for _ in range(calls)))
+        await ticket.release()
+        assert controller.active == 0
+        return peak
+
+    # 全局 3 个名额：请求自身 1 个 + 额外 2 个
+    assert asyncio.run(run_fan_out(_controller(max_concurrent=3, max_per_client=10), 8)) == 3
+    # 单客户端上限 2
+    assert asyncio.run(run_fan_out(_controller(max_concurrent=10, max_per_client=2), 8)) == 2
+
+
+def test_try_admit_does_not_jump_the_queue():
+    async def scenario():
+        controller = _controller(max_concurrent=1, max_per_client=5, max_queue=5)
+        await controller.admit("a")
+        assert await controller.try_admit("a") is None
+        await controller.admit("b")  # 排队中
+        assert controller.queued == 1
+
+    asyncio.run(scenario())
+
+
+def _request(peer: str, **headers: str) -> Request:
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "headers": raw, "client": (peer, 1234)})
+
+
+def test_client_ip_ignores_forwarded_headers_from_untrusted_peers():
+    trusted = parse_trusted_proxies("10.0.0.0/8")
+
+    request = _request("203.0.113.7", x_forwarded_for="1.2.3.4", x_real_ip="5.6.7.8")
+
+    assert client_ip(request, trusted) == "203.0.113.7"
+    assert client_ip(request, ()) == "203.0.113.7"
+
+
+def test_client_ip_uses_headers_set_by_trusted_proxy():
+    trusted = parse_trusted_proxies("10.0.0.1, 172.16.0.0/12")
+
+    assert client_ip(_request("10.0.0.1", x_real_ip="198.51.100.2"), trusted) == "198.51.100.2"
+    # 客户端伪造的最左侧地址被忽略：取从右向左第一个不可信的地址
+    spoofed = _request("10.0.0.1", x_forwarded_for="1.1.1.1, 198.51.100.2, 172.16.0.5")
+    assert client_ip(spoofed, trusted) == "198.51.100.2"
+
+
+def test_new_session_ids_do_not_bypass_the_ip_limit():
+    async def scenario():
+        controller = _controller(max_concurrent=10, max_per_client=2, max_queue=10)
+        request = _request("203.0.113.7")
+        await controller.admit(client_keys(request, "s1"))
+        await controller.admit(client_keys(request, "s2"))
+        with pytest.raises(HTTPException) as exc:
+            await controller.admit(client_keys(request, "s3"))
+        assert exc.value.status_code == 429
+        # 被拒绝的请求不占用任何计数
+        assert controller.state.incr("admission:session:s3", 0, 60) == 0
+        assert (await controller.admit(client_keys(_request("198.51.100.2"), "s1"))).granted
+        with pytest.raises(HTTPException):
+            await controller.admit(client_keys(_request("198.51.100.3"), "s1"))
+
+    asyncio.run(scenario())
+
+
+def test_client_keys_combine_ip_and_distinct_sessions():
+    request = _request("203.0.113.7")
+
+    assert client_keys(request) == ("ip:203.0.113.7",)
+    assert client_keys(request, "a", None, "a", "b") == ("ip:203.0.113.7", "session:a", "session:b")
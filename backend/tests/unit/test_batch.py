@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+
+from src.services.batch import BatchRunner
+
+
+def _collect(runner: BatchRunner, starts, parallelism=None) -> list[dict]:
+    async def scenario():
+        return [event async for event in runner.stream(starts, parallelism)]
+
+    return asyncio.run(scenario())
+
+
+def test_events_are_tagged_and_parallelism_is_bounded():
+    running = 0
+    peak = 0
+
+    def start(index: int):
+        async def events():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            yield {"type": "content", "content": f"PRD {index}"}
+            running -= 1
+
+        return events
+
+    events = _collect(BatchRunner(max_parallelism=8), [start(i) for i in range(5)], parallelism=2)
+
+    assert peak == 2
+    contents = {event["index"]: event["content"] for event in events if event["type"] == "content"}
+    assert contents == {i: f"PRD {i}" for i in range(5)}
+    done = [event for event in events if event["type"] == "item_done"]
+    assert sorted(event["index"] for event in done) == list(range(5))
+    assert events[-1] == {"type": "batch_done", "succeeded": 5, "failed": 0}
+
+
+def test_parallelism_is_capped_by_configuration():
+    runner = BatchRunner(max_parallelism=3)
+
+    assert runner.parallelism(None) == 3
+    assert runner.parallelism(2) == 2
+    assert runner.parallelism(50) == 3
+
+
+def test_failing_item_does_not_stop_the_batch():
+    async def ok():
+        yield {"type": "content", "content": "fine"}
+
+    async def error_event():
+        yield {"type": "error", "message": "Upstream model error"}
+
+    async def raises():
+        raise RuntimeError("boom")
+        yield  # pragma: no cover
+
+    events = _collect(BatchRunner(max_parallelism=1), [ok, error_event, raises])
+
+    statuses = {event["index"]: event["status"] for event in events if event["type"] == "item_done"}
+    assert statuses == {0: "succeeded", 1: "failed", 2: "failed"}
+    assert {"type": "error", "message": "Upstream model error", "index": 2} in events
+    assert events[-1] == {"type": "batch_done", "succeeded": 1, "failed": 2}
+
+
+def test_closing_the_stream_cancels_running_items():
+    cancelled = []
+
+    def start(index: int):
+        async def events():
+            try:
+                yield {"type": "content", "content": str(index)}
+                await asyncio.Event().wait()
+            finally:
+                cancelled.append(index)
+
+        return events
+
+    async def scenario():
+        stream = BatchRunner(max_parallelism=2).stream([start(0), start(1)])
+        await anext(stream)
+        await stream.aclose()
+
+    asyncio.run(scenario())
+
+    assert sorted(cancelled) == [0, 1]
+
+
+def test_each_running_item_holds_a_slot():
+    held = 0
+    peak = 0
+
+    @contextlib.asynccontextmanager
+    async def slot():
+        nonlocal held, peak
+        held += 1
+        peak = max(peak, held)
+        try:
+            yield
+        finally:
+            held -= 1
+
+    async def item():
+        await asyncio.sleep(0.01)
+        yield {"type": "content", "content": "PRD"}
+
+    async def scenario():
+        return [event async for event in BatchRunner(max_parallelism=8).stream([item] * 6, 3, slot=slot)]
+
+    events = asyncio.run(scenario())
+
+    assert peak == 3 and held == 0
+    assert events[-1] == {"type": "batch_done", "succeeded": 6, "failed": 0}
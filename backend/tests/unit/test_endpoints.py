@@ -1,22 +1,97 @@
+import asyncio
+
 import pytest
 from fastapi import HTTPException
 
-from src.api.endpoints import _collect_stream_content
+from src.api.endpoints import (
+    _collect_content,
+    _run_until_disconnect,
+    _stream_until_disconnect,
+    close_llm_service,
+    get_llm_service,
+)
+from tests.helpers import async_iter
 
 
-def test_collect_stream_content_success():
-    chunks = [
-        '{"type":"content","content":"Hello"}\n{"type":"content","content":" World"}\n',
-        '{"type":"usage","input_tokens":1,"output_tokens":2,"total_tokens":3}\n',
+def test_collect_content_success():
+    events = [
+        {"type": "reasoning", "content": "thinking"},
+        {"type": "content", "content": "Hello"},
+        {"type": "content", "content": " World"},
+        {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3},
     ]
 
-    assert _collect_stream_content(chunks) == "Hello World"
+    assert asyncio.run(_collect_content(async_iter(events))) == "Hello World"
 
 
-def test_collect_stream_content_error():
-    chunks = ['{"type":"error","message":"bad"}\n']
+def test_collect_content_error():
+    events = [{"type": "content", "content": "partial"}, {"type": "error", "message": "bad"}]
 
     with pytest.raises(HTTPException) as excinfo:
-        _collect_stream_content(chunks)
+        asyncio.run(_collect_content(async_iter(events)))
 
     assert excinfo.value.status_code == 502
+
+
+def test_llm_service_is_process_wide_singleton():
+    get_llm_service.cache_clear()
+    service = get_llm_service()
+
+    assert get_llm_service() is service
+
+    asyncio.run(close_llm_service())
+    assert get_llm_service.cache_info().currsize == 0
+
+
+class FakeHTTPRequest:
+    """Minimal stand-in for starlette Request: receive() reports a disconnect after a delay."""
+
+    def __init__(self, disconnect_after: float):
+        self.disconnect_after = disconnect_after
+
+    async def receive(self):
+        await asyncio.sleep(self.disconnect_after)
+        return {"type": "http.disconnect"}
+
+
+def test_stream_until_disconnect_closes_upstream():
+    closed = []
+
+    async def chunks():
+        try:
+            yield "first\n"
+            await asyncio.sleep(10)
+            yield "never\n"
+        finally:
+            closed.append(True)
+
+    async def scenario():
+        return [chunk async for chunk in _stream_until_disconnect(FakeHTTPRequest(0.01), chunks())]
+
+    assert asyncio.run(scenario()) == ["first\n"]
+    assert closed == [True]
+
+
+def test_run_until_disconnect_cancels_buffered_generation():
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "done"
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(_run_until_disconnect(FakeHTTPRequest(0.01), work()))
+
+    assert excinfo.value.status_code == 499
+    assert cancelled == [True]
+
+
+def test_run_until_disconnect_returns_result():
+    async def work():
+        return "PRD"
+
+    assert asyncio.run(_run_until_disconnect(FakeHTTPRequest(10), work())) == "PRD"
@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+import pytest
+
+from src.core import event_encoder
+from src.core.event_encoder import EventEncoder
+
+
+async def _aiter(items, delay: float = 0.0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+def _coalesce(encoder: EventEncoder, events, delay: float = 0.0) -> list[dict]:
+    async def collect():
+        return [event async for event in encoder.coalesce(_aiter(events, delay))]
+
+    return asyncio.run(collect())
+
+
+def test_encode_outputs_compact_utf8():
+    encoder = EventEncoder(ensure_ascii=False, backend="json")
+
+    line = encoder.encode({"type": "content", "content": "需求"})
+
+    assert line == '{"type":"content","content":"需求"}\n'
+
+
+def test_encode_ensure_ascii_escapes():
+    encoder = EventEncoder(ensure_ascii=True)
+
+    line = encoder.encode({"type": "content", "content": "需求"})
+
+    assert "\\u9700" in line
+    assert json.loads(line)["content"] == "需求"
+
+
+@pytest.mark.skipif(event_encoder.orjson is None, reason="orjson not installed")
+def test_encode_orjson_backend_matches_json():
+    event = {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3}
+
+    assert EventEncoder(backend="orjson").encode(event) == EventEncoder(backend="json").encode(event)
+
+
+def test_unknown_backend_rejected():
+    with pytest.raises(ValueError):
+        EventEncoder(backend="yaml")
+
+
+def test_coalesce_merges_consecutive_deltas_by_type():
+    encoder = EventEncoder(coalesce_ms=1000, coalesce_bytes=1024)
+    events = [
+        {"type": "reasoning", "content": "想"},
+        {"type": "reasoning", "content": "一想"},
+        {"type": "content", "content": "## "},
+        {"type": "content", "content": "标题"},
+        {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3},
+    ]
+
+    merged = _coalesce(encoder, events)
+
+    assert merged == [
+        {"type": "reasoning", "content": "想一想"},
+        {"type": "content", "content": "## 标题"},
+        {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3},
+    ]
+
+
+def test_coalesce_flushes_when_byte_limit_reached():
+    encoder = EventEncoder(coalesce_ms=1000, coalesce_bytes=6)
+    events = [
+        {"type": "content", "content": "需"},
+        {"type": "content", "content": "求"},
+        {"type": "content", "content": "x"},
+    ]
+
+    merged = _coalesce(encoder, events)
+
+    assert [e["content"] for e in merged] == ["需求", "x"]
+
+
+def test_coalesce_flushes_after_interval_when_source_stalls():
+    encoder = EventEncoder(coalesce_ms=10, coalesce_bytes=1024)
+    events = [{"type": "content", "content": "a"}, {"type": "content", "content": "b"}]
+
+    merged = _coalesce(encoder, events, delay=0.05)
+
+    assert [e["content"] for e in merged] == ["a", "b"]
+
+
+def test_coalesce_disabled_passes_events_through():
+    encoder = EventEncoder(coalesce_ms=0)
+    events = [{"type": "content", "content": "a"}, {"type": "content", "content": "b"}]
+
+    assert _coalesce(encoder, events) == events
+
+
+def test_coalesce_closes_source_when_consumer_stops_early():
+    encoder = EventEncoder(coalesce_ms=1000, coalesce_bytes=1)
+    closed = []
+
+    async def source():
+        try:
+            while True:
+                yield {"type": "content", "content": "token"}
+                await asyncio.sleep(0)
+        finally:
+            closed.append(True)
+
+    async def consume_one():
+        stream = encoder.coalesce(source())
+        first = await anext(stream)
+        await stream.aclose()
+        return first
+
+    assert asyncio.run(consume_one())["content"] == "token"
+    assert closed == [True]
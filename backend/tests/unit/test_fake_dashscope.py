@@ -0,0 +1,53 @@
+import asyncio
+
+import dashscope
+from aiohttp.test_utils import TestServer
+from dashscope.api_entities.dashscope_response import Message
+
+from benchmarks.fake_dashscope import FakeDashScope, FakeUpstreamConfig
+from src.services.llm_service import LLMService
+
+
+def _stream(monkeypatch, config: FakeUpstreamConfig, multimodal: bool = False) -> list[dict]:
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+    service = LLMService()
+
+    async def scenario():
+        server = TestServer(FakeDashScope(config).app())
+        await server.start_server()
+        monkeypatch.setattr(dashscope, "base_http_api_url", str(server.make_url("/api/v1")))
+        try:
+            if multimodal:
+                messages = [{"role": "user", "content": [{"text": "看图"}]}]
+                return [event async for event in service._astream_multimodal_events(messages)]
+            messages = [Message(role="user", content="登录功能")]
+            return [event async for event in service._astream_events(messages)]
+        finally:
+            await service.aclose()
+            await server.close()
+
+    return asyncio.run(scenario())
+
+
+def test_fake_server_streams_through_the_real_sdk(monkeypatch):
+    config = FakeUpstreamConfig(
+        ttft=0, vl_extra_ttft=0, tokens_per_sec=0, chunk_tokens=4, output_tokens=10, reasoning_tokens=4
+    )
+
+    for multimodal in (False, True):
+        events = _stream(monkeypatch, config, multimodal)
+
+        types = [event["type"] for event in events]
+        assert types == ["reasoning", "content", "content", "content", "usage"]
+        assert events[-1]["output_tokens"] == 14
+
+
+def test_fake_server_injects_errors(monkeypatch):
+    rejected = _stream(monkeypatch, FakeUpstreamConfig(ttft=0, tokens_per_sec=0, error_rate=1.0))
+    midstream = _stream(
+        monkeypatch, FakeUpstreamConfig(ttft=0, tokens_per_sec=0, output_tokens=9, midstream_error_rate=1.0, seed=1)
+    )
+
+    assert [event["type"] for event in rejected] == ["error"]
+    assert rejected[0]["code"] == "Throttling.RateQuota"
+    assert midstream[-1]["type"] == "error"
@@ -0,0 +1,85 @@
+import base64
+import hashlib
+import io
+
+import pytest
+
+from src.services.image_processor import ImageProcessor
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _png(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _size(data_b64: str) -> tuple[int, int]:
+    with Image.open(io.BytesIO(base64.b64decode(data_b64))) as image:
+        return image.size
+
+
+def test_downscales_to_max_edge_and_keeps_png():
+    processor = ImageProcessor(max_edge=100, quality=80, output_format="keep", cache_max_bytes=1024 * 1024)
+
+    data, mime_type = processor.process("hash-1", _png(400, 200), "image/png")
+
+    assert mime_type == "image/png"
+    assert _size(data) == (100, 50)
+
+
+def test_small_images_are_passed_through():
+    processor = ImageProcessor(max_edge=100, quality=80, output_format="keep", cache_max_bytes=1024 * 1024)
+    original = _png(50, 50)
+
+    data, mime_type = processor.process("hash-1", original, "image/png")
+
+    assert base64.b64decode(data) == original
+    assert mime_type == "image/png"
+
+
+def test_webp_output_format():
+    processor = ImageProcessor(max_edge=100, quality=80, output_format="webp", cache_max_bytes=1024 * 1024)
+
+    data, mime_type = processor.process("hash-1", _png(300, 300), "image/png")
+
+    assert mime_type == "image/webp"
+    assert _size(data) == (100, 100)
+
+
+def test_results_are_cached_by_content_hash_and_bounded():
+    processor = ImageProcessor(max_edge=100, quality=80, output_format="keep", cache_max_bytes=1024 * 1024)
+    original = base64.b64encode(_png(400, 400)).decode("ascii")
+
+    first = processor.process_base64(original, "image/png")
+    processor.process = None  # 命中缓存时不应再次处理
+    second = processor.process_base64(original, "image/png")
+
+    assert first == second
+    assert _size(first[0]) == (100, 100)
+
+    tiny = ImageProcessor(max_edge=0, quality=80, output_format="keep", cache_max_bytes=10)
+    tiny.process("a", b"12345", "image/png")
+    tiny.process("b", b"67890", "image/png")
+    assert tiny.get_cached("a") is None
+    assert tiny.get_cached("b") == (base64.b64encode(b"67890").decode("ascii"), "image/png")
+
+
+def test_inline_and_uploaded_images_share_the_content_address():
+    """内联 Base64 与上传图片都按解码后的字节寻址，image_id 可直接命中内联图片的缓存"""
+    processor = ImageProcessor(max_edge=100, quality=80, output_format="keep", cache_max_bytes=1024 * 1024)
+    original = _png(400, 400)
+
+    inline = processor.process_base64(base64.b64encode(original).decode("ascii"), "image/png")
+
+    assert processor.get_cached(hashlib.sha256(original).hexdigest()) == inline
+
+
+def test_undecodable_image_is_sent_unchanged():
+    processor = ImageProcessor(max_edge=100, quality=80, output_format="keep", cache_max_bytes=1024)
+
+    data, mime_type = processor.process("hash-1", b"\x89PNG\r\n\x1a\nbroken", "image/png")
+
+    assert base64.b64decode(data) == b"\x89PNG\r\n\x1a\nbroken"
+    assert mime_type == "image/png"
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from src.services.image_store import ImageStore, ImageUploadError, sniff_image_mime
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+
+
+async def _chunks(data: bytes, size: int = 7):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+def _save(store: ImageStore, data: bytes, max_size: int = 1024):
+    return asyncio.run(store.save_stream(_chunks(data), max_size=max_size))
+
+
+def test_sniff_image_mime():
+    assert sniff_image_mime(PNG) == "image/png"
+    assert sniff_image_mime(JPEG) == "image/jpeg"
+    assert sniff_image_mime(b"GIF89a......") == "image/gif"
+    assert sniff_image_mime(b"RIFF\x00\x00\x00\x00WEBP") == "image/webp"
+    assert sniff_image_mime(b"%PDF-1.7....") is None
+
+
+def test_save_stream_is_content_addressed(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+
+    first = _save(store, PNG)
+    second = _save(store, PNG)
+
+    assert first.image_id == hashlib.sha256(PNG).hexdigest()
+    assert second.image_id == first.image_id
+    assert first.mime_type == "image/png"
+    assert store.read_bytes(first.image_id) == PNG
+    assert store.total_bytes == len(PNG)
+    assert [p.name for p in tmp_path.iterdir()] == [first.image_id]
+
+
+def test_save_stream_rejects_invalid_uploads(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+
+    with pytest.raises(ImageUploadError) as too_large:
+        _save(store, PNG, max_size=16)
+    with pytest.raises(ImageUploadError) as unsupported:
+        _save(store, b"not an image at all")
+    with pytest.raises(ImageUploadError) as empty:
+        _save(store, b"")
+
+    assert too_large.value.status_code == 413
+    assert unsupported.value.status_code == 415
+    assert empty.value.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_store_evicts_by_size_and_reloads_from_disk(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=len(PNG) + len(JPEG), ttl=60)
+    png = _save(store, PNG)
+    jpeg = _save(store, JPEG)
+    gif = _save(store, b"GIF89a" + b"\x01" * 30)
+
+    assert store.get(png.image_id) is None
+    assert store.get(jpeg.image_id) is not None
+
+    reopened = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+    assert reopened.get(gif.image_id).mime_type == "image/gif"
+    assert reopened.get(png.image_id) is None
+
+
+def test_get_falls_back_to_images_saved_by_another_worker(tmp_path):
+    ours = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+    theirs = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+    png = _save(theirs, PNG)
+
+    found = ours.get(png.image_id)
+
+    assert found.mime_type == "image/png"
+    assert found.size == len(PNG)
+    assert ours.read_bytes(png.image_id) == PNG
+    assert ours.get("../" + png.image_id[3:]) is None
+    assert ours.get("0" * 64) is None
+
+
+def test_get_ignores_expired_files_on_disk(tmp_path):
+    theirs = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+    png = _save(theirs, PNG)
+    os.utime(png.path, (0, 0))
+
+    assert ImageStore(tmp_path, max_bytes=1024, ttl=60).get(png.image_id) is None
+    assert not png.path.exists()
@@ -0,0 +1,118 @@
+import asyncio
+
+from src.services.inflight import InflightRegistry
+
+
+def test_concurrent_identical_requests_share_one_upstream():
+    registry = InflightRegistry()
+    upstream_calls = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def upstream():
+            upstream_calls.append(True)
+            yield {"type": "content", "content": "A"}
+            await gate.wait()
+            yield {"type": "content", "content": "B"}
+
+        async def consume():
+            return [event["content"] async for event in registry.subscribe("k", upstream)]
+
+        first = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        # 第二个调用方在 "A" 已产生后加入，应先回放前缀再接收实时事件
+        second = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await first, await second
+
+    first, second = asyncio.run(scenario())
+
+    assert first == second == ["A", "B"]
+    assert upstream_calls == [True]
+    assert len(registry) == 0
+
+
+def test_different_keys_run_separately():
+    registry = InflightRegistry()
+    calls = []
+
+    def factory(name):
+        async def upstream():
+            calls.append(name)
+            yield {"type": "content", "content": name}
+
+        return upstream
+
+    async def scenario():
+        return await asyncio.gather(*(_collect(registry.subscribe(key, factory(key))) for key in ("a", "b")))
+
+    results = asyncio.run(scenario())
+
+    assert sorted(calls) == ["a", "b"]
+    assert [r[0]["content"] for r in results] == ["a", "b"]
+
+
+def test_driver_failure_becomes_error_event():
+    registry = InflightRegistry()
+
+    async def upstream():
+        yield {"type": "content", "content": "partial"}
+        raise RuntimeError("boom")
+
+    events = asyncio.run(_collect(registry.subscribe("k", upstream)))
+
+    assert events[-1] == {"type": "error", "message": "Upstream model error"}
+    assert len(registry) == 0
+
+
+async def _collect(stream) -> list[dict]:
+    return [event async for event in stream]
+
+
+def test_last_subscriber_leaving_cancels_upstream():
+    registry = InflightRegistry()
+    closed = []
+
+    async def scenario():
+        async def upstream():
+            try:
+                yield {"type": "content", "content": "A" * 100}
+                await asyncio.Event().wait()  # 模拟仍在生成中的上游
+                yield {"type": "content", "content": "never"}
+            finally:
+                closed.append(True)
+
+        first = registry.subscribe("k", upstream)
+        second = registry.subscribe("k", upstream)
+        assert (await anext(first))["content"].startswith("A")
+        assert (await anext(second))["content"].startswith("A")
+
+        await first.aclose()
+        await asyncio.sleep(0)
+        assert closed == []  # 仍有订阅者，继续生成
+
+        await second.aclose()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+
+    assert closed == [True]
+    assert len(registry) == 0
+    assert registry.abort_stats.aborted == 1
+    assert registry.abort_stats.tokens_saved > 0
+
+
+def test_abort_stats_learn_from_completed_generations():
+    registry = InflightRegistry()
+
+    async def upstream():
+        yield {"type": "content", "content": "x" * 1000}
+        yield {"type": "usage", "input_tokens": 1, "output_tokens": 500, "total_tokens": 501}
+
+    asyncio.run(_collect(registry.subscribe("k", upstream)))
+
+    stats = registry.abort_stats
+    assert stats.avg_output_tokens < 3000
+    assert stats.record_abort(output_chars=0) == round(stats.avg_output_tokens)
@@ -0,0 +1,233 @@
+import asyncio
+
+import pytest
+
+from src.models.schemas import GenerationRequest
+from src.services.jobs import JobQueue, JobQueueFull, JobRecord, SQLiteJobStore
+
+
+def _store(tmp_path) -> SQLiteJobStore:
+    return SQLiteJobStore(str(tmp_path / "jobs.sqlite3"), ttl=60)
+
+
+async def _wait_finished(queue: JobQueue, job_id: str):
+    for _ in range(200):
+        record = await queue.get(job_id)
+        if record.finished:
+            return record
+        await asyncio.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_jobs_run_on_bounded_worker_pool(tmp_path):
+    running = 0
+    peak = 0
+
+    async def run(request: GenerationRequest, keys=()):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+        yield {"type": "content", "content": f"PRD for {request.description}"}
+        yield {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3}
+
+    async def scenario():
+        queue = JobQueue(run, store=_store(tmp_path), workers=2, max_pending=100)
+        records = [await queue.submit(GenerationRequest(description=f"feature {i}")) for i in range(5)]
+        assert all(record.status == "queued" for record in records)
+        finished = [await _wait_finished(queue, record.job_id) for record in records]
+        await queue.close()
+        return finished
+
+    finished = asyncio.run(scenario())
+
+    assert peak == 2
+    assert [record.status for record in finished] == ["succeeded"] * 5
+    assert finished[3].result == "PRD for feature 3"
+    assert finished[3].usage == {"input_tokens": 1, "output_tokens": 2, "total_tokens": 3}
+
+
+def test_error_event_fails_job(tmp_path):
+    async def run(request: GenerationRequest, keys=()):
+        yield {"type": "content", "content": "partial"}
+        yield {"type": "error", "message": "Upstream model error"}
+
+    async def scenario():
+        queue = JobQueue(run, store=_store(tmp_path), workers=1, max_pending=10)
+        record = await queue.submit(GenerationRequest(description="feature"))
+        finished = await _wait_finished(queue, record.job_id)
+        await queue.close()
+        return finished
+
+    record = asyncio.run(scenario())
+
+    assert record.status == "failed"
+    assert record.error == "Upstream model error"
+    assert record.result is None
+
+
+def test_cancel_running_and_queued_jobs(tmp_path):
+    started = []
+
+    async def run(request: GenerationRequest, keys=()):
+        started.append(request.description)
+        await asyncio.Event().wait()
+        yield {"type": "content", "content": "never"}
+
+    async def scenario():
+        queue = JobQueue(run, store=_store(tmp_path), workers=1, max_pending=1)
+        first = await queue.submit(GenerationRequest(description="first"))
+        await asyncio.sleep(0.01)
+        second = await queue.submit(GenerationRequest(description="second"))
+        with pytest.raises(JobQueueFull):
+            await queue.submit(GenerationRequest(description="third"))
+        queued = await queue.cancel(second.job_id)
+        running = await queue.cancel(first.job_id)
+        await asyncio.sleep(0.01)
+        await queue.close()
+        return queued, running
+
+    queued, running = asyncio.run(scenario())
+
+    assert queued.status == "cancelled"
+    assert running.status == "cancelled"
+    assert started == ["first"]
+
+
+def test_unfinished_jobs_resume_after_restart(tmp_path):
+    calls = []
+
+    async def hang(request: GenerationRequest, keys=()):
+        await asyncio.Event().wait()
+        yield {"type": "content", "content": "never"}
+
+    async def run(request: GenerationRequest, keys=()):
+        calls.append(request.description)
+        yield {"type": "content", "content": "done"}
+
+    async def first_process():
+        queue = JobQueue(hang, store=_store(tmp_path), workers=1, max_pending=10)
+        record = await queue.submit(GenerationRequest(description="feature"))
+        await asyncio.sleep(0.01)
+        await queue.close()
+        return record.job_id
+
+    async def second_process(job_id: str):
+        queue = JobQueue(run, store=_store(tmp_path), workers=1, max_pending=10)
+        # 正常退出时运行中的任务交还租约，重新排队
+        assert (await queue.get(job_id)).status == "queued"
+        await queue.start()
+        finished = await _wait_finished(queue, job_id)
+        await queue.close()
+        return finished
+
+    job_id = asyncio.run(first_process())
+    record = asyncio.run(second_process(job_id))
+
+    assert record.status == "succeeded"
+    assert record.result == "done"
+    assert calls == ["feature"]
+
+
+def test_running_job_is_not_taken_over_and_cancel_reaches_its_owner(tmp_path):
+    started = []
+
+    async def hang(request: GenerationRequest, keys=()):
+        started.append(request.description)
+        await asyncio.Event().wait()
+        yield {"type": "content", "content": "never"}
+
+    async def scenario():
+        options = {"workers": 1, "max_pending": 10, "lease": 0.3, "poll_interval": 0.01}
+        worker_a = JobQueue(hang, store=_store(tmp_path), **options)
+        worker_b = JobQueue(hang, store=_store(tmp_path), **options)
+        record = await worker_a.submit(GenerationRequest(description="feature"))
+        await asyncio.sleep(0.05)
+        assert record.job_id in worker_a._running
+        await worker_b.start()
+        # 超过租约时长：worker_a 持续续约，worker_b 不会重复执行
+        await asyncio.sleep(0.5)
+        assert started == ["feature"]
+
+        requested = await worker_b.cancel(record.job_id)
+        assert requested.status == "running" and requested.cancel_requested
+        finished = await _wait_finished(worker_b, record.job_id)
+        await worker_a.close()
+        await worker_b.close()
+        return finished
+
+    assert asyncio.run(scenario()).status == "cancelled"
+
+
+def test_job_of_a_dead_worker_is_recovered_after_its_lease_expires(tmp_path):
+    store = _store(tmp_path)
+    store.save(JobRecord(job_id="j1", request={"description": "feature"}))
+    assert store.claim_next("dead-worker", lease=-1).status == "running"
+
+    async def run(request: GenerationRequest, keys=()):
+        yield {"type": "content", "content": "done"}
+
+    async def scenario():
+        queue = JobQueue(run, store=store, workers=1, max_pending=10, lease=5, poll_interval=0.01)
+        await queue.start()
+        finished = await _wait_finished(queue, "j1")
+        await queue.close()
+        return finished
+
+    record = asyncio.run(scenario())
+
+    assert record.status == "succeeded"
+    assert record.result == "done"
+
+
+def test_claim_is_exclusive(tmp_path):
+    store_a, store_b = _store(tmp_path), _store(tmp_path)
+    store_a.save(JobRecord(job_id="j1", request={"description": "feature"}))
+
+    assert store_a.claim_next("a", lease=30).job_id == "j1"
+    assert store_b.claim_next("b", lease=30) is None
+    assert store_b.renew("j1", "b", lease=30) is None
+    assert store_a.renew("j1", "a", lease=30) is False
+
+
+def test_running_job_holds_an_admission_slot(tmp_path):
+    from unittest.mock import MagicMock
+
+    from src.api.admission import AdmissionController
+    from src.api.endpoints import _job_events
+
+    admission = AdmissionController(max_concurrent=1, max_per_client=5, max_queue=5, queue_timeout=5)
+    seen = []
+
+    async def agenerate_events(**kwargs):
+        seen.append((admission.active, kwargs["slot"] is not None))
+        yield {"type": "content", "content": "PRD"}
+
+    llm_service = MagicMock(agenerate_events=agenerate_events)
+
+    async def scenario():
+        queue = JobQueue(
+            lambda request, keys: _job_events(llm_service, admission, request, keys),
+            store=_store(tmp_path),
+            workers=1,
+            max_pending=10,
+            poll_interval=0.01,
+        )
+        busy = await admission.admit("ip:other")
+        record = await queue.submit(GenerationRequest(description="feature"), ("ip:1.2.3.4", "session:s"))
+        await asyncio.sleep(0.1)
+        # 名额被占满时任务等待，不会越过全局上限
+        assert seen == []
+        await busy.release()
+        finished = await _wait_finished(queue, record.job_id)
+        await queue.close()
+        return finished
+
+    finished = asyncio.run(scenario())
+
+    assert finished.status == "succeeded"
+    assert finished.client_keys == ["ip:1.2.3.4", "session:s"]
+    assert seen == [(1, True)]
+    assert admission.active == 0
+    assert admission.state.incr("admission:session:s", 0, 60) == 0
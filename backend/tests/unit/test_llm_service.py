@@ -1,8 +1,18 @@
+import asyncio
+import base64
 import json
 from http import HTTPStatus
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import pytest
+
+from src.models.schemas import ImageAttachment
+from src.services.image_processor import ImageProcessor
+from src.services.image_store import ImageStore
+from src.services.inflight import InflightRegistry
 from src.services.llm_service import LLMService
+from src.services.response_cache import MemoryCacheBackend, ResponseCache
+from tests.helpers import async_iter, collect
 
 
 class FakeResponse:
@@ -82,7 +92,7 @@ def test_build_chat_messages_order(monkeypatch):
         assert messages[3].content == "Latest"
 
 
-def test_stream_response_emits_events(monkeypatch):
+def test_astream_events_emits_events(monkeypatch):
     """测试 DashScope 流式响应事件"""
     monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
 
@@ -91,27 +101,25 @@ def test_stream_response_emits_events(monkeypatch):
         service.debug_errors = False
         service.model = "test-model"
         service.enable_thinking = False
+        service._get_session = AsyncMock(return_value="pooled-session")
 
-        # 模拟 DashScope 响应
         responses = [
             FakeResponse(content="Hello"),
             FakeResponse(content=" World"),
             FakeUsageResponse(input_tokens=10, output_tokens=5),
         ]
 
-        with patch("dashscope.Generation.call", return_value=iter(responses)):
-            events = [json.loads(line) for line in service._stream_response([])]
+        with patch("dashscope.AioGeneration.call", new=AsyncMock(return_value=async_iter(responses))) as mock_call:
+            events = collect(service._astream_events([]))
 
-        assert events[0]["type"] == "content"
+        assert mock_call.await_args.kwargs["stream"] is True
+        assert mock_call.await_args.kwargs["session"] == "pooled-session"
+        assert [e["type"] for e in events] == ["content", "content", "usage"]
         assert events[0]["content"] == "Hello"
-        assert events[1]["type"] == "content"
-        assert events[1]["content"] == " World"
-        assert events[2]["type"] == "usage"
-        assert events[2]["input_tokens"] == 10
-        assert events[2]["output_tokens"] == 5
+        assert events[2]["total_tokens"] == 15
 
 
-def test_stream_response_emits_reasoning(monkeypatch):
+def test_astream_events_emits_reasoning(monkeypatch):
     """测试 DashScope reasoning 事件"""
     monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
 
@@ -120,28 +128,22 @@ def test_stream_response_emits_reasoning(monkeypatch):
         service.debug_errors = False
         service.model = "test-model"
         service.enable_thinking = True
+        service._get_session = AsyncMock(return_value=None)
 
-        # 模拟带 reasoning 的响应
-        response = MagicMock()
-        response.status_code = HTTPStatus.OK
-        response.output = MagicMock()
-        response.output.choices = [MagicMock()]
-        response.output.choices[0].message = MagicMock()
-        response.output.choices[0].message.content = "Answer"
-        response.output.choices[0].message.reasoning_content = "Thinking process"
-        response.usage = None
+        response = FakeResponse(content="Answer", reasoning_content="Thinking process")
 
-        with patch("dashscope.Generation.call", return_value=iter([response])):
-            events = [json.loads(line) for line in service._stream_response([])]
+        with patch("dashscope.AioGeneration.call", new=AsyncMock(return_value=async_iter([response]))) as mock_call:
+            events = collect(service._astream_events([]))
 
-        assert events[0]["type"] == "reasoning"
-        assert events[0]["content"] == "Thinking process"
-        assert events[1]["type"] == "content"
-        assert events[1]["content"] == "Answer"
+        assert mock_call.await_args.kwargs["enable_thinking"] is True
+        assert events == [
+            {"type": "reasoning", "content": "Thinking process"},
+            {"type": "content", "content": "Answer"},
+        ]
 
 
-def test_stream_response_emits_error(monkeypatch):
-    """测试 DashScope 错误处理"""
+def test_astream_events_emits_error(monkeypatch):
+    """测试异步流式调用失败时输出 error 事件"""
     monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
 
     with patch.object(LLMService, "__init__", lambda self: None):
@@ -150,8 +152,315 @@ def test_stream_response_emits_error(monkeypatch):
         service.model = "test-model"
         service.enable_thinking = False
 
-        with patch("dashscope.Generation.call", side_effect=RuntimeError("API Error")):
-            events = [json.loads(line) for line in service._stream_response([])]
+        with patch("dashscope.AioGeneration.call", new=AsyncMock(side_effect=RuntimeError("API Error"))):
+            events = collect(service._astream_events([]))
+
+        assert events == [{"type": "error", "message": "Upstream model error"}]
+
+
+def test_astream_multimodal_events_extracts_text(monkeypatch):
+    """测试异步多模态响应提取列表格式的文本内容"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+        service.debug_errors = False
+        service.vl_model = "test-vl-model"
+        service.enable_thinking = False
+        service._get_session = AsyncMock(return_value=None)
+
+        response = FakeResponse()
+        response.output.choices[0].message.content = [{"text": "看图"}, {"text": "写 PRD"}]
+
+        with patch(
+            "dashscope.AioMultiModalConversation.call", new=AsyncMock(return_value=async_iter([response]))
+        ) as mock_call:
+            events = collect(service._astream_multimodal_events([]))
+
+        assert mock_call.await_args.kwargs["model"] == "test-vl-model"
+        assert [e["content"] for e in events] == ["看图", "写 PRD"]
+
+
+def test_session_pool_is_reused_and_closed(monkeypatch):
+    """测试上游连接池在同一事件循环内复用，aclose 后释放"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+    monkeypatch.setenv("UPSTREAM_POOL_SIZE", "8")
+    monkeypatch.setenv("UPSTREAM_POOL_PER_HOST", "4")
+    service = LLMService()
+
+    async def scenario():
+        first = await service._get_session()
+        second = await service._get_session()
+        assert first is second
+        assert first.connector.limit == 8
+        assert first.connector.limit_per_host == 4
+        await service.aclose()
+        assert first.closed
+
+    asyncio.run(scenario())
+
+
+def test_session_pool_closes_session_of_previous_loop(monkeypatch):
+    """测试事件循环变化时旧连接池被关闭而不是直接丢弃"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+    service = LLMService()
+
+    first = asyncio.run(service._get_session())
+
+    async def scenario():
+        second = await service._get_session()
+        assert second is not first
+        await service.aclose()
+
+    asyncio.run(scenario())
+    assert first.closed
+
+
+def test_agenerate_events_uses_response_cache(monkeypatch):
+    """测试开启结果缓存后，相同请求只调用一次上游"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+        service.model = "test-model"
+        service.vl_model = "test-vl-model"
+        service.enable_thinking = False
+        service.generation_mode = "sequential"
+        service.prompt_loader = MagicMock(version="v1")
+        service.response_cache = ResponseCache(MemoryCacheBackend(max_entries=4, ttl=60))
+        service.inflight = InflightRegistry()
+        service.session_store = None
+
+        upstream_calls = []
+
+        async def fake_upstream(user_description, images=None):
+            upstream_calls.append(user_description)
+            yield {"type": "content", "content": "PRD"}
+
+        service._agenerate_upstream_events = fake_upstream
+        first = collect(service.agenerate_events("登录功能"))
+        second = collect(service.agenerate_events(" 登录功能 "))
+
+        assert first == second == [{"type": "content", "content": "PRD"}]
+        assert upstream_calls == ["登录功能"]
+
+
+def test_load_images_resolves_uploaded_references(monkeypatch, tmp_path):
+    """测试 image_id 引用在构建多模态消息前被替换为 Base64 数据"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 16
+
+    async def chunks():
+        yield png
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+        service.image_store = ImageStore(tmp_path, max_bytes=1024, ttl=60)
+        service.image_processor = ImageProcessor(max_edge=0, output_format="keep")
+        stored = asyncio.run(service.image_store.save_stream(chunks()))
+
+        images = asyncio.run(service._aload_images([ImageAttachment(image_id=stored.image_id)]))
+        content = service._build_multimodal_content("看图", images)
+
+        assert content[0] == {"image": "data:image/png;base64," + base64.b64encode(png).decode("ascii")}
+        with pytest.raises(LookupError):
+            service._load_images([ImageAttachment(image_id="0" * 64)])
+
 
-        assert events[0]["type"] == "error"
-        assert events[0]["message"] == "Upstream model error"
+def _prompt_service(mode: str) -> LLMService:
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+    service.prompt_cache_mode = mode
+    service.vl_model = "test-vl-model"
+    service.chat_prompt_loader = MagicMock(load_prompt=MagicMock(return_value="Chat system prompt"))
+    service.chat_patch_prompt_loader = MagicMock(load_prompt=MagicMock(return_value="Patch prompt"))
+    return service
+
+
+def test_patch_chat_messages_mark_a_byte_stable_cache_prefix():
+    """测试显式缓存标记：补丁模式下系统提示词和固定确认回复末尾带 cache_control，前缀跨轮次逐字节相同"""
+    service = _prompt_service("explicit")
+
+    first, multimodal = service._prepare_chat("# PRD\n", "加一个导出功能", patch=True)
+    second, _ = service._prepare_chat("# PRD", "导出支持 Excel 吗？", patch=True)
+
+    assert multimodal is False
+    assert first[0].content == [{"type": "text", "text": "Patch prompt", "cache_control": {"type": "ephemeral"}}]
+    assert first[1].content == "## 当前 PRD\n\n# PRD"
+    assert first[2].content[0]["cache_control"] == {"type": "ephemeral"}
+    assert first[3].content == "加一个导出功能"
+    assert json.dumps(first[:3], ensure_ascii=False) == json.dumps(second[:3], ensure_ascii=False)
+
+
+def test_full_edit_chat_marks_only_the_system_prompt():
+    """full 模式每轮都会改写 PRD，不为 PRD 创建缓存"""
+    service = _prompt_service("explicit")
+
+    messages, _ = service._prepare_chat("# PRD", "加一个导出功能")
+
+    assert messages[0].content == [
+        {"type": "text", "text": "Chat system prompt", "cache_control": {"type": "ephemeral"}}
+    ]
+    assert all(isinstance(message.content, str) for message in messages[1:])
+
+
+def test_multimodal_chat_marks_prefix_and_keeps_images_last():
+    service = _prompt_service("explicit")
+    images = [ImageAttachment(data=base64.b64encode(b"png").decode("ascii"), mime_type="image/png")]
+
+    messages, multimodal = service._prepare_chat("# PRD", "看图", images, patch=True)
+
+    assert multimodal is True
+    assert messages[0]["content"] == [{"text": "Patch prompt", "cache_control": {"type": "ephemeral"}}]
+    assert "cache_control" in messages[2]["content"][-1]
+    assert all("cache_control" not in part for part in messages[3]["content"])
+
+
+def test_implicit_prompt_cache_mode_sends_plain_messages():
+    service = _prompt_service("implicit")
+
+    messages, _ = service._prepare_chat("# PRD", "问题")
+
+    assert [message.content for message in messages][::2] == [
+        "Chat system prompt",
+        "好的，我已了解当前 PRD 内容，请告诉我你的想法或问题。",
+    ]
+
+
+def test_usage_event_reports_cached_input_tokens():
+    from dashscope.api_entities.dashscope_response import GenerationUsage
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+    response = FakeResponse()
+    response.usage = GenerationUsage(
+        input_tokens=3000,
+        output_tokens=100,
+        prompt_tokens_details={"cached_tokens": 2800, "cache_creation_input_tokens": 0},
+    )
+
+    assert service._usage_event(response) == {
+        "type": "usage",
+        "input_tokens": 3000,
+        "output_tokens": 100,
+        "total_tokens": 3100,
+        "cached_input_tokens": 2800,
+        "uncached_input_tokens": 200,
+    }
+    response.usage = FakeUsageResponse(input_tokens=10, output_tokens=5).usage
+    assert service._usage_event(response)["cached_input_tokens"] == 0
+
+
+def test_patch_mode_sends_pruned_prd_and_merges_into_full_document():
+    """测试补丁模式只发送相关章节全文，合并仍基于完整 PRD"""
+    from src.core.prd_index import PrdIndex
+
+    background = "本产品帮助团队管理任务、文档和日程。" * 40
+    prd = f"# PRD\n\n## 1. 概述\n{background}\n\n## 2. 导出报表\n支持 CSV 导出。\n\n## 3. 提醒\n{background}\n"
+    sent = []
+
+    def fake_upstream(messages, multimodal, mode):
+        sent.append((messages, mode))
+        return async_iter(
+            [{"type": "content", "content": "<<<REPLACE ## 2. 导出报表\n支持 CSV 和 Excel 导出。\n>>>\n"}]
+        )
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+    service.model = "test-model"
+    service.vl_model = "test-vl-model"
+    service.enable_thinking = False
+    service.prompt_cache_mode = "implicit"
+    service.chat_edit_mode = "patch"
+    service.chat_patch_prompt_loader = MagicMock(version="v1", load_prompt=MagicMock(return_value="Patch prompt"))
+    service.prd_index = PrdIndex(min_chars=500)
+    service.inflight = InflightRegistry()
+    service.session_store = None
+    service._aupstream_events = fake_upstream
+
+    events = collect(service.achat_events(prd, "导出报表要支持 Excel"))
+
+    messages, mode = sent[0]
+    assert mode == "chat_patch"
+    assert "支持 CSV 导出。" in messages[1].content
+    assert background not in messages[1].content
+    assert "## 3. 提醒" in messages[1].content
+    assert events[-1]["type"] == "content"
+    assert "支持 CSV 和 Excel 导出。" in events[-1]["content"]
+    assert background in events[-1]["content"]
+
+
+def test_pruned_prd_is_not_part_of_the_cached_prefix():
+    """裁剪后的 PRD 随每条消息变化，只有系统提示词带缓存标记"""
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+    service.prompt_cache_mode = "explicit"
+    service.chat_patch_prompt_loader = MagicMock(load_prompt=MagicMock(return_value="Patch prompt"))
+
+    messages, _ = service._prepare_chat("# PRD\n\n## 1. 概述", "改概述", patch=True, pruned=True)
+
+    assert messages[0].content[0]["cache_control"] == {"type": "ephemeral"}
+    assert all(isinstance(message.content, str) for message in messages[1:])
+
+
+def test_parallel_generation_section_calls_share_a_cached_prefix():
+    """测试并行生成：大纲调用后各章节调用共享 系统提示词 + 描述 + 大纲 前缀"""
+    from src.services.parallel_generation import ParallelGenerator
+
+    outline = "# PRD\n## 1. 背景\n- 痛点\n## 2. 需求\n- 导出\n## 3. 验收\n- 场景"
+    calls = []
+
+    def fake_upstream(messages, multimodal, mode, thinking=None):
+        calls.append((messages, mode))
+        if mode == "generate_outline":
+            return async_iter([{"type": "content", "content": outline}])
+        return async_iter([{"type": "content", "content": f"section {len(calls) - 1}"}])
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+    service.prompt_cache_mode = "explicit"
+    service.prompt_loader = MagicMock(load_prompt=MagicMock(return_value="System prompt"))
+    service.parallel_generator = ParallelGenerator(max_parallel=2)
+    service._aupstream_events = fake_upstream
+
+    events = collect(service._agenerate_parallel_events("导出报表"))
+
+    assert [mode for _, mode in calls] == ["generate_outline", *["generate_section"] * 3]
+    assert calls[0][0][1].content.startswith("导出报表\n\n")
+    sections = [messages for messages, mode in calls if mode == "generate_section"]
+    assert all(messages[:3] == sections[0][:3] for messages in sections)
+    assert sections[0][2].role == "assistant"
+    assert sections[0][2].content[0]["cache_control"] == {"type": "ephemeral"}
+    assert "「## 3. 验收」" in sections[2][3].content
+    assert "".join(event["content"] for event in events) == "section 1\n\nsection 2\n\nsection 3"
+
+
+def test_parallel_generation_sends_images_only_with_the_outline_call():
+    """测试并行生成：图片只随大纲调用发送，章节调用只发文本且关闭思考"""
+    from src.services.parallel_generation import ParallelGenerator
+
+    outline = "# PRD\n## 1. 背景\n## 2. 需求\n## 3. 验收"
+    calls = []
+
+    def fake_upstream(messages, multimodal, mode, thinking=None):
+        calls.append((mode, multimodal, thinking))
+        if mode == "generate_outline":
+            return async_iter([{"type": "content", "content": outline}])
+        return async_iter([{"type": "content", "content": "section"}])
+
+    with patch.object(LLMService, "__init__", lambda self: None):
+        service = LLMService()
+    service.prompt_cache_mode = "explicit"
+    service.prompt_loader = MagicMock(load_prompt=MagicMock(return_value="System prompt"))
+    service.parallel_generator = ParallelGenerator(max_parallel=2)
+    service._aupstream_events = fake_upstream
+    service._aload_images = AsyncMock(side_effect=lambda images: images)
+    service._build_multimodal_messages = MagicMock(
+        return_value=[{"role": "system", "content": [{"text": "System prompt"}]}, {"role": "user", "content": []}]
+    )
+    images = [ImageAttachment(data="QUJD", mime_type="image/png")]
+
+    collect(service._agenerate_parallel_events("导出报表", images))
+
+    assert calls[0] == ("generate_outline", True, None)
+    assert calls[1:] == [("generate_section", False, False)] * 3
@@ -0,0 +1,79 @@
+import asyncio
+import base64
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from benchmarks.load_driver import LoadDriver, load_descriptions, parse_args, percentile, synthetic_png
+from src.services.image_store import sniff_image_mime
+
+
+def test_descriptions_accept_backlog_and_plain_lines(tmp_path):
+    path = tmp_path / "requests.jsonl"
+    path.write_text(
+        json.dumps({"request_id": "r1", "title": "Batch", "body": "Generate many"})
+        + "\n\n"
+        + json.dumps({"description": "登录功能"})
+        + "\n",
+        encoding="utf-8",
+    )
+
+    assert load_descriptions(str(path)) == ["Batch\n\nGenerate many", "登录功能"]
+    assert load_descriptions(None)
+
+
+def test_percentile_and_synthetic_images():
+    values = [float(value) for value in range(1, 101)]
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
+    assert sniff_image_mime(base64.b64decode(synthetic_png(8, seed=1))[:12]) == "image/png"
+
+
+def test_driver_reports_per_path_latency():
+    seen = []
+
+    async def generate(request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        seen.append(payload)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        await response.write(b'{"type":"generation","generation_id":"g","id":1}\n')
+        await response.write(json.dumps({"type": "content", "content": "PRD"}).encode() + b"\n")
+        await response.write_eof()
+        return response
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/api/v1/generate", generate)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            args = parse_args(
+                [
+                    "--url",
+                    str(server.make_url("/api/v1/generate")),
+                    "--total",
+                    "6",
+                    "--concurrency",
+                    "3",
+                    "--multimodal-ratio",
+                    "0.5",
+                    "--image-size",
+                    "4",
+                ]
+            )
+            return await LoadDriver(args).run(server_pid=None)
+        finally:
+            await server.close()
+
+    report = asyncio.run(scenario())
+
+    assert sum(stats["requests"] for stats in report.paths.values()) == 6
+    assert all(stats["errors"] == {} for stats in report.paths.values())
+    assert all(stats["ttft_p50"] is not None for stats in report.paths.values())
+    assert len({payload["description"] for payload in seen}) == 6
+    assert len({payload["session_id"] for payload in seen}) == 6
+    assert report.server is None
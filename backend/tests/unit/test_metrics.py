@@ -0,0 +1,91 @@
+import asyncio
+
+from src.core.metrics import LLMMetrics, MetricsRegistry
+
+LABELS = {"mode": "generate", "model": "test-model", "kind": "text"}
+
+
+async def _events(*events):
+    for event in events:
+        yield event
+
+
+def _drain(stream) -> list[dict]:
+    async def collect():
+        return [event async for event in stream]
+
+    return asyncio.run(collect())
+
+
+def test_registry_renders_prometheus_text_format():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests.", ("mode",))
+    histogram = registry.histogram("latency_seconds", "Latency.", ("mode",), (1, 5))
+    registry.gauge("queue_depth", "Queue depth.", lambda: 3)
+
+    counter.inc(mode='chat "x"')
+    counter.inc(2, mode='chat "x"')
+    histogram.observe(0.5, mode="generate")
+    histogram.observe(3, mode="generate")
+    histogram.observe(10, mode="generate")
+
+    text = registry.render()
+
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{mode="chat \\"x\\""} 3' in text
+    assert 'latency_seconds_bucket{mode="generate",le="1"} 1' in text
+    assert 'latency_seconds_bucket{mode="generate",le="5"} 2' in text
+    assert 'latency_seconds_bucket{mode="generate",le="+Inf"} 3' in text
+    assert 'latency_seconds_sum{mode="generate"} 13.5' in text
+    assert 'latency_seconds_count{mode="generate"} 3' in text
+    assert "queue_depth 3" in text
+
+
+def test_observe_records_latency_tokens_and_channels():
+    metrics = LLMMetrics()
+    events = _drain(
+        metrics.observe(
+            _events(
+                {"type": "reasoning", "content": "think"},
+                {"type": "content", "content": "PRD"},
+                {
+                    "type": "usage",
+                    "input_tokens": 10,
+                    "output_tokens": 20,
+                    "total_tokens": 30,
+                    "cached_input_tokens": 8,
+                },
+            ),
+            **LABELS,
+        )
+    )
+
+    assert len(events) == 3
+    assert metrics.requests.value(outcome="success", **LABELS) == 1
+    assert metrics.time_to_first_token.count(**LABELS) == 1
+    assert metrics.duration.count(**LABELS) == 1
+    assert metrics.tokens_per_second.count(**LABELS) == 1
+    assert metrics.tokens.value(type="input", **LABELS) == 10
+    assert metrics.tokens.value(type="output", **LABELS) == 20
+    assert metrics.tokens.value(type="cached_input", **LABELS) == 8
+    assert metrics.chars.value(channel="reasoning", **LABELS) == 5
+    assert metrics.chars.value(channel="content", **LABELS) == 3
+
+
+def test_observe_counts_errors_and_cancellations():
+    metrics = LLMMetrics()
+    _drain(metrics.observe(_events({"type": "error", "message": "x", "code": "Throttling"}), **LABELS))
+
+    async def abandon():
+        stream = metrics.observe(
+            _events({"type": "content", "content": "a"}, {"type": "content", "content": "b"}), **LABELS
+        )
+        await anext(stream)
+        await stream.aclose()
+
+    asyncio.run(abandon())
+
+    assert metrics.requests.value(outcome="error", **LABELS) == 1
+    assert metrics.errors.value(code="Throttling", **LABELS) == 1
+    assert metrics.requests.value(outcome="cancelled", **LABELS) == 1
+    assert metrics.duration.count(**LABELS) == 0
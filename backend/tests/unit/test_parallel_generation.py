@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import time
+
+from src.services.parallel_generation import ParallelGenerator, parse_outline
+from tests.helpers import collect
+
+OUTLINE = """```markdown
+# 导出报表 PRD
+## 1. 功能背景
+- 运营需要离线分析数据
+## 2. 用户故事
+- 导出 Excel、导出 CSV
+## 3. 验收场景
+- 大数据量导出、权限不足
+```"""
+
+
+async def _events(*events, delay: float = 0):
+    for event in events:
+        if delay:
+            await asyncio.sleep(delay)
+        yield event
+
+
+def _usage(tokens: int) -> dict:
+    return {"type": "usage", "input_tokens": tokens, "output_tokens": tokens, "total_tokens": 2 * tokens}
+
+
+def test_parse_outline_reads_title_sections_and_notes():
+    outline = parse_outline(OUTLINE)
+
+    assert outline.title == "# 导出报表 PRD"
+    assert [section.heading for section in outline.sections] == ["## 1. 功能背景", "## 2. 用户故事", "## 3. 验收场景"]
+    assert outline.sections[1].notes == ["- 导出 Excel、导出 CSV"]
+    assert outline.render().startswith("# 导出报表 PRD\n## 1. 功能背景\n- 运营需要离线分析数据")
+    assert "「## 2. 用户故事」" in outline.section_instruction(1)
+    assert "# 导出报表 PRD" in outline.section_instruction(0)
+
+
+def test_sections_run_concurrently_and_stream_in_document_order():
+    running = 0
+    peak = 0
+    # 第一个章节最慢：后面的章节先完成，但必须等它结束后才按顺序输出
+    delays = [0.06, 0.01, 0.02]
+
+    def outline_call():
+        return _events({"type": "reasoning", "content": "规划"}, {"type": "content", "content": OUTLINE}, _usage(10))
+
+    async def section_call(outline, index):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        try:
+            yield {"type": "reasoning", "content": f"思考 {index}"}
+            for part in (outline.sections[index].heading, f"\n正文 {index}"):
+                await asyncio.sleep(delays[index])
+                yield {"type": "content", "content": part}
+            yield _usage(5)
+        finally:
+            running -= 1
+
+    started = time.perf_counter()
+    events = collect(ParallelGenerator(max_parallel=3).stream(outline_call, section_call, lambda: _events()))
+    elapsed = time.perf_counter() - started
+
+    assert peak == 3
+    assert elapsed < sum(delays) * 2
+    assert events[0] == {"type": "reasoning", "content": "规划"}
+    content = "".join(event["content"] for event in events if event["type"] == "content")
+    assert content == "## 1. 功能背景\n正文 0\n\n## 2. 用户故事\n正文 1\n\n## 3. 验收场景\n正文 2"
+    assert [event["type"] for event in events].count("reasoning") == 1
+    assert events[-1] == {"type": "usage", "input_tokens": 25, "output_tokens": 25, "total_tokens": 50}
+
+
+def test_short_outline_falls_back_to_sequential_generation():
+    def outline_call():
+        return _events({"type": "content", "content": "# PRD\n## 1. 功能背景"}, _usage(3))
+
+    def sequential_call():
+        return _events({"type": "content", "content": "# PRD 全文"}, _usage(7))
+
+    def section_call(outline, index):
+        raise AssertionError("sections must not be generated")
+
+    events = collect(ParallelGenerator(min_sections=3).stream(outline_call, section_call, sequential_call))
+
+    assert events == [
+        {"type": "content", "content": "# PRD 全文"},
+        {"type": "usage", "input_tokens": 10, "output_tokens": 10, "total_tokens": 20},
+    ]
+
+
+def test_section_error_stops_generation_and_cancels_other_sections():
+    cancelled = []
+
+    def outline_call():
+        return _events({"type": "content", "content": OUTLINE})
+
+    async def section_call(outline, index):
+        try:
+            if index == 1:
+                yield {"type": "error", "message": "Upstream model error", "code": "Throttling"}
+                return
+            await asyncio.sleep(1)
+            yield {"type": "content", "content": "late"}
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+
+    events = collect(ParallelGenerator(max_parallel=3).stream(outline_call, section_call, lambda: _events()))
+
+    assert events == [{"type": "error", "message": "Upstream model error", "code": "Throttling"}]
+    assert sorted(cancelled) == [0, 2]
+
+
+def test_each_running_section_holds_a_slot():
+    active = []
+    peak = []
+
+    @contextlib.asynccontextmanager
+    async def slot():
+        active.append(1)
+        peak.append(len(active))
+        try:
+            yield
+        finally:
+            active.pop()
+
+    def outline_call():
+        return _events({"type": "content", "content": OUTLINE})
+
+    def section_call(outline, index):
+        assert active, "section started without a slot"
+        return _events({"type": "content", "content": f"s{index}"}, delay=0.02)
+
+    events = collect(ParallelGenerator(max_parallel=2).stream(outline_call, section_call, lambda: _events(), slot))
+
+    assert "".join(event["content"] for event in events) == "s0\n\ns1\n\ns2"
+    assert max(peak) == 2
+    assert len(peak) == 3
+    assert active == []
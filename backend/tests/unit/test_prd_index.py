@@ -0,0 +1,67 @@
+from src.core.prd_index import PrdIndex, tokenize
+
+
+def _story(number: int, topic: str) -> str:
+    return (
+        f"### 用户故事 {number}: {topic}\n\n"
+        f"作为用户，我希望{topic}，以便更高效地完成工作。"
+        * 3
+        + f"\n\n#### 验收标准\n\n- AC-{number:03d}-1: {topic}后页面给出明确提示\n"
+        f"- AC-{number:03d}-2: {topic}失败时展示错误原因\n"
+    )
+
+
+PRD = "\n".join(
+    [
+        "# 团队协作平台 PRD",
+        "",
+        "## 1. 概述",
+        "本产品帮助团队管理任务、文档和日程。" * 20,
+        "## 2. 用户故事",
+        _story(1, "创建任务"),
+        _story(2, "上传附件"),
+        _story(3, "导出报表"),
+        _story(4, "设置提醒"),
+        "## 3. 非功能需求",
+        "系统在高峰期保持可用，接口响应时间小于 500ms。" * 20,
+    ]
+)
+
+
+def test_tokenize_splits_cjk_bigrams_and_normalizes_numbers():
+    assert tokenize("修改 Story 003 的验收标准") == ["修改", "story", "3", "的验", "验收", "收标", "标准"]
+
+
+def test_prune_keeps_targeted_section_and_outlines_the_rest():
+    index = PrdIndex(min_chars=500, top_k=2)
+
+    pruned = index.prune(PRD, "把用户故事 3 的验收标准改成支持 Excel 导出")
+
+    assert pruned is not None
+    assert "AC-003-1" in pruned.text
+    assert "AC-001-1" not in pruned.text
+    assert "### 用户故事 1: 创建任务" in pruned.text
+    assert "## 3. 非功能需求" in pruned.text
+    assert "接口响应时间" not in pruned.text
+    assert len(pruned.text) < len(PRD) / 2
+    assert pruned.selected[0].startswith("### 用户故事 3")
+    # 只展示了标题行的章节不能整体替换 / 删除；同名的“验收标准”按第一次出现（故事 1）判断
+    assert "用户故事 3: 导出报表" not in pruned.protected
+    assert {"2. 用户故事", "用户故事 1: 创建任务", "3. 非功能需求", "验收标准"} <= pruned.protected
+
+
+def test_prune_sends_full_document_when_short_or_unrelated():
+    assert PrdIndex(min_chars=len(PRD) + 1).prune(PRD, "用户故事 3") is None
+    assert PrdIndex(min_chars=500).prune(PRD, "整体润色一下") is None
+
+
+def test_index_is_cached_and_reuses_unchanged_sections():
+    index = PrdIndex(min_chars=500)
+    first = index.index(PRD)
+    revised = PRD.replace("AC-004-2", "AC-004-3")
+
+    assert index.index(PRD) is first
+    second = index.index(revised)
+    assert second is not first
+    assert second.chunks[1].terms is first.chunks[1].terms
+    assert second.chunks[-2].terms is not first.chunks[-2].terms
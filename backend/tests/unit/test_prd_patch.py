@@ -0,0 +1,165 @@
+from src.core.prd_patch import (
+    PatchOp,
+    PatchStreamParser,
+    apply_patch,
+    apply_patch_events,
+    parse_sections,
+    strip_guide_trailer,
+)
+from tests.helpers import async_iter, collect
+
+PRD = """# 登录 PRD
+
+## 1. 功能背景
+用户需要登录。
+
+## 2. 成功标准
+- SC-001: 登录成功率 99%
+- SC-002: 用户满意度 80%
+
+## 3. 用户故事
+### 故事 1
+作为用户，我想登录。
+
+```markdown
+## 不是标题
+```
+
+## 4. 范围外
+- 第三方登录
+"""
+
+
+def test_parse_sections_nests_and_ignores_code_fences():
+    sections = parse_sections(PRD.split("\n"))
+    titles = [section.title for section in sections]
+
+    assert "不是标题" not in titles
+    story = next(section for section in sections if section.title == "3. 用户故事")
+    nested = next(section for section in sections if section.title == "故事 1")
+    assert story.start < nested.start < nested.end <= story.end
+
+
+def test_replace_section_keeps_rest_of_document():
+    op = PatchOp(
+        op="REPLACE",
+        target="## 2. 成功标准",
+        content="## 2. 成功标准\n- SC-001: 登录成功率 99%\n- SC-002: 用户满意度 90%",
+    )
+
+    result = apply_patch(PRD, op)
+
+    assert op.applied
+    assert "用户满意度 90%" in result
+    assert "用户满意度 80%" not in result
+    assert "## 3. 用户故事" in result
+    assert result.index("## 2. 成功标准") < result.index("## 3. 用户故事")
+
+
+def test_replace_without_heading_keeps_original_heading():
+    op = PatchOp(op="REPLACE", target="## 4. 范围外", content="- 第三方登录\n- 短信登录")
+
+    result = apply_patch(PRD, op)
+
+    assert "## 4. 范围外\n- 第三方登录\n- 短信登录" in result
+
+
+def test_insert_after_goes_after_nested_subsections():
+    op = PatchOp(op="INSERT_AFTER", target="## 3. 用户故事", content="## 3.5 用户流程\n1. 打开页面")
+
+    result = apply_patch(PRD, op)
+
+    assert result.index("## 不是标题") < result.index("## 3.5 用户流程") < result.index("## 4. 范围外")
+
+
+def test_delete_and_unknown_target():
+    deleted = apply_patch(PRD, PatchOp(op="DELETE", target="### 故事 1"))
+    missing = PatchOp(op="REPLACE", target="## 9. 不存在", content="x")
+
+    assert "作为用户，我想登录" not in deleted
+    assert apply_patch(PRD, missing) == PRD
+    assert not missing.applied
+
+
+def test_strip_guide_trailer():
+    document = PRD + "\n---\n\n### 💡 接下来可以考虑\n\n1. 需要验证码吗？\n"
+
+    assert strip_guide_trailer(document).rstrip() == PRD.rstrip()
+
+
+def test_stream_parser_handles_blocks_split_across_deltas():
+    parser = PatchStreamParser()
+    ops = []
+    for delta in ["<<<REP", "LACE ## 2. 成功标准\n## 2. 成功", "标准\n- SC-002: 90%\n>", ">>\n\n💡 问题"]:
+        ops.extend(parser.feed(delta))
+    ops.extend(parser.close())
+
+    assert len(ops) == 1
+    assert ops[0].target == "## 2. 成功标准"
+    assert ops[0].content == "## 2. 成功标准\n- SC-002: 90%"
+    assert parser.note == "💡 问题"
+
+
+def test_apply_patch_events_streams_patches_then_merged_document():
+    events = [
+        {"type": "reasoning", "content": "改 SC-002"},
+        {"type": "content", "content": "<<<REPLACE ## 2. 成功标准\n## 2. 成功标准\n- SC-002: 用户满意度 90%\n>>>\n"},
+        {"type": "content", "content": "\n### 💡 接下来可以考虑\n1. 如何衡量？"},
+        {"type": "usage", "input_tokens": 10, "output_tokens": 5, "total_tokens": 15},
+    ]
+
+    result = collect(apply_patch_events(async_iter(events), PRD))
+
+    assert [event["type"] for event in result] == ["reasoning", "patch", "content", "usage"]
+    assert result[1]["applied"] is True
+    merged = result[2]["content"]
+    assert "用户满意度 90%" in merged
+    assert "## 1. 功能背景" in merged
+    assert merged.endswith("---\n\n### 💡 接下来可以考虑\n1. 如何衡量？")
+
+
+def test_apply_patch_events_falls_back_to_full_document():
+    events = [{"type": "content", "content": "# 新 PRD\n\n## 1. 功能背景\n全部重写"}]
+
+    result = collect(apply_patch_events(async_iter(events), PRD))
+
+    assert result == [{"type": "content", "content": "# 新 PRD\n\n## 1. 功能背景\n全部重写"}]
+
+
+def test_apply_patch_events_rejects_full_document_for_pruned_context():
+    """模型只看到裁剪后的 PRD 时，整篇重写会丢失被省略的章节，应返回错误"""
+    events = [
+        {"type": "content", "content": "# 新 PRD\n\n## 1. 功能背景\n全部重写"},
+        {"type": "usage", "input_tokens": 10, "output_tokens": 5, "total_tokens": 15},
+    ]
+
+    result = collect(apply_patch_events(async_iter(events), PRD, allow_full_document=False))
+
+    assert [event["type"] for event in result] == ["error", "usage"]
+
+
+def test_apply_patch_events_does_not_replace_sections_outside_the_pruned_context():
+    """模型只看到 ## 3. 用户故事 的标题行：整体替换 / 删除会丢掉它没看到的故事，不应用"""
+    events = [
+        {"type": "content", "content": "<<<REPLACE ## 3. 用户故事\n## 3. 用户故事\n（空）\n>>>\n"},
+        {"type": "content", "content": "<<<DELETE ## 3. 用户故事\n>>>\n"},
+        {"type": "content", "content": "<<<INSERT_AFTER ## 3. 用户故事\n## 3.1 新章节\n>>>\n"},
+        {"type": "content", "content": "<<<REPLACE ## 2. 成功标准\n- SC-002: 90%\n>>>\n"},
+    ]
+
+    result = collect(apply_patch_events(async_iter(events), PRD, allow_full_document=False, protected={"3. 用户故事"}))
+
+    patches = [event for event in result if event["type"] == "patch"]
+    assert [event["applied"] for event in patches] == [False, False, True, True]
+    assert patches[0]["reason"] == "not_in_context"
+    assert "reason" not in patches[2]
+    merged = result[-1]["content"]
+    assert "作为用户，我想登录。" in merged
+    assert "## 3.1 新章节" in merged
+    assert "SC-002: 90%" in merged
+
+
+def test_apply_patch_events_skips_merge_on_error():
+    events = [{"type": "error", "message": "Upstream model error"}]
+
+    assert collect(apply_patch_events(async_iter(events), PRD)) == events
@@ -1,3 +1,7 @@
+import os
+
+import pytest
+
 from src.core.prompt_loader import (
     PromptLoader,
     get_chat_prompt_loader,
@@ -32,3 +36,51 @@ def test_chat_prompt_loader_default_path(monkeypatch):
     assert loader.file_path.name == "prompt-chat.md"
     assert loader.file_path.parent.name == "prompts"
     assert loader.file_path.exists()
+
+
+def _touch(path, content: str, mtime_ns: int):
+    path.write_text(content, encoding="utf-8")
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_prompt_loader_caches_until_reload_interval(tmp_path):
+    prompt_path = tmp_path / "prompt.md"
+    _touch(prompt_path, "v1", 1_000_000_000)
+    loader = PromptLoader(str(prompt_path), reload_interval=3600)
+
+    assert loader.load_prompt() == "v1"
+    _touch(prompt_path, "v2", 2_000_000_000)
+
+    # 未到重新校验间隔，继续使用内存中的内容
+    assert loader.load_prompt() == "v1"
+
+
+def test_prompt_loader_reloads_on_change_and_updates_version(tmp_path):
+    prompt_path = tmp_path / "prompt.md"
+    _touch(prompt_path, "v1", 1_000_000_000)
+    loader = PromptLoader(str(prompt_path), reload_interval=0)
+    first_version = loader.version
+
+    _touch(prompt_path, "v2", 2_000_000_000)
+
+    assert loader.load_prompt() == "v2"
+    assert loader.version != first_version
+    assert len(loader.version) == 12
+
+
+def test_prompt_loader_keeps_cached_prompt_when_file_disappears(tmp_path):
+    prompt_path = tmp_path / "prompt.md"
+    _touch(prompt_path, "v1", 1_000_000_000)
+    loader = PromptLoader(str(prompt_path), reload_interval=0)
+    loader.load_prompt()
+
+    prompt_path.unlink()
+
+    assert loader.load_prompt() == "v1"
+
+
+def test_prompt_loader_missing_file_raises(tmp_path):
+    loader = PromptLoader(str(tmp_path / "missing.md"))
+
+    with pytest.raises(FileNotFoundError):
+        loader.load_prompt()
@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from src.api.request_guard import JsonBodyScanner, PayloadTooLarge, RequestGuardMiddleware, TooManyItems
+from src.models.schemas import GenerationRequest, ImageAttachment, base64_decoded_size
+
+
+def _feed(body: bytes, chunk_size: int, **kwargs) -> JsonBodyScanner:
+    scanner = JsonBodyScanner(**kwargs)
+    for start in range(0, len(body), chunk_size):
+        scanner.feed(body[start : start + chunk_size])
+    return scanner
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1024])
+def test_scanner_accepts_strings_within_limits(chunk_size):
+    body = json.dumps(
+        {
+            "description": "登录功能" * 5,
+            "images": [{"data": "QUJD" * 4, "mime_type": "image/png"}],
+            "n": [1, 2.5, None],
+        },
+        ensure_ascii=False,
+    ).encode()
+
+    _feed(body, chunk_size, string_limits={"description": 20, "data": 16}, array_limits={"images": 1})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_scanner_counts_characters_not_bytes(chunk_size):
+    body = json.dumps({"current_prd": "需求" * 50}, ensure_ascii=False).encode()
+
+    _feed(body, chunk_size, string_limits={"current_prd": 100})
+    with pytest.raises(PayloadTooLarge, match="current_prd exceeds 99 characters"):
+        _feed(body, chunk_size, string_limits={"current_prd": 99})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 64])
+def test_scanner_counts_escapes_as_one_character(chunk_size):
+    # ensure_ascii 输出 \uXXXX 转义，表情符号为代理对
+    body = json.dumps({"description": 'a"b\\c\n需😀'}).encode()
+
+    _feed(body, chunk_size, string_limits={"description": 8})
+    with pytest.raises(PayloadTooLarge):
+        _feed(body, chunk_size, string_limits={"description": 7})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4096])
+def test_scanner_limits_arrays_by_key(chunk_size):
+    images = [{"image_id": "a" * 64, "tags": ["x", "y"]} for _ in range(3)]
+    body = json.dumps({"items": [{"images": images}, {"images": []}]}).encode()
+
+    _feed(body, chunk_size, array_limits={"images": 3, "items": 2})
+    with pytest.raises(TooManyItems, match="images cannot exceed 2 items") as exc_info:
+        _feed(body, chunk_size, array_limits={"images": 2})
+    assert exc_info.value.loc == ("items", 0, "images")
+    with pytest.raises(TooManyItems, match="items cannot exceed 1 items") as exc_info:
+        _feed(body, chunk_size, array_limits={"items": 1})
+    assert exc_info.value.loc == ("items",)
+
+
+def test_scanner_decodes_escaped_keys_and_ignores_values_named_like_keys():
+    with pytest.raises(PayloadTooLarge, match="data exceeds 4 characters"):
+        _feed(b'{"d\\u0061ta": "ABCDEFGH"}', 3, string_limits={"data": 4})
+
+    # 值恰好是 "data" 的字符串不会被当作键；未受限的键不计数
+    _feed(b'{"filename": "data", "other": "ABCDEFGH", "list": ["data", "ABCDEFGH"]}', 2, string_limits={"data": 4})
+
+
+def test_scanner_rejects_deep_nesting():
+    with pytest.raises(PayloadTooLarge, match="nesting"):
+        _feed(b"[" * 100, 10, max_depth=32)
+
+
+def test_base64_decoded_size_matches_decoding():
+    for size in range(0, 12):
+        data = base64.b64encode(b"x" * size).decode()
+        assert base64_decoded_size(data) == size
+
+
+def test_image_attachment_size_comes_from_data():
+    data = base64.b64encode(b"x" * 100).decode()
+
+    image = ImageAttachment(data=data, mime_type="image/png", size=1)
+
+    assert image.size == 100
+
+
+def test_image_attachment_rejects_oversized_data():
+    data = "QUJD" * (10 * 1024 * 1024 // 3 + 1)
+
+    with pytest.raises(ValidationError, match="image exceeds"):
+        ImageAttachment(data=data, mime_type="image/png")
+
+
+def _guarded_app(max_bytes: int = 1024 * 1024) -> tuple[FastAPI, list]:
+    app = FastAPI()
+    app.add_middleware(RequestGuardMiddleware, max_bytes=max_bytes)
+    handled = []
+
+    @app.post("/generate")
+    async def generate(request: GenerationRequest):
+        handled.append(request)
+        return {"images": len(request.images or ())}
+
+    return app, handled
+
+
+def test_middleware_rejects_content_length_over_cap():
+    app, handled = _guarded_app(max_bytes=100)
+
+    response = TestClient(app).post("/generate", json={"description": "x" * 200})
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Request body exceeds 100 bytes"}
+    assert handled == []
+
+
+def test_middleware_rejects_chunked_body_over_cap():
+    app, handled = _guarded_app(max_bytes=100)
+
+    def chunks():
+        for _ in range(10):
+            yield b" " * 50
+
+    response = TestClient(app).post("/generate", content=chunks(), headers={"Content-Type": "text/plain"})
+
+    assert response.status_code == 413
+    assert handled == []
+
+
+def test_middleware_rejects_oversized_field_while_streaming():
+    app, handled = _guarded_app(max_bytes=64 * 1024 * 1024)
+
+    def chunks():
+        yield b'{"description": "x", "images": [{"mime_type": "image/png", "data": "'
+        for _ in range(300):
+            yield b"QUJD" * 16384
+        yield b'"}]}'
+
+    response = TestClient(app).post("/generate", content=chunks(), headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 413
+    assert response.json()["detail"].startswith("data exceeds")
+    assert handled == []
+
+
+def test_middleware_stops_reading_at_the_limit():
+    app, handled = _guarded_app()
+    chunks = [b'{"description": "x", "current_prd": "', *[b"x" * 65536] * 20, b'"}']
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(1)
+        return {"type": "http.request", "body": chunks[len(received) - 1], "more_body": len(received) < len(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/generate",
+        "raw_path": b"/generate",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1),
+        "server": ("testserver", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+
+    assert sent[0]["status"] == 413
+    # current_prd 上限 500000 字符：第 9 个 64KB 分段越界后不再读取
+    assert len(received) == 9
+    assert handled == []
+
+
+def test_middleware_rejects_too_many_images():
+    app, handled = _guarded_app()
+    images = [{"image_id": "a" * 64} for _ in range(6)]
+
+    response = TestClient(app).post("/generate", json={"description": "x", "images": images})
+
+    # 与 Pydantic 的校验错误同为 422，detail 的结构一致
+    assert response.status_code == 422
+    assert response.json() == {
+        "detail": [{"type": "too_long", "loc": ["body", "images"], "msg": "images cannot exceed 5 items"}]
+    }
+    assert handled == []
+
+
+def test_middleware_passes_valid_requests():
+    app, handled = _guarded_app()
+    data = base64.b64encode(b"png").decode()
+
+    response = TestClient(app).post(
+        "/generate", json={"description": "登录", "images": [{"data": data, "mime_type": "image/png", "size": 999}]}
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {"images": 1}
+    assert handled[0].images[0].size == 3
@@ -0,0 +1,115 @@
+import hashlib
+
+from src.models.schemas import ImageAttachment
+from src.services import response_cache
+from src.services.response_cache import (
+    MemoryCacheBackend,
+    ResponseCache,
+    SQLiteCacheBackend,
+    build_request_key,
+)
+from tests.helpers import async_iter, collect
+
+EVENTS = [
+    {"type": "content", "content": "# PRD"},
+    {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3},
+]
+
+
+def _key(**overrides) -> str:
+    params = {
+        "description": "登录功能",
+        "model": "deepseek-v3.2",
+        "enable_thinking": True,
+        "prompt_version": "abc123",
+        "images": None,
+    }
+    params.update(overrides)
+    return build_request_key(**params)
+
+
+def test_request_key_normalizes_whitespace():
+    assert _key(description="  登录功能 \n") == _key()
+
+
+def test_request_key_covers_model_thinking_prompt_and_images():
+    image = ImageAttachment(data="aGVsbG8=", mime_type="image/png")
+
+    keys = {
+        _key(),
+        _key(model="qwen3-vl-plus"),
+        _key(enable_thinking=False),
+        _key(prompt_version="def456"),
+        _key(images=[image]),
+    }
+
+    assert len(keys) == 5
+
+
+def test_request_key_addresses_inline_images_by_their_bytes():
+    inline = ImageAttachment(data="aGVsbG8=", mime_type="image/png")
+    uploaded = ImageAttachment(image_id=hashlib.sha256(b"hello").hexdigest())
+
+    assert _key(images=[inline]) == _key(images=[uploaded])
+
+
+def test_memory_backend_lru_eviction():
+    backend = MemoryCacheBackend(max_entries=2, ttl=60)
+    backend.set("a", EVENTS)
+    backend.set("b", EVENTS)
+    backend.get("a")
+    backend.set("c", EVENTS)
+
+    assert backend.get("a") == EVENTS
+    assert backend.get("b") is None
+    assert backend.get("c") == EVENTS
+
+
+def test_memory_backend_ttl_expiry(monkeypatch):
+    backend = MemoryCacheBackend(max_entries=2, ttl=10)
+    monkeypatch.setattr(response_cache.time, "time", lambda: 1000.0)
+    backend.set("a", EVENTS)
+
+    monkeypatch.setattr(response_cache.time, "time", lambda: 1011.0)
+
+    assert backend.get("a") is None
+
+
+def test_sqlite_backend_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    backend = SQLiteCacheBackend(path, max_entries=1, ttl=60)
+    backend.set("a", EVENTS)
+
+    assert SQLiteCacheBackend(path, max_entries=1, ttl=60).get("a") == EVENTS
+
+    backend.set("b", EVENTS)
+    assert backend.get("a") is None
+    assert backend.get("b") == EVENTS
+
+
+def test_wrap_records_then_replays():
+    cache = ResponseCache(MemoryCacheBackend(max_entries=4, ttl=60))
+    upstream_runs = []
+
+    async def upstream():
+        upstream_runs.append(True)
+        for event in EVENTS:
+            yield event
+
+    first = collect(cache.wrap("k", upstream()))
+    second = collect(cache.wrap("k", upstream()))
+
+    assert first == EVENTS
+    assert second[0] == EVENTS[0]
+    assert second[1]["cached"] is True
+    # 第二次命中缓存，上游生成器从未被迭代
+    assert upstream_runs == [True]
+
+
+def test_wrap_does_not_cache_errors():
+    cache = ResponseCache(MemoryCacheBackend(max_entries=4, ttl=60))
+    events = [{"type": "content", "content": "partial"}, {"type": "error", "message": "Upstream model error"}]
+
+    collect(cache.wrap("k", async_iter(events)))
+
+    assert cache.backend.get("k") is None
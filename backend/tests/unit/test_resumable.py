@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from src.services.inflight import ReplayGone
+from src.services.resumable import ResumableStreams
+
+
+async def _take(stream, count: int) -> list[dict]:
+    events = []
+    async for event in stream:
+        events.append(event)
+        if len(events) == count:
+            break
+    await stream.aclose()
+    return events
+
+
+def test_events_are_numbered_and_resumable_after_disconnect():
+    async def scenario():
+        streams = ResumableStreams(grace=5, max_events=100)
+        gate = asyncio.Event()
+
+        async def upstream():
+            yield {"type": "content", "content": "A"}
+            await gate.wait()
+            yield {"type": "content", "content": "B"}
+
+        stream = streams.start(upstream())
+        first = await _take(streams.subscribe(stream), 2)
+        # 客户端断开后上游继续生成
+        gate.set()
+        await asyncio.sleep(0.01)
+        resumed = [event async for event in streams.subscribe(stream, last_event_id=first[-1]["id"])]
+        return stream, first, resumed
+
+    stream, first, resumed = asyncio.run(scenario())
+
+    assert first == [
+        {"type": "generation", "generation_id": stream.generation_id, "id": 1},
+        {"type": "content", "content": "A", "id": 2},
+    ]
+    assert resumed == [{"type": "content", "content": "B", "id": 3}]
+
+
+def test_generation_is_cancelled_when_nobody_resumes():
+    closed = []
+
+    async def scenario(grace: float):
+        streams = ResumableStreams(grace=grace, max_events=100)
+
+        async def upstream():
+            try:
+                yield {"type": "content", "content": "A"}
+                await asyncio.Event().wait()
+            finally:
+                closed.append(grace)
+
+        stream = streams.start(upstream())
+        await _take(streams.subscribe(stream), 2)
+        await asyncio.sleep(0.05)
+        return stream
+
+    assert asyncio.run(scenario(0)).done
+    assert asyncio.run(scenario(0.01)).done
+    assert closed == [0, 0.01]
+
+
+def test_replay_buffer_is_bounded():
+    async def scenario():
+        streams = ResumableStreams(grace=5, max_events=3)
+
+        async def upstream():
+            for index in range(5):
+                yield {"type": "content", "content": str(index)}
+
+        stream = streams.start(upstream())
+        await asyncio.sleep(0.01)
+        assert not stream.can_resume(1)
+        assert stream.can_resume(3)
+        with pytest.raises(ReplayGone):
+            await _take(streams.subscribe(stream, last_event_id=1), 1)
+        return [event["content"] async for event in streams.subscribe(stream, last_event_id=4)]
+
+    assert asyncio.run(scenario()) == ["3", "4"]
@@ -0,0 +1,87 @@
+import asyncio
+
+from src.models.schemas import ImageAttachment
+from src.services.session_store import (
+    MemorySessionBackend,
+    SessionRecord,
+    SessionStore,
+    SQLiteSessionBackend,
+    prd_etag,
+)
+from tests.helpers import async_iter, collect
+
+
+def _record(prd: str, images: list[dict] | None = None) -> SessionRecord:
+    return SessionRecord(prd=prd, etag=prd_etag(prd), images=images or [])
+
+
+def test_memory_backend_evicts_least_recently_used_by_size():
+    backend = MemorySessionBackend(max_bytes=10, ttl=60)
+    backend.set("a", _record("aaaa"))
+    backend.set("b", _record("bbbb"))
+    assert backend.get("a") is not None  # a 变为最近使用
+
+    backend.set("c", _record("cccc"))
+
+    assert backend.get("b") is None
+    assert backend.get("a").prd == "aaaa"
+    assert backend.total_bytes == 8
+
+
+def test_memory_backend_skips_oversized_and_expired_records():
+    backend = MemorySessionBackend(max_bytes=4, ttl=60)
+    backend.set("big", _record("too large"))
+    assert backend.get("big") is None
+
+    backend.ttl = 0
+    backend.set("a", _record("a"))
+    assert backend.get("a") is None
+    assert backend.total_bytes == 0
+
+
+def test_sqlite_backend_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    backend = SQLiteSessionBackend(path, max_bytes=10, ttl=60)
+    backend.set("a", _record("aaaa", [{"data": "aGk=", "mime_type": "image/png"}]))
+
+    reopened = SQLiteSessionBackend(path, max_bytes=10, ttl=60)
+    record = reopened.get("a")
+    assert record.prd == "aaaa"
+    assert record.image_attachments()[0].mime_type == "image/png"
+
+    reopened.set("b", _record("bbbbbb"))
+    assert reopened.get("a") is None
+    assert reopened.delete("b")
+    assert not reopened.delete("b")
+
+
+def test_wrap_stores_final_document_and_emits_session_event():
+    store = SessionStore(MemorySessionBackend(max_bytes=1024, ttl=60))
+    image = ImageAttachment(data="aGk=", mime_type="image/png")
+    events = [
+        {"type": "content", "content": "# PRD"},
+        {"type": "content", "content": "\n正文"},
+        {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3},
+    ]
+
+    result = collect(store.wrap("s1", async_iter(events), [image]))
+
+    assert result[:3] == events
+    assert result[3] == {"type": "session", "session_id": "s1", "etag": prd_etag("# PRD\n正文")}
+    record = asyncio.run(store.get("s1"))
+    assert record.prd == "# PRD\n正文"
+    assert record.images == [image.model_dump()]
+
+    # 后续轮次不带图片时沿用已保存的图片
+    collect(store.wrap("s1", async_iter([{"type": "content", "content": "# PRD v2"}])))
+    record = asyncio.run(store.get("s1"))
+    assert record.prd == "# PRD v2"
+    assert record.images == [image.model_dump()]
+
+
+def test_wrap_does_not_store_failed_generation():
+    store = SessionStore(MemorySessionBackend(max_bytes=1024, ttl=60))
+    events = [{"type": "content", "content": "partial"}, {"type": "error", "message": "Upstream model error"}]
+
+    assert collect(store.wrap("s1", async_iter(events))) == events
+    assert asyncio.run(store.get("s1")) is None
@@ -0,0 +1,106 @@
+import asyncio
+import multiprocessing
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from src.api.admission import AdmissionController
+from src.core.shared_state import MemorySharedState, PrefixedState, RedisSharedState, SQLiteSharedState
+from src.services.response_cache import SharedStateCacheBackend
+from src.services.session_store import SessionRecord, SharedStateSessionBackend, prd_etag
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def state(request, tmp_path):
+    if request.param == "memory":
+        return MemorySharedState()
+    if request.param == "sqlite":
+        return SQLiteSharedState(str(tmp_path / "shared.sqlite3"))
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisSharedState(client=fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_get_set_delete_and_expiry(state):
+    state.set("a", "1")
+    state.set("b", "2", ttl=0.05)
+
+    assert state.get("a") == "1"
+    assert state.get("b") == "2"
+    time.sleep(0.1)
+    assert state.get("b") is None
+    assert state.delete("a") is True
+    assert state.delete("a") is False
+    assert state.get("a") is None
+
+
+def test_incr_is_counted_and_restarts_after_expiry(state):
+    assert state.incr("n", 1, ttl=0.05) == 1
+    assert state.incr("n", 2) == 3
+    assert state.incr("n", -1) == 2
+    time.sleep(0.1)
+    assert state.incr("n", 1, ttl=60) == 1
+
+
+def test_prefixed_state_namespaces_keys():
+    inner = MemorySharedState()
+    PrefixedState(inner, "app:").set("k", "v")
+
+    assert inner.get("app:k") == "v"
+    assert PrefixedState(inner, "other:").get("k") is None
+
+
+def _count(path: str, times: int) -> None:
+    state = SQLiteSharedState(path)
+    for _ in range(times):
+        state.incr("hits", 1, ttl=60)
+
+
+def test_sqlite_counter_is_atomic_across_processes(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    SQLiteSharedState(path)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_count, args=(path, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+
+    assert [worker.exitcode for worker in workers] == [0, 0, 0, 0]
+    assert SQLiteSharedState(path).get("hits") == "200"
+
+
+def test_per_client_limit_holds_across_workers(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    options = {"max_concurrent": 10, "max_per_client": 2, "max_queue": 10, "queue_timeout": 5}
+    worker_a = AdmissionController(**options, state=SQLiteSharedState(path))
+    worker_b = AdmissionController(**options, state=SQLiteSharedState(path))
+
+    async def scenario():
+        first = await worker_a.admit("ip:1")
+        await worker_b.admit("ip:1")
+        with pytest.raises(HTTPException) as exc_info:
+            await worker_a.admit("ip:1")
+        assert exc_info.value.status_code == 429
+
+        await first.release()
+        await worker_b.admit("ip:1")
+        await worker_b.admit("ip:2")
+
+    asyncio.run(scenario())
+
+
+def test_cache_and_sessions_are_visible_to_every_worker(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    worker_a, worker_b = SQLiteSharedState(path), SQLiteSharedState(path)
+    events = [{"type": "content", "content": "PRD"}]
+
+    SharedStateCacheBackend(worker_a, ttl=60).set("key", events)
+    assert SharedStateCacheBackend(worker_b, ttl=60).get("key") == events
+
+    record = SessionRecord(prd="# PRD", etag=prd_etag("# PRD"), images=[{"image_id": "0" * 64}])
+    SharedStateSessionBackend(worker_a, max_bytes=1024, ttl=60).set("s1", record)
+    sessions_b = SharedStateSessionBackend(worker_b, max_bytes=1024, ttl=60)
+    assert sessions_b.get("s1") == record
+    assert sessions_b.delete("s1") is True
+    assert SharedStateSessionBackend(worker_a, max_bytes=1024, ttl=60).get("s1") is None
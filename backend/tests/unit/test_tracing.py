@@ -0,0 +1,122 @@
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src.core.tracing import Tracer, TracingMiddleware, activate, parse_traceparent, span, trace_stream
+
+
+class CollectingExporter:
+    def __init__(self):
+        self.spans = []
+
+    def on_start(self, span) -> None:
+        pass
+
+    def on_end(self, span) -> None:
+        self.spans.append(span)
+
+    def by_name(self, name: str):
+        return next(span for span in self.spans if span.name == name)
+
+
+def test_sampling_and_traceparent():
+    exporter = CollectingExporter()
+    traceparent = "00-" + "a" * 32 + "-" + "b" * 16 + "-01"
+
+    assert Tracer(sample_rate=0, exporter=exporter).start_trace("request") is None
+    assert Tracer(sample_rate=1, exporter=exporter).start_trace("request") is not None
+    root = Tracer(sample_rate=0, exporter=exporter).start_trace("request", traceparent=traceparent)
+
+    assert root.trace_id == "a" * 32
+    assert root.parent_id == "b" * 16
+    assert parse_traceparent("00-" + "a" * 32 + "-" + "b" * 16 + "-00")[2] is False
+    assert parse_traceparent("garbage") is None
+
+
+def test_spans_nest_under_the_active_span():
+    exporter = CollectingExporter()
+    root = Tracer(sample_rate=1, exporter=exporter).start_trace("request")
+
+    with span("outside") as outside:
+        assert outside is None
+    with activate(root), span("prepare", step=1) as prepare, span("inner"):
+        assert prepare is not None
+    root.end()
+
+    inner, prepare, request = exporter.spans
+    assert [span.name for span in exporter.spans] == ["inner", "prepare", "request"]
+    assert inner.parent_id == prepare.span_id
+    assert prepare.parent_id == request.span_id
+    assert prepare.attributes == {"step": 1}
+    assert {span.trace_id for span in exporter.spans} == {request.trace_id}
+
+
+def test_trace_stream_marks_first_token_and_errors():
+    exporter = CollectingExporter()
+    root = Tracer(sample_rate=1, exporter=exporter).start_trace("request")
+
+    async def upstream():
+        yield {"type": "reasoning", "content": "think"}
+        yield {"type": "error", "message": "x", "code": "Throttling"}
+
+    async def endless():
+        while True:
+            yield {"type": "content", "content": "a"}
+
+    async def scenario():
+        with activate(root):
+            events = [event async for event in trace_stream(upstream(), "upstream.call", model="m")]
+            abandoned = trace_stream(endless(), "upstream.hedge")
+            await anext(abandoned)
+            await abandoned.aclose()
+        return events
+
+    events = asyncio.run(scenario())
+
+    call = exporter.by_name("upstream.call")
+    assert len(events) == 2
+    assert call.attributes["model"] == "m"
+    assert call.attributes["events"] == 2
+    assert "first_token_ms" in call.attributes
+    assert call.error == "Throttling"
+    hedge = exporter.by_name("upstream.hedge")
+    assert hedge.attributes["cancelled"] is True
+    assert hedge.error is None
+
+
+def test_middleware_traces_request_body_and_response():
+    exporter = CollectingExporter()
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, tracer=Tracer(sample_rate=1, exporter=exporter))
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        with span("handler"):
+            return {"size": len(body)}
+
+    response = TestClient(app).post("/echo", content=b"x" * 100)
+
+    root = exporter.by_name("http.request")
+    assert response.headers["X-Trace-Id"] == root.trace_id
+    assert root.attributes["http.status_code"] == 200
+    assert root.attributes["http.target"] == "/echo"
+    assert "first_byte_ms" in root.attributes
+    assert exporter.by_name("request.body").attributes["bytes"] == 100
+    assert exporter.by_name("handler").parent_id == root.span_id
+
+
+def test_middleware_skips_unsampled_requests():
+    exporter = CollectingExporter()
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, tracer=Tracer(sample_rate=0, exporter=exporter))
+
+    @app.get("/ping")
+    async def ping():
+        return {}
+
+    response = TestClient(app).get("/ping")
+
+    assert "X-Trace-Id" not in response.headers
+    assert exporter.spans == []
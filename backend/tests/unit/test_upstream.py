@@ -0,0 +1,166 @@
+import asyncio
+
+from src.services.upstream import CircuitBreaker, ResilientUpstream
+from tests.helpers import collect
+
+
+def _upstream(**kwargs) -> ResilientUpstream:
+    options = {
+        "retries": 2,
+        "backoff_base": 0,
+        "backoff_max": 0,
+        "hedge_after": 0,
+        "breaker_failures": 0,
+        "breaker_reset": 30,
+    }
+    options.update(kwargs)
+    return ResilientUpstream(**options)
+
+
+async def _drain(stream) -> list[dict]:
+    return [event async for event in stream]
+
+
+def _scripted(scripts: dict[str, list], calls: list[str], closed: list[str] | None = None):
+    """Each call for a model pops the next script: a list of events, with floats meaning sleep."""
+
+    def start(model: str):
+        calls.append(model)
+        script = scripts[model].pop(0)
+
+        async def events():
+            try:
+                for item in script:
+                    if isinstance(item, float):
+                        await asyncio.sleep(item)
+                    else:
+                        yield item
+            finally:
+                if closed is not None:
+                    closed.append(model)
+
+        return events()
+
+    return start
+
+
+ERROR = {"type": "error", "message": "Upstream model error", "code": "InternalError"}
+CONTENT = {"type": "content", "content": "PRD"}
+USAGE = {"type": "usage", "input_tokens": 1, "output_tokens": 2, "total_tokens": 3}
+
+
+def test_retries_until_first_token():
+    calls: list[str] = []
+    start = _scripted({"m": [[ERROR], [ERROR], [CONTENT, USAGE]]}, calls)
+
+    assert collect(_upstream().stream(["m"], start)) == [CONTENT, USAGE]
+    assert calls == ["m", "m", "m"]
+
+
+def test_gives_up_after_retries_and_on_non_retryable_errors():
+    calls: list[str] = []
+    start = _scripted({"m": [[ERROR], [ERROR]]}, calls)
+    assert collect(_upstream(retries=1).stream(["m"], start)) == [ERROR]
+    assert calls == ["m", "m"]
+
+    blocked = {"type": "error", "message": "Upstream model error", "code": "DataInspectionFailed"}
+    calls = []
+    start = _scripted({"m": [[blocked]], "fallback": [[CONTENT]]}, calls)
+    assert collect(_upstream().stream(["m", "fallback"], start)) == [blocked]
+    assert calls == ["m"]
+
+
+def test_errors_after_first_token_are_not_retried():
+    calls: list[str] = []
+    start = _scripted({"m": [[CONTENT, ERROR]]}, calls)
+
+    assert collect(_upstream().stream(["m"], start)) == [CONTENT, ERROR]
+    assert calls == ["m"]
+
+
+def test_fails_over_to_next_model():
+    calls: list[str] = []
+    start = _scripted({"primary": [[ERROR]], "fallback": [[CONTENT]]}, calls)
+
+    assert collect(_upstream().stream(["primary", "fallback"], start)) == [CONTENT]
+    assert calls == ["primary", "fallback"]
+
+
+def test_hedges_slow_first_token_and_cancels_loser():
+    calls: list[str] = []
+    closed: list[str] = []
+    slow = [5.0, {"type": "content", "content": "slow"}]
+    start = _scripted({"primary": [slow], "fallback": [[CONTENT, USAGE]]}, calls, closed)
+
+    result = collect(_upstream(hedge_after=0.01).stream(["primary", "fallback"], start))
+
+    assert result == [CONTENT, USAGE]
+    assert calls == ["primary", "fallback"]
+    assert sorted(closed) == ["fallback", "primary"]
+
+
+def test_circuit_breaker_skips_failing_model():
+    calls: list[str] = []
+    upstream = _upstream(retries=0, breaker_failures=2)
+    start = _scripted({"primary": [[ERROR], [ERROR]], "fallback": [[CONTENT], [CONTENT], [CONTENT]]}, calls)
+
+    for _ in range(3):
+        assert collect(upstream.stream(["primary", "fallback"], start)) == [CONTENT]
+
+    assert calls == ["primary", "fallback", "primary", "fallback", "fallback"]
+    assert upstream.breaker("primary").state == "open"
+
+
+def test_circuit_breaker_half_open_after_reset():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+    open_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    open_breaker.record_failure()
+    assert not open_breaker.allow()
+
+
+def test_half_open_breaker_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+
+    assert breaker.acquire()
+    assert not breaker.allow()
+    assert not breaker.acquire()
+    breaker.end_trial()
+    assert breaker.acquire()
+    breaker.record_failure()
+    assert breaker.acquire()
+    breaker.record_success()
+    assert breaker.acquire() and breaker.acquire()
+
+
+def test_concurrent_requests_fail_fast_while_trial_runs():
+    upstream = _upstream(retries=0, breaker_failures=1, breaker_reset=0)
+    upstream.breaker("m").record_failure()
+    calls: list[str] = []
+    start = _scripted({"m": [[0.05, CONTENT]]}, calls)
+
+    async def scenario():
+        return await asyncio.gather(*(_drain(upstream.stream(["m"], start)) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+
+    assert calls == ["m"]
+    assert results[0] == [CONTENT]
+    assert [result[0]["code"] for result in results[1:]] == ["CircuitOpen", "CircuitOpen"]
+    assert upstream.breaker("m").state == "closed"
+
+
+def test_all_breakers_open_fails_fast():
+    upstream = _upstream(breaker_failures=1, breaker_reset=60)
+    upstream.breaker("m").record_failure()
+
+    result = collect(upstream.stream(["m"], lambda model: None))
+
+    assert result[0]["code"] == "CircuitOpen"
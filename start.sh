@@ -10,12 +10,21 @@ docker rm spec-nginx spec-frontend-prod spec-backend-prod 2>/dev/null
 export DASHSCOPE_API_KEY=$(grep "^DASHSCOPE_API_KEY=" .env | cut -d'=' -f2)
 export DASHSCOPE_MODEL=$(grep "^DASHSCOPE_MODEL=" .env | cut -d'=' -f2)
 export DASHSCOPE_VL_MODEL=$(grep "^DASHSCOPE_VL_MODEL=" .env | cut -d'=' -f2)
+export DASHSCOPE_FALLBACK_MODELS=$(grep "^DASHSCOPE_FALLBACK_MODELS=" .env | cut -d'=' -f2)
+export DASHSCOPE_VL_FALLBACK_MODELS=$(grep "^DASHSCOPE_VL_FALLBACK_MODELS=" .env | cut -d'=' -f2)
 export ENABLE_THINKING=$(grep "^ENABLE_THINKING=" .env | cut -d'=' -f2)
 export DEBUG_ERRORS=$(grep "^DEBUG_ERRORS=" .env | cut -d'=' -f2)
 export ALLOWED_ORIGINS=$(grep "^ALLOWED_ORIGINS=" .env | cut -d'=' -f2)
+export CHAT_EDIT_MODE=$(grep "^CHAT_EDIT_MODE=" .env | cut -d'=' -f2)
+export TRUSTED_PROXIES=$(grep "^TRUSTED_PROXIES=" .env | cut -d'=' -f2)
 
-# Create network if not exists
-docker network create app-network 2>/dev/null || true
+# Create network if not exists; nginx gets a fixed address that the backend trusts for client IPs
+NETWORK_SUBNET=172.28.0.0/16
+NGINX_IP=172.28.0.10
+if [ "$(docker network inspect app-network -f '{{range .IPAM.Config}}{{.Subnet}}{{end}}' 2>/dev/null)" != "$NETWORK_SUBNET" ]; then
+  docker network rm app-network 2>/dev/null
+  docker network create --subnet "$NETWORK_SUBNET" app-network
+fi
 
 # Start backend
 docker run -d --name spec-backend-prod --network app-network \
@@ -24,11 +33,16 @@ docker run -d --name spec-backend-prod --network app-network \
   -e DASHSCOPE_API_KEY=$DASHSCOPE_API_KEY \
   -e DASHSCOPE_MODEL=${DASHSCOPE_MODEL:-qwen-max} \
   -e DASHSCOPE_VL_MODEL=${DASHSCOPE_VL_MODEL:-qwen-vl-plus} \
+  -e DASHSCOPE_FALLBACK_MODELS=${DASHSCOPE_FALLBACK_MODELS:-} \
+  -e DASHSCOPE_VL_FALLBACK_MODELS=${DASHSCOPE_VL_FALLBACK_MODELS:-} \
   -e ENABLE_THINKING=${ENABLE_THINKING:-false} \
   -e DEBUG_ERRORS=${DEBUG_ERRORS:-false} \
   -e ALLOWED_ORIGINS=${ALLOWED_ORIGINS:-http://localhost:23456} \
   -e PROMPT_FILE_PATH=/app/prompts/prompt.md \
   -e PROMPT_CHAT_FILE_PATH=/app/prompts/prompt-chat.md \
+  -e PROMPT_CHAT_PATCH_FILE_PATH=/app/prompts/prompt-chat-patch.md \
+  -e CHAT_EDIT_MODE=${CHAT_EDIT_MODE:-full} \
+  -e TRUSTED_PROXIES=${TRUSTED_PROXIES:-$NGINX_IP} \
   -e PYTHONUNBUFFERED=1 \
   -e LOG_LEVEL=info \
   --restart unless-stopped \
@@ -43,7 +57,7 @@ docker run -d --name spec-frontend-prod --network app-network \
   spec-generator-frontend:prod
 
 # Start nginx
-docker run -d --name spec-nginx --network app-network \
+docker run -d --name spec-nginx --network app-network --ip "$NGINX_IP" \
   -p 23456:23456 \
   -v ./nginx.conf:/etc/nginx/nginx.conf:ro \
   -v /dev/null:/etc/nginx/conf.d/default.conf:ro \